@@ -1,10 +1,22 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
 import altair as alt
 import json
-import gspread
-from google.oauth2.service_account import Credentials
+import functools
+import threading
+import uuid
+from collections import OrderedDict, deque
+from motor import (
+    formato_europeo, formateador_europeo, formato_europeo_columna, huella_fuentes, construir_simulador, preprocesar_fuentes,
+    construir_ranking_simulador, editar_simulador, procesar_cadena_cascada, construir_cubo,
+    familias_cubo, precio_cp_familias, resumen_clientes_cubo,
+    nueva_cache_lru, memo_lru, desglose_venta, desglose_simulador, mascara_filtros, opciones_filtro,
+    etapa, medir_etapa, iniciar_medicion, cerrar_medicion, medicion_actual, tabla_mediciones, CONTADORES_ETAPAS,
+)
+from fuentes import (
+    cliente_gspread, id_spreadsheet, revisiones_spreadsheets, recargar_fuentes, FUENTES_SHEETS,
+    preparar_base, preparar_equivalencias, preparar_ventas,
+)
 
 # --- CONFIGURACIÓN ---
 st.set_page_config(
@@ -85,43 +97,11 @@ def get_gspread_client():
             creds_dict = json.loads(creds_secret)
         else:
             creds_dict = dict(creds_secret)
-            
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets.readonly",
-            "https://www.googleapis.com/auth/drive.readonly"
-        ]
-        credentials = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-        return gspread.authorize(credentials)
+        return cliente_gspread(creds_dict)
     except Exception as e:
         st.error(f"🚨 Error en la configuración de la clave de Google: {e}")
         st.stop()
 
-def load_sheet_df(url):
-    """Extrae la información de Google Sheets usando el enlace real."""
-    client = get_gspread_client()
-    # Extraer el GID (Identificador de la pestaña)
-    gid = 0
-    if "gid=" in url:
-        gid = url.split("gid=")[-1].split("&")[0]
-        
-    try:
-        sheet = client.open_by_url(url)
-        ws = sheet.get_worksheet_by_id(int(gid))
-        data = ws.get_all_values()
-        
-        if not data:
-            return pd.DataFrame()
-        
-        # Convierte los datos brutos en un DataFrame de Pandas usando la primera fila como cabecera
-        return pd.DataFrame(data[1:], columns=data[0])
-    except Exception as e:
-        raise Exception(f"No se pudo acceder a la hoja. ¿Has compartido el Excel con el correo del Robot? Detalle técnico: {e}")
-
-# --- ENLACES REALES DE DATOS PRIVADOS ---
-VENTAS_URL = 'https://docs.google.com/spreadsheets/d/1kyiTFjTl-XxkwhYQlm6FjMbnZWhNR4-AtW3iFj2qXzs/edit?gid=1543847315#gid=1543847315'
-BASE_URL = 'https://docs.google.com/spreadsheets/d/1nGSUQGspPnvkkSD0qmlYqhhfXAEAqbN1vm5DTPhaDkM/edit?gid=0#gid=0'
-EQUIV_URL = 'https://docs.google.com/spreadsheets/d/1nGSUQGspPnvkkSD0qmlYqhhfXAEAqbN1vm5DTPhaDkM/edit?gid=1911720872#gid=1911720872'
-
 # =====================================================================
 
 # --- FUNCIONES DE DIBUJADO DE KPIs ---
@@ -133,291 +113,154 @@ def render_kpi(titulo, valor, color_texto="#38BDF8"):
     </div>
     """
 
-# --- FUNCIONES DE LIMPIEZA Y FORMATO ---
-def clean_european_number(x):
-    if pd.isna(x) or str(x).strip() == '': return 0.0
-    if isinstance(x, (int, float)): return float(x)
-    try: return float(str(x).replace('.', '').replace(',', '.'))
-    except ValueError: return 0.0
-
-def formato_europeo(val, decimales=2, sufijo=""):
-    if pd.isna(val) or val == np.inf or val == -np.inf: return "0" + sufijo
-    formateado = f"{val:,.{decimales}f}".replace(',', 'X').replace('.', ',').replace('X', '.')
-    return formateado + sufijo
-
-def recalcular_dataframe(df):
-    if 'Cantidad(kg)' in df.columns and 'Escandallo' in df.columns:
-        df['Total_Kg_Grupo'] = df.groupby('Escandallo')['Cantidad(kg)'].transform('sum')
-        df['%_Calculado'] = np.where(df['Total_Kg_Grupo'] > 0, df['Cantidad(kg)'] / df['Total_Kg_Grupo'], 0.0)
-
-    cols_calc = ['Precio EXW', 'Coste_congelación', 'Coste_despiece', '%_Calculado']
-    if all(c in df.columns for c in cols_calc):
-        df['Precio_escandallo_Calculado'] = (df['Precio EXW'] - df['Coste_congelación'] - df['Coste_despiece']) * df['%_Calculado']
-    return df
-
-# --- MOTOR MRP ---
-def procesar_ventas_cascada(df_v, df_esc_completo, mapa_esc_principal, mapa_equiv, esc_to_princ):
-    df_v_agrupado = df_v.groupby(['Cliente', 'Código', 'Nombre']).agg({'Kilos': 'sum', 'Precio EXW': 'mean'}).reset_index()
-    
-    global_avg = {}
-    for cod, grp in df_v_agrupado.groupby('Código'):
-        tot_k = grp['Kilos'].sum()
-        if tot_k > 0: global_avg[str(cod)] = (grp['Kilos'] * grp['Precio EXW']).sum() / tot_k
+# --- CARGA DE FUENTES ---
+# La descarga y limpieza viven en fuentes.py y todo el cálculo en motor.py, ninguno depende de Streamlit.
+# Cada fuente se prepara una vez por revisión de su Spreadsheet. Las revisiones se consultan cada 10 minutos o al pulsar
+# "Actualizar" y solo se descargan los Spreadsheets que han cambiado (ver recargar_fuentes).
+NOMBRES_FUENTES = {'base': "Base de Datos", 'equivalencias': "Equivalencias", 'ventas': "Ventas"}
 
-    client_avg = {}
-    banco_kilos = {} 
-    
-    for cli, grp_cli in df_v_agrupado.groupby('Cliente'):
-        cli_str = str(cli)
-        client_avg[cli_str] = {}
-        banco_kilos[cli_str] = {}
-        for _, row in grp_cli.iterrows():
-            cod = str(row['Código'])
-            client_avg[cli_str][cod] = row['Precio EXW']
-            banco_kilos[cli_str][cod] = {'kilos': float(row['Kilos']), 'precio': float(row['Precio EXW']), 'nombre': str(row['Nombre'])}
-
-    ventas_procesadas = []
-
-    for _, row in df_v_agrupado.iterrows():
-        cli = str(row['Cliente'])
-        cod_vendido = str(row['Código']).strip()
-        kilos_cliente = float(row['Kilos'])
-        precio_cliente = float(row['Precio EXW'])
-        nombre_articulo = str(row['Nombre'])
-
-        esc_id = None
-        cod_principal_teorico = None
-        
-        if cod_vendido in mapa_esc_principal:
-            esc_id = mapa_esc_principal[cod_vendido]
-            cod_principal_teorico = cod_vendido
-        elif cod_vendido in mapa_equiv:
-            esc_id = mapa_equiv[cod_vendido][0]
-            cod_principal_teorico = mapa_equiv[cod_vendido][1]
-
-        if esc_id is not None and cod_principal_teorico is not None:
-            df_bloque_esc = df_esc_completo[df_esc_completo['Escandallo'] == esc_id]
-            if not df_bloque_esc.empty:
-                fam_temp = df_bloque_esc['Familia'].iloc[0] if 'Familia' in df_bloque_esc.columns else "Sin clasificar"
-                if pd.isna(fam_temp) or str(fam_temp).strip() == "": fam_temp = "Sin clasificar"
-                
-                fila_principal = df_bloque_esc[df_bloque_esc['Código'].astype(str) == cod_principal_teorico]
-                pct_principal = fila_principal['%_Calculado'].iloc[0] if not fila_principal.empty else 0.0
-                kilos_cp = (kilos_cliente / pct_principal) if pct_principal > 0 else 0.0
-                
-                precio_cp_unitario = 0.0
-                
-                for _, item in df_bloque_esc.iterrows():
-                    cod_item = str(item['Código']).strip()
-                    pct_item = float(item['%_Calculado'])
-                    coste_cong = float(item.get('Coste_congelación', 0.0))
-                    coste_desp = float(item.get('Coste_despiece', 0.0))
-                    
-                    if cod_item == cod_principal_teorico: 
-                        precio_exw_dinamico = precio_cliente
-                        codigo_a_consumir = cod_vendido 
-                    else:
-                        codigo_a_consumir = cod_item
-                        if cod_item in client_avg.get(cli, {}): precio_exw_dinamico = client_avg[cli][cod_item]
-                        elif cod_item in global_avg: precio_exw_dinamico = global_avg[cod_item]
-                        else: precio_exw_dinamico = float(item.get('Precio EXW', 0.0))
-                    
-                    precio_cp_unitario += (precio_exw_dinamico - coste_cong - coste_desp) * pct_item
-                    
-                    if cli in banco_kilos and codigo_a_consumir in banco_kilos[cli]:
-                        banco_kilos[cli][codigo_a_consumir]['kilos'] -= (kilos_cp * pct_item)
-
-                ventas_procesadas.append({
-                    'Cliente': cli, 'Código': cod_vendido, 'Artículo': nombre_articulo,
-                    'Familia': fam_temp, 'Kilos': kilos_cliente, 'Kilos_CP': kilos_cp,
-                    'Precio EXW': precio_cliente, 'Precio_CP_Unitario': precio_cp_unitario,
-                    'Precio_CP_Total': precio_cp_unitario * kilos_cp
-                })
-
-    sobrantes = []
-    for cli, codigos in banco_kilos.items():
-        for cod, data in codigos.items():
-            if data['kilos'] > 0.01: 
-                sobrantes.append({
-                    'Cliente': cli, 'Código': cod, 'Artículo': data['nombre'],
-                    'Familia': 'Sin clasificar', 'Kilos': data['kilos'], 'Kilos_CP': 0.0,
-                    'Precio EXW': data['precio'], 'Precio_CP_Unitario': 0.0, 'Precio_CP_Total': 0.0
-                })
-
-    df_final = pd.DataFrame(ventas_procesadas)
-    if sobrantes:
-        df_final = pd.concat([df_final, pd.DataFrame(sobrantes)], ignore_index=True)
-
-    return df_final, global_avg, client_avg
-
-@st.cache_data(ttl=600)
-def load_equiv_data():
-    try:
-        df_e = load_sheet_df(EQUIV_URL)
-        if df_e.empty: return {}, "El archivo de Equivalencias está vacío."
-        
-        df_e.columns = df_e.columns.str.strip()
-        for c in df_e.columns:
-            c_up = c.upper()
-            if c_up in ['CODIGO', 'CÓDIGO']: df_e.rename(columns={c: 'Código'}, inplace=True)
-            elif c_up == 'ESCANDALLO': df_e.rename(columns={c: 'Escandallo'}, inplace=True)
-            elif c_up in ['CODIGO PRINCIPAL', 'CÓDIGO PRINCIPAL']: df_e.rename(columns={c: 'Codigo_Principal'}, inplace=True)
-            
-        if 'Código' in df_e.columns and 'Escandallo' in df_e.columns and 'Codigo_Principal' in df_e.columns:
-            df_e['Código'] = df_e['Código'].astype(str).str.replace('.0', '', regex=False).str.strip()
-            df_e['Codigo_Principal'] = df_e['Codigo_Principal'].astype(str).str.replace('.0', '', regex=False).str.strip()
-            mapa_equiv = {}
-            for _, row in df_e.iterrows():
-                try:
-                    val_esc = float(row['Escandallo'])
-                    val_esc = int(val_esc) if val_esc.is_integer() else val_esc
-                except: val_esc = row['Escandallo']
-                mapa_equiv[row['Código']] = (val_esc, row['Codigo_Principal'])
-            return mapa_equiv, None
-        return {}, "Faltan columnas clave (Código, Escandallo, Codigo Principal) en Equivalencias."
-    except Exception as e:
-        return {}, f"Error cargando equivalencias: {e}"
-
-@st.cache_data(ttl=600)
-def load_initial_data():
-    try: 
-        df_raw = load_sheet_df(BASE_URL)
-        if df_raw.empty: return None, "La base de datos principal está vacía."
-    except Exception as e: 
-        return None, f"Error conectando a Base de Datos: {e}"
-        
-    df_raw.columns = df_raw.columns.str.strip()
-    rename_map = {'Coste congelación': 'Coste_congelación', 'Coste congelacion': 'Coste_congelación', 'Coste despiece': 'Coste_despiece', 'Precio escandallo': 'Precio_escandallo', 'TIPO': 'Tipo', 'tipo': 'Tipo', 'Fecha': 'Fecha', 'fecha': 'Fecha', 'Cliente': 'Cliente'}
-    df_raw.rename(columns={k:v for k,v in rename_map.items() if k in df_raw.columns}, inplace=True)
-    if 'Tipo' not in df_raw.columns: df_raw['Tipo'] = ""
-    for col in ['Cliente', 'Fecha', 'Familia', 'Formato']:
-        if col not in df_raw.columns: df_raw[col] = ""
-        else: df_raw[col] = df_raw[col].fillna("")
-    if 'Código' in df_raw.columns: df_raw['Código'] = df_raw['Código'].astype(str).str.replace('.0', '', regex=False)
-    cols_num = ['Cantidad(kg)', 'Coste_despiece', 'Coste_congelación', 'Precio EXW']
-    for col in cols_num:
-        if col in df_raw.columns: df_raw[col] = df_raw[col].apply(clean_european_number)
-        else: df_raw[col] = 0.0
-    if 'Fecha' in df_raw.columns:
-        df_raw['Fecha_dt'] = pd.to_datetime(df_raw['Fecha'], dayfirst=True, errors='coerce')
-        if df_raw['Fecha_dt'].notna().any():
-            max_fechas = df_raw.groupby('Escandallo')['Fecha_dt'].transform('max')
-            mask = (df_raw['Fecha_dt'] == max_fechas) | (df_raw['Fecha_dt'].isna())
-            df_raw = df_raw[mask].copy()
-            df_raw.drop(columns=['Fecha_dt'], inplace=True)
-    df_calc = recalcular_dataframe(df_raw)
-    return df_calc, None
-
-@st.cache_data(ttl=600)
-def load_sales_data():
-    try:
-        df_v = load_sheet_df(VENTAS_URL)
-        if df_v.empty: return pd.DataFrame(), None
-        
-        df_v.columns = df_v.columns.str.strip()
-        for c in df_v.columns:
-            c_up = c.upper()
-            if c_up in ['CODIGO', 'CÓDIGO']: df_v.rename(columns={c: 'Código'}, inplace=True)
-            elif c_up == 'CLIENTE': df_v.rename(columns={c: 'Cliente'}, inplace=True)
-            elif c_up == 'NOMBRE': df_v.rename(columns={c: 'Nombre'}, inplace=True)
-            elif c_up == 'KILOS': df_v.rename(columns={c: 'Kilos'}, inplace=True)
-            elif c_up == 'PRECIO EXW': df_v.rename(columns={c: 'Precio EXW'}, inplace=True)
-        for col in ['Kilos', 'Precio EXW']:
-            if col in df_v.columns: df_v[col] = df_v[col].apply(clean_european_number)
-        if 'Código' in df_v.columns: df_v['Código'] = df_v['Código'].astype(str).str.replace('.0', '', regex=False)
-        return df_v, None
+@st.cache_resource
+def memoria_fuentes():
+    """Última carga de cada Spreadsheet con su revisión y Spreadsheets abiertos en la última consulta de revisiones,
+    compartidos por todas las sesiones del proceso."""
+    return {'spreadsheets': {}, 'abiertas': {}, 'lock': threading.Lock()}
+
+@etapa('revisiones_fuentes', cache=st.cache_data(ttl=600))
+def revisiones_fuentes():
+    return revisiones_spreadsheets(FUENTES_SHEETS, get_gspread_client(), memoria_fuentes()['abiertas'])
+
+def revision_fuente(nombre):
+    return revisiones_fuentes()[id_spreadsheet(FUENTES_SHEETS[nombre][0])]
+
+@etapa('load_sheets_data', cache=st.cache_data(ttl=600, max_entries=2))
+def load_sheets_data(revisiones):
+    """Las tres fuentes para esas revisiones; cada load_*_data toma de aquí su parte."""
+    memoria = memoria_fuentes()
+    with memoria['lock']:
+        return recargar_fuentes(FUENTES_SHEETS, get_gspread_client(), revisiones, memoria['spreadsheets'], memoria['abiertas'])
+
+@etapa('load_equiv_data', cache=st.cache_data(ttl=600, max_entries=2))
+def load_equiv_data(revision):
+    try: return preparar_equivalencias(*load_sheets_data(revisiones_fuentes())['equivalencias'])
+    except Exception as e: return {}, f"Error cargando equivalencias: {e}"
+
+@etapa('load_initial_data', cache=st.cache_data(ttl=600, max_entries=2))
+def load_initial_data(revision):
+    try: return preparar_base(*load_sheets_data(revisiones_fuentes())['base'])
+    except Exception as e: return None, None, f"Error conectando a Base de Datos: {e}"
+
+@etapa('load_sales_data', cache=st.cache_data(ttl=600, max_entries=2))
+def load_sales_data(revision):
+    try: return preparar_ventas(*load_sheets_data(revisiones_fuentes())['ventas'])
     except Exception as e: return None, f"Error cargando ventas: {e}"
 
+# --- RESULTADOS COMPARTIDOS ENTRE SESIONES ---
+MAX_VERSIONES_COMPARTIDAS = 2
+MAX_CADENAS_COMPARTIDAS = 16  # Cascadas de cadenas de clientes guardadas por versión (LRU)
+
+@st.cache_resource
+def registro_resultados():
+    """Resultados por versión de datos, compartidos en solo lectura por todas las sesiones del proceso."""
+    return {'versiones': OrderedDict(), 'lock': threading.Lock()}
+
+def publicar_resultados(version, calcular):
+    """Resultados de `version`, calculados una sola vez por proceso; se guardan las últimas versiones.
+    calcular recibe los resultados publicados más recientes (o None) para poder partir de ellos."""
+    registro = registro_resultados()
+    with registro['lock']:
+        if version not in registro['versiones']:
+            registro['versiones'][version] = calcular(next(reversed(registro['versiones'].values()), None))
+            while len(registro['versiones']) > MAX_VERSIONES_COMPARTIDAS: registro['versiones'].popitem(last=False)
+        return registro['versiones'][version]
+
+# --- MEDICIÓN DE RENDIMIENTO ---
+# Cada rerun abre una medición (ver motor.py) que recoge las etapas de carga, cálculo y dibujado de las pestañas;
+# la sesión guarda las últimas y el panel de administración (?admin=1) las muestra y exporta.
+MAX_EJECUCIONES_MEDIDAS = 20
+
+def fragmento_medido(nombre):
+    """Un rerun solo del fragmento no pasa por el inicio del script: abre su propia medición."""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            if medicion_actual() is not None: return funcion(*args, **kwargs)
+            st.session_state.historial_rendimiento.append(iniciar_medicion(f"fragmento {nombre}"))
+            try:
+                with medir_etapa(nombre): return funcion(*args, **kwargs)
+            finally: cerrar_medicion()
+        return envoltura
+    return decorador
+
+def panel_rendimiento():
+    historial = list(st.session_state.historial_rendimiento)
+    with st.expander("⏱️ Rendimiento (admin)"):
+        df_med = tabla_mediciones(historial)
+        st.download_button("⬇️ Exportar CSV", df_med.to_csv(index=False).encode('utf-8'), "rendimiento.csv", "text/csv")
+        df_ejec = pd.DataFrame([{'EJECUCIÓN': m['id'], 'TIPO': m['etiqueta'], 'INICIO': m['inicio'], 'SEGUNDOS': m['segundos'], 'ETAPAS': len(m['etapas'])} for m in reversed(historial)])
+        st.dataframe(df_ejec, hide_index=True, use_container_width=True)
+        if historial:
+            sel = st.selectbox("Ejecución", df_ejec['EJECUCIÓN'].tolist(), key="rendimiento_ejecucion")
+            df_sel = df_med[df_med['ejecucion'] == sel].sort_values('desde_inicio')
+            df_sel = df_sel.assign(etapa=["· " * n + e for n, e in zip(df_sel['nivel'], df_sel['etapa'])])
+            st.dataframe(df_sel[['etapa', 'desde_inicio', 'segundos', 'filas_entrada', 'filas_salida', 'cache']], hide_index=True, use_container_width=True)
+        st.markdown("**Acumulado del proceso**")
+        df_cont = pd.DataFrame.from_dict({k: dict(v) for k, v in list(CONTADORES_ETAPAS.items())}, orient='index')
+        st.dataframe(df_cont.sort_values('segundos', ascending=False) if not df_cont.empty else df_cont, use_container_width=True)
+
+st.session_state.setdefault('historial_rendimiento', deque(maxlen=MAX_EJECUCIONES_MEDIDAS)).append(iniciar_medicion("ejecución completa"))
+
 # --- CARGA Y ESTADO ---
-if 'df_global_base' not in st.session_state:
-    data, err = load_initial_data()
+# Lo derivado de los datos vive una sola vez por proceso (ver publicar_resultados); la sesión solo
+# guarda su versión de datos y, si ha editado el simulador, sus precios manuales y su copia del simulador.
+# Al actualizar, los precios manuales se vuelven a aplicar sobre el simulador de la versión nueva.
+refrescar_datos = st.session_state.pop('refrescar_datos', False)
+resultados = None if refrescar_datos else registro_resultados()['versiones'].get(st.session_state.get('version_datos'))
+if resultados is None:
+    data, indice_recetas, err = load_initial_data(revision_fuente('base'))
     if err: st.error(err); st.stop()
-    st.session_state.df_global_base = data.copy()
-if 'grid_key' not in st.session_state: st.session_state.grid_key = 0
-
-# --- PRE-PROCESAMIENTO Y GENERACIÓN DEL SIMULADOR ---
-if 'df_proc_global' not in st.session_state or 'df_simulador' not in st.session_state:
-    df_ventas, err_v = load_sales_data()
-    st.session_state.err_v = err_v 
-    mapa_equiv, err_e = load_equiv_data()
+    df_ventas, err_v = load_sales_data(revision_fuente('ventas'))
+    mapa_equiv, err_e = load_equiv_data(revision_fuente('equivalencias'))
     if err_e: st.warning(err_e)
-    st.session_state.mapa_equivalencias = mapa_equiv
-    
-    global_avg_base = {}
-    client_avg_base = {}
-    bench_familia = {}
-    mapa_escandallos = {}
-    esc_to_princ = {}
+    calidad = st.session_state.setdefault('calidad_datos', {})
+    calidad['Base de Datos'] = data.attrs.get('fallos_numericos', {})
+    if df_ventas is not None: calidad['Ventas'] = df_ventas.attrs.get('fallos_numericos', {})
     
-    if not err_v and df_ventas is not None and not df_ventas.empty:
-        df_ventas = df_ventas[~df_ventas['Cliente'].str.contains('Entradas a Congelar', case=False, na=False)]
-        df_esc_completo = st.session_state.df_global_base.copy() 
-        
-        if 'Código' in df_ventas.columns:
-            df_princ = df_esc_completo[df_esc_completo['Tipo'].str.contains('Principal', case=False, na=False)] if 'Tipo' in df_esc_completo.columns else pd.DataFrame()
-            if not df_princ.empty:
-                df_princ_unique = df_princ.drop_duplicates(subset=['Código'], keep='first')
-                mapa_escandallos = dict(zip(df_princ_unique['Código'].astype(str), df_princ_unique['Escandallo']))
-                df_princ_per_esc = df_princ.drop_duplicates(subset=['Escandallo'], keep='first')
-                esc_to_princ = dict(zip(df_princ_per_esc['Escandallo'], df_princ_per_esc['Código'].astype(str)))
-                
-                df_proc_global, global_avg_base, client_avg_base = procesar_ventas_cascada(df_ventas, df_esc_completo, mapa_escandallos, mapa_equiv, esc_to_princ)
-                
-                if not df_proc_global.empty:
-                    for fam in df_proc_global['Familia'].unique():
-                        if fam != 'Sin clasificar':
-                            df_f = df_proc_global[df_proc_global['Familia'] == fam]
-                            tk, tr = df_f['Kilos_CP'].sum(), df_f['Precio_CP_Total'].sum()
-                            bench_familia[fam] = tr / tk if tk > 0 else 0.0
-                            
-                st.session_state.df_proc_global = df_proc_global
-                st.session_state.global_avg_base = global_avg_base
-                st.session_state.client_avg_base = client_avg_base
-                st.session_state.bench_familia = bench_familia
-                st.session_state.mapa_escandallos = mapa_escandallos
-                st.session_state.esc_to_princ = esc_to_princ
-                st.session_state.df_ventas_crudas = df_ventas
-                
-                df_sim = st.session_state.df_global_base.copy()
-                df_sim['ORIGEN_PRECIO'] = 'Teórico'
-                for idx, row in df_sim.iterrows():
-                    cod = str(row['Código'])
-                    if cod in global_avg_base:
-                        df_sim.at[idx, 'Precio EXW'] = float(global_avg_base[cod])
-                        df_sim.at[idx, 'ORIGEN_PRECIO'] = 'Venta Real'
-                df_sim = recalcular_dataframe(df_sim)
-                st.session_state.df_simulador = df_sim
-                
-    else: 
-        st.session_state.df_proc_global = pd.DataFrame()
-        st.session_state.df_simulador = st.session_state.df_global_base.copy()
+    version_datos = huella_fuentes(data, df_ventas, mapa_equiv)
+    resultados = publicar_resultados(version_datos, lambda previo: preprocesar_fuentes(data, indice_recetas, df_ventas, err_v, mapa_equiv, previo))
+    if version_datos != st.session_state.get('version_datos'):
+        if refrescar_datos:
+            huellas_previas = st.session_state.get('huellas_fuentes', {})
+            cambiadas = [NOMBRES_FUENTES[n] for n, h in resultados['huellas'].items() if huellas_previas.get(n) != h]
+            st.toast("Datos actualizados: " + ", ".join(cambiadas), icon="🔄")
+        st.session_state.version_datos = version_datos
+        st.session_state.huellas_fuentes = resultados['huellas']
+        st.session_state.pop('df_simulador', None)
+        st.session_state.pop('version_simulador', None)
+        st.session_state.pop('ranking_simulador', None)
+        st.session_state.grid_key = st.session_state.get('grid_key', 0) + 1
+        if st.session_state.get('precios_manuales') and 'ORIGEN_PRECIO' in resultados['df_simulador'].columns:
+            st.session_state.df_simulador = construir_simulador(resultados['df_global_base'], resultados['global_avg_base'], st.session_state.precios_manuales)
+            st.session_state.version_simulador = uuid.uuid4().hex
+    elif refrescar_datos: st.toast("Las fuentes no han cambiado desde la última carga.", icon="✅")
+if 'grid_key' not in st.session_state: st.session_state.grid_key = 0
 
 # RECUPERACIÓN DE VARIABLES
-df_proc_global = st.session_state.get('df_proc_global', pd.DataFrame())
-df_simulador = st.session_state.get('df_simulador', st.session_state.get('df_global_base', pd.DataFrame()).copy())
-df_global_base = st.session_state.get('df_global_base', pd.DataFrame())
-global_avg_base = st.session_state.get('global_avg_base', {})
-client_avg_base = st.session_state.get('client_avg_base', {})
-bench_familia = st.session_state.get('bench_familia', {})
-mapa_escandallos = st.session_state.get('mapa_escandallos', {})
-esc_to_princ = st.session_state.get('esc_to_princ', {})
-mapa_equivalencias = st.session_state.get('mapa_equivalencias', {})
-df_ventas = st.session_state.get('df_ventas_crudas', pd.DataFrame())
-err_v = st.session_state.get('err_v', None)
-
-# --- ETIQUETAS FILTROS GLOBALES ---
-if not df_global_base.empty:
-    if 'Tipo' in df_global_base.columns and df_global_base['Tipo'].str.contains('Principal', case=False, na=False).any():
-        df_principales = df_global_base[df_global_base['Tipo'].str.contains('Principal', case=False, na=False)][['Escandallo', 'Código', 'Nombre']]
-    else:
-        df_principales = df_global_base.groupby('Escandallo')[['Escandallo', 'Código', 'Nombre']].first().reset_index()
-    
-    df_principales = df_principales.drop_duplicates(subset=['Escandallo'])
-    df_principales['Texto_Escandallo'] = df_principales['Escandallo'].astype(str) + " | " + df_principales['Código'].astype(str) + " | " + df_principales['Nombre']
-    mapa_etiquetas = dict(zip(df_principales['Escandallo'], df_principales['Texto_Escandallo']))
-
-    if 'Escandallo' in df_global_base.columns: df_global_base['Filtro_Display'] = df_global_base['Escandallo'].map(mapa_etiquetas)
-    if 'Escandallo' in df_simulador.columns: df_simulador['Filtro_Display'] = df_simulador['Escandallo'].map(mapa_etiquetas)
+df_proc_global = resultados['df_proc_global']
+df_global_base = resultados['df_global_base']
+df_simulador = st.session_state.get('df_simulador', resultados['df_simulador'])
+version_simulador = st.session_state.get('version_simulador', resultados['version_simulador'])
+global_avg_base = resultados['global_avg_base']
+precios_base = resultados['precios_base']
+bench_familia = resultados['bench_familia']
+mapa_escandallos = resultados['mapa_escandallos']
+esc_to_princ = resultados['esc_to_princ']
+filtros_base = resultados['filtros_base']
+filtros_ventas = resultados['filtros_ventas']
+cubo_ventas = resultados['cubo']
+indice_recetas = resultados['indice_recetas']
+mapa_equivalencias = resultados['mapa_equivalencias']
+df_ventas = resultados['df_ventas_crudas']
+err_v = resultados['err_v']
 
 # --- FUNCIONES DE ESTILO DE TABLA ---
 def zebra_base(row):
@@ -425,6 +268,64 @@ def zebra_base(row):
     if row.name % 2 == 0: return [base_style + 'background-color: #F8F9FA; color: #1E293B'] * len(row)
     else: return [base_style + 'background-color: #DBEAFE; color: #0F172A'] * len(row)
 
+# Tablas de hasta MAX_FILAS_STYLER filas se pintan con Styler (zebra y formato por celda); las más grandes con las
+# columnas numéricas ya formateadas en bloque y st.column_config, sin una llamada Python por fila o celda.
+MAX_FILAS_STYLER = 400
+
+@etapa('mostrar_tabla')
+def mostrar_tabla(df, formatos, estilo_filas=None, estilos_celda=None, column_config=None, **kwargs):
+    """st.dataframe con formato europeo. formatos: {columna: (decimales, sufijo[, con_signo])};
+    estilos_celda: {columna: función valor -> css}. Devuelve lo que devuelva st.dataframe (eventos de selección)."""
+    column_config = dict(column_config or {})
+    if len(df) <= MAX_FILAS_STYLER:
+        styler = df.style.apply(estilo_filas or zebra_base, axis=1)
+        for col, estilo in (estilos_celda or {}).items():
+            try: styler = styler.map(estilo, subset=[col])
+            except AttributeError: styler = styler.applymap(estilo, subset=[col])
+        return st.dataframe(styler.format({col: formateador_europeo(*f) for col, f in formatos.items()}), column_config=column_config, **kwargs)
+    df_disp = df.copy()
+    for col, f in formatos.items():
+        df_disp[col] = formato_europeo_columna(df[col], *f)
+        column_config.setdefault(col, st.column_config.TextColumn(col))
+    return st.dataframe(df_disp, column_config=column_config, **kwargs)
+
+# Vista paginada: orden y corte se hacen en el servidor y al navegador solo viaja la página visible.
+TAMANOS_PAGINA = [25, 50, 100, 250]
+
+def tabla_paginada(df, clave, formatos, orden_defecto=None, **kwargs):
+    """mostrar_tabla por páginas con orden, tamaño de página y cursor propios (widgets con prefijo `clave`).
+    df debe tener índice 0..n-1; devuelve las posiciones en df de las filas seleccionadas en la página."""
+    columnas = list(df.columns)
+    c_orden, c_dir, c_tam, c_pag = st.columns([3, 1, 1, 2])
+    col_orden = c_orden.selectbox("Ordenar por", columnas, index=columnas.index(orden_defecto[0]) if orden_defecto else 0, key=f"{clave}_orden")
+    descendente = c_dir.checkbox("Descendente", value=bool(orden_defecto and not orden_defecto[1]), key=f"{clave}_desc")
+    tam_pagina = c_tam.selectbox("Filas", TAMANOS_PAGINA, key=f"{clave}_tam")
+    n_paginas = max(1, -(-len(df) // tam_pagina))
+    if st.session_state.get(f"{clave}_pag", 1) > n_paginas: st.session_state[f"{clave}_pag"] = 1
+    pagina = c_pag.number_input(f"Página (de {n_paginas})", min_value=1, max_value=n_paginas, step=1, key=f"{clave}_pag")
+
+    inicio = (pagina - 1) * tam_pagina
+    df_pagina = df.sort_values(col_orden, ascending=not descendente, kind='stable').iloc[inicio:inicio + tam_pagina]
+    st.caption(f"Mostrando {inicio + 1 if len(df) else 0} - {inicio + len(df_pagina)} de {len(df)}")
+    # La clave de la tabla cambia con la página y el orden para que la selección no se arrastre a otras filas
+    evento = mostrar_tabla(df_pagina.reset_index(drop=True), formatos, key=f"{clave}_tabla_{col_orden}_{descendente}_{tam_pagina}_{pagina}", **kwargs)
+    return [int(df_pagina.index[i]) for i in evento.selection.rows] if evento is not None and hasattr(evento, 'selection') else []
+
+@st.cache_resource
+def cache_trazabilidad():
+    """Caché LRU de desgloses compartida por todas las sesiones (las claves llevan la versión de precios)."""
+    return nueva_cache_lru()
+
+def mostrar_desglose(df_breakdown, cod_resaltado):
+    def style_breakdown(row):
+        if row['CÓDIGO'] == cod_resaltado: return ['background-color: #1E3A8A; font-weight: bold; color: #FFFFFF; font-size: 16px;'] * len(row)
+        return zebra_base(row)
+        
+    mostrar_tabla(df_breakdown, {
+        '% RENDIMIENTO': (2, " %"), 'PRECIO APLICADO': (3, " €"), 'COSTE DESPIECE': (3, " €"),
+        'COSTE CONG.': (3, " €"), 'APORTACIÓN A CP': (4, " €/kg")
+    }, estilo_filas=style_breakdown, use_container_width=True, hide_index=True)
+
 def style_rows_t1(row):
     tipo_val = row.get('TIPO', '') 
     if tipo_val == 'TotalRow' or tipo_val == 'TOTALROW': return ['background-color: #064E3B; font-weight: bold; color: #FFFFFF; font-size: 16px;'] * len(row)
@@ -435,28 +336,28 @@ def style_rows_t1(row):
 c_title, c_btn = st.columns([4, 1])
 c_title.title("📊 Panel de Escandallos y Rentabilidad")
 if c_btn.button("🔄 Actualizar todos los datos", type="primary", use_container_width=True):
-    st.cache_data.clear()
-    for key in list(st.session_state.keys()):
-        if key != "password_correct": 
-            del st.session_state[key]
+    # Solo se vuelven a consultar las revisiones: se recargan las fuentes que cambiaron y la sesión (filtros, precios manuales) se conserva
+    revisiones_fuentes.clear()
+    st.session_state.refrescar_datos = True
     st.rerun()
 
+calidad_datos = {origen: fallos for origen, fallos in st.session_state.get('calidad_datos', {}).items() if fallos}
+if calidad_datos:
+    with st.expander("⚠️ Calidad de datos: celdas numéricas no reconocidas (se han tomado como 0)"):
+        for origen, fallos in calidad_datos.items():
+            st.markdown(f"**{origen}:** " + ", ".join(f"{col} ({n} celdas)" for col, n in fallos.items()))
+
 tab1, tab2, tab3 = st.tabs(["📋 DETALLE TÉCNICO (TEÓRICO)", "🏆 RANKING & SIMULACIÓN", "📈 PANEL EJECUTIVO (VENTAS REALES)"])
 
 # --- PESTAÑA 1: DETALLE TÉCNICO PURAMENTE TEÓRICO ---
-with tab1:
+with tab1, medir_etapa("render_pestaña_1"):
     with st.expander("🎛️ Panel de Filtros Teóricos", expanded=True):
         col_t1_1, col_t1_2, col_t1_3 = st.columns(3)
-        familias_t1 = sorted(df_global_base['Familia'].unique()) if not df_global_base.empty and 'Familia' in df_global_base.columns else []
-        sel_familia_t1 = col_t1_1.multiselect("📂 Familia", options=familias_t1, key="f_fam_t1")
-        formatos_t1 = sorted(df_global_base['Formato'].unique()) if not df_global_base.empty and 'Formato' in df_global_base.columns else []
-        sel_formato_t1 = col_t1_2.multiselect("📦 Formato", options=formatos_t1, key="f_for_t1")
-        mask_t1 = pd.Series(True, index=df_global_base.index)
-        if sel_familia_t1: mask_t1 &= df_global_base['Familia'].isin(sel_familia_t1)
-        if sel_formato_t1: mask_t1 &= df_global_base['Formato'].isin(sel_formato_t1)
-        opciones_escandallo_t1 = sorted(df_global_base[mask_t1]['Filtro_Display'].dropna().unique()) if not df_global_base.empty and 'Filtro_Display' in df_global_base.columns else []
-        sel_escandallo_t1 = col_t1_3.multiselect("🏷️ Escandallo", options=opciones_escandallo_t1, key="f_esc_t1")
-        if sel_escandallo_t1 and 'Filtro_Display' in df_global_base.columns: mask_t1 &= df_global_base['Filtro_Display'].isin(sel_escandallo_t1)
+        sel_familia_t1 = col_t1_1.multiselect("📂 Familia", options=opciones_filtro(filtros_base, 'Familia'), key="f_fam_t1")
+        sel_formato_t1 = col_t1_2.multiselect("📦 Formato", options=opciones_filtro(filtros_base, 'Formato'), key="f_for_t1")
+        mask_t1 = mascara_filtros(filtros_base, {'Familia': sel_familia_t1, 'Formato': sel_formato_t1})
+        sel_escandallo_t1 = col_t1_3.multiselect("🏷️ Escandallo", options=opciones_filtro(filtros_base, 'Filtro_Display', mask_t1), key="f_esc_t1")
+        mask_t1 = mascara_filtros(filtros_base, {'Filtro_Display': sel_escandallo_t1}, mask_t1)
         df_t1_filtrado = df_global_base[mask_t1].copy() if not df_global_base.empty else pd.DataFrame()
 
     st.divider()
@@ -509,35 +410,28 @@ with tab1:
             df_fin.rename(columns={'Precio_escandallo_Calculado': 'Precio a CP Teórico'}, inplace=True)
             df_fin.columns = [str(c).upper() for c in df_fin.columns]
 
-            styled_df = df_fin.style.apply(style_rows_t1, axis=1).format({
-                '%_CALCULADO': lambda x: formato_europeo(x, 2, " %"),
-                'PRECIO EXW': lambda x: formato_europeo(x, 3, " €"),
-                'PRECIO A CP TEÓRICO': lambda x: formato_europeo(x, 4, " €")
-            })
-            st.dataframe(styled_df, column_config={"TIPO": None}, use_container_width=True, hide_index=True)
+            formatos_t1 = {'%_CALCULADO': (2, " %"), 'PRECIO EXW': (3, " €"), 'PRECIO A CP TEÓRICO': (4, " €")}
+            mostrar_tabla(df_fin, {c: f for c, f in formatos_t1.items() if c in df_fin.columns}, estilo_filas=style_rows_t1,
+                          column_config={"TIPO": None}, use_container_width=True, hide_index=True)
             st.divider()
 
 # --- PESTAÑA 2: RANKING Y SIMULACIÓN (CON GEMELO DIGITAL) ---
-with tab2:
+with tab2, medir_etapa("render_pestaña_2"):
     st.subheader("🏆 Simulador Híbrido de Precios (Base Mercado Real)")
     st.info("💡 Este simulador arranca usando los **Precios Reales Medios** de tus ventas. Haz doble clic en los números azules de la columna **PRECIO EXW ✏️** para sobrescribirlos. Marca la casilla **🔍 VER** para desplegar el escandallo.")
 
     with st.expander("🎛️ Panel de Filtros del Simulador", expanded=True):
         col_t2_1, col_t2_2, col_t2_3, col_t2_4 = st.columns(4)
         
-        familias_t2_sim = sorted(df_simulador['Familia'].unique()) if not df_simulador.empty and 'Familia' in df_simulador.columns else []
-        sel_familia_t2_sim = col_t2_1.multiselect("📂 Familia", options=familias_t2_sim, key="f_fam_t2_sim")
+        # El simulador tiene las mismas filas que la base, así que comparte su índice de filtros
+        sel_familia_t2_sim = col_t2_1.multiselect("📂 Familia", options=opciones_filtro(filtros_base, 'Familia'), key="f_fam_t2_sim")
         
-        formatos_t2_sim = sorted(df_simulador['Formato'].unique()) if not df_simulador.empty and 'Formato' in df_simulador.columns else []
-        sel_formato_t2_sim = col_t2_2.multiselect("📦 Formato", options=formatos_t2_sim, key="f_for_t2_sim")
+        sel_formato_t2_sim = col_t2_2.multiselect("📦 Formato", options=opciones_filtro(filtros_base, 'Formato'), key="f_for_t2_sim")
         
-        mask_t2_sim = pd.Series(True, index=df_simulador.index) if not df_simulador.empty else pd.Series(dtype=bool)
-        if sel_familia_t2_sim: mask_t2_sim &= df_simulador['Familia'].isin(sel_familia_t2_sim)
-        if sel_formato_t2_sim: mask_t2_sim &= df_simulador['Formato'].isin(sel_formato_t2_sim)
+        mask_t2_sim = mascara_filtros(filtros_base, {'Familia': sel_familia_t2_sim, 'Formato': sel_formato_t2_sim})
         
-        opciones_escandallo_t2_sim = sorted(df_simulador[mask_t2_sim]['Filtro_Display'].dropna().unique()) if not df_simulador.empty and 'Filtro_Display' in df_simulador.columns else []
-        sel_escandallo_t2_sim = col_t2_3.multiselect("🏷️ Escandallo", options=opciones_escandallo_t2_sim, key="f_esc_t2_sim")
-        if sel_escandallo_t2_sim and 'Filtro_Display' in df_simulador.columns: mask_t2_sim &= df_simulador['Filtro_Display'].isin(sel_escandallo_t2_sim)
+        sel_escandallo_t2_sim = col_t2_3.multiselect("🏷️ Escandallo", options=opciones_filtro(filtros_base, 'Filtro_Display', mask_t2_sim), key="f_esc_t2_sim")
+        mask_t2_sim = mascara_filtros(filtros_base, {'Filtro_Display': sel_escandallo_t2_sim}, mask_t2_sim)
         
         if not df_simulador.empty and 'ORIGEN_PRECIO' in df_simulador.columns:
             try:
@@ -554,22 +448,12 @@ with tab2:
     if df_sim_filtrado.empty:
         st.warning("No hay datos para los filtros seleccionados.")
     else:
-        df_rank = df_sim_filtrado.groupby('Escandallo')['Precio_escandallo_Calculado'].sum().reset_index()
-        cols_info = ['Escandallo', 'Código', 'Nombre', '%_Calculado', 'Precio EXW', 'ORIGEN_PRECIO']
-        cols_info = [c for c in cols_info if c in df_sim_filtrado.columns]
-
-        try:
-            if 'Tipo' in df_sim_filtrado.columns and df_sim_filtrado['Tipo'].str.contains('Principal', case=False, na=False).any():
-                df_pr = df_sim_filtrado[df_sim_filtrado['Tipo'].str.contains('Principal', case=False, na=False)][cols_info]
-            else: df_pr = df_sim_filtrado.groupby('Escandallo')[cols_info].first().reset_index()
-        except: df_pr = df_sim_filtrado.groupby('Escandallo')[cols_info].first().reset_index()
-
-        df_suma = df_pr.groupby('Escandallo')['%_Calculado'].sum().reset_index()
-        cols_desc = [c for c in cols_info if c != '%_Calculado' and c != 'Escandallo']
-        df_desc = df_pr.groupby('Escandallo')[cols_desc].first().reset_index()
-
-        df_final = pd.merge(df_rank, df_suma, on='Escandallo')
-        df_final = pd.merge(df_final, df_desc, on='Escandallo').sort_values('Precio_escandallo_Calculado', ascending=False).reset_index(drop=True)
+        # El ranking compartido viene calculado de preprocesar_fuentes; solo la copia de la sesión se rehace aquí.
+        if 'df_simulador' in st.session_state and st.session_state.get('ranking_simulador') is None:
+            st.session_state.ranking_simulador = construir_ranking_simulador(df_simulador, indice_recetas)
+        ranking_sim = st.session_state.ranking_simulador if 'df_simulador' in st.session_state else resultados['ranking_simulador']
+        df_final = ranking_sim[ranking_sim.index.isin(df_sim_filtrado['Escandallo'].unique())].reset_index()
+        df_final = df_final.sort_values('Precio_escandallo_Calculado', ascending=False).reset_index(drop=True)
         
         if sel_origen_t2_sim and 'ORIGEN_PRECIO' in df_final.columns:
             df_final = df_final[df_final['ORIGEN_PRECIO'].isin(sel_origen_t2_sim)].reset_index(drop=True)
@@ -586,12 +470,12 @@ with tab2:
             df_ed = df_final[cols_final].copy()
             
             df_ed_display = df_ed.copy()
-            df_ed_display['%/CP'] = df_ed['%/CP'].apply(lambda x: formato_europeo(x, 2, " %"))
-            df_ed_display['Precio_escandallo_Calculado'] = df_ed['Precio_escandallo_Calculado'].apply(lambda x: formato_europeo(x, 4, " €"))
+            df_ed_display['%/CP'] = formato_europeo_columna(df_ed['%/CP'], 2, " %")
+            df_ed_display['Precio_escandallo_Calculado'] = formato_europeo_columna(df_ed['Precio_escandallo_Calculado'], 4, " €")
             df_ed_display.rename(columns={'Precio_escandallo_Calculado': 'Precio a CP Simulado', 'ORIGEN_PRECIO': 'Origen'}, inplace=True)
             df_ed_display.columns = [str(c).upper() for c in df_ed_display.columns]
 
-            styled_ed_display = df_ed_display.style.apply(zebra_base, axis=1)
+            styled_ed_display = df_ed_display.style.apply(zebra_base, axis=1) if len(df_ed_display) <= MAX_FILAS_STYLER else df_ed_display
             
             edited_df = st.data_editor(
                 styled_ed_display,
@@ -619,17 +503,13 @@ with tab2:
                 if diferencias.abs().sum() > 0.0001:
                      st.toast("⚡ Guardando simulación...", icon="📊")
                      cambios = edited_df[diferencias.abs() > 0.0001]
-                     for i, r in cambios.iterrows():
-                        esc_val = r.get('ESCANDALLO')
-                        cod_val = r.get('CÓDIGO')
-                        precio_val = r.get('PRECIO EXW')
-                        
-                        mask = (st.session_state.df_simulador['Escandallo'] == esc_val) & (st.session_state.df_simulador['Código'].astype(str) == str(cod_val))
-                        st.session_state.df_simulador.loc[mask, 'Precio EXW'] = float(precio_val)
-                        if 'ORIGEN_PRECIO' in st.session_state.df_simulador.columns:
-                            st.session_state.df_simulador.loc[mask, 'ORIGEN_PRECIO'] = 'Simulado Manual'
-                            
-                     st.session_state.df_simulador = recalcular_dataframe(st.session_state.df_simulador)
+                     if 'df_simulador' not in st.session_state:
+                         st.session_state.df_simulador = df_simulador.copy()
+                         st.session_state.ranking_simulador = ranking_sim.copy()
+                     nuevos_precios = editar_simulador(st.session_state.df_simulador, st.session_state.ranking_simulador, indice_recetas,
+                                                       zip(cambios['ESCANDALLO'], cambios['CÓDIGO'], cambios['PRECIO EXW']))
+                     st.session_state.setdefault('precios_manuales', {}).update(nuevos_precios)
+                     st.session_state.version_simulador = uuid.uuid4().hex
                      st.session_state.grid_key += 1 
                      st.rerun()
             
@@ -642,37 +522,9 @@ with tab2:
                     
                     st.markdown(f"###### 🔎 Trazabilidad del Escandallo: {sel_cod} - {sel_nombre}")
                     
-                    df_bloque_esc = st.session_state.df_simulador[st.session_state.df_simulador['Escandallo'] == sel_esc]
-                    breakdown_data = []
-                    for _, item in df_bloque_esc.iterrows():
-                        cod_item = str(item.get('Código', '')).strip()
-                        pct_item = float(item.get('%_Calculado', 0.0))
-                        coste_cong = float(item.get('Coste_congelación', 0.0))
-                        coste_desp = float(item.get('Coste_despiece', 0.0))
-                        precio_aplicado = float(item.get('Precio EXW', 0.0))
-                        origen = str(item.get('ORIGEN_PRECIO', 'Teórico'))
-                        
-                        linea_cp = (precio_aplicado - coste_cong - coste_desp) * pct_item
-                        breakdown_data.append({
-                            'Código': cod_item, 'Artículo': item.get('Nombre', ''), '% Rendimiento': pct_item * 100, 
-                            'Origen Precio': origen, 'Precio Aplicado': precio_aplicado,
-                            'Coste Despiece': coste_desp, 'Coste Cong.': coste_cong, 'Aportación a CP': linea_cp
-                        })
-                        
-                    df_breakdown = pd.DataFrame(breakdown_data).reset_index(drop=True)
-                    df_breakdown.columns = [str(c).upper() for c in df_breakdown.columns]
-
-                    def style_breakdown(row):
-                        if row['CÓDIGO'] == str(sel_cod): return ['background-color: #1E3A8A; font-weight: bold; color: #FFFFFF; font-size: 16px;'] * len(row)
-                        return zebra_base(row)
-                        
-                    st.dataframe(
-                        df_breakdown.style.apply(style_breakdown, axis=1).format({
-                            '% RENDIMIENTO': lambda x: formato_europeo(x, 2, " %"), 'PRECIO APLICADO': lambda x: formato_europeo(x, 3, " €"),
-                            'COSTE DESPIECE': lambda x: formato_europeo(x, 3, " €"), 'COSTE CONG.': lambda x: formato_europeo(x, 3, " €"),
-                            'APORTACIÓN A CP': lambda x: formato_europeo(x, 4, " €/kg")
-                        }), use_container_width=True, hide_index=True
-                    )
+                    df_breakdown = desglose_simulador(indice_recetas, df_simulador, sel_esc, version_simulador, cache_trazabilidad())
+                    if df_breakdown is None: continue
+                    mostrar_desglose(df_breakdown, str(sel_cod))
 
     # --- LISTA MAESTRA DE VENTAS REALES ---
     st.divider()
@@ -682,50 +534,24 @@ with tab2:
     if not df_proc_global.empty:
         with st.expander("🎛️ Panel de Filtros de Ventas", expanded=True):
             col_f2_1, col_f2_2, col_f2_3 = st.columns(3)
-            df_proc_validos_t2 = df_proc_global[df_proc_global['Familia'] != 'Sin clasificar']
             
-            clientes_t2 = sorted(df_proc_global['Cliente'].unique()) if not df_proc_global.empty else []
-            sel_clientes_t2 = col_f2_1.multiselect("🏢 Cliente", options=clientes_t2, key="f_cli_t2")
-            fams_t2 = sorted(df_proc_validos_t2['Familia'].unique()) if not df_proc_validos_t2.empty else []
-            sel_familia_t2 = col_f2_2.multiselect("📂 Familia", options=fams_t2, key="f_fam_t2")
-            arts_t2 = sorted(df_proc_validos_t2['Artículo'].unique()) if not df_proc_validos_t2.empty else []
-            sel_arts_t2 = col_f2_3.multiselect("🏷️ Artículo", options=arts_t2, key="f_art_t2")
+            sel_clientes_t2 = col_f2_1.multiselect("🏢 Cliente", options=opciones_filtro(filtros_ventas, 'Cliente'), key="f_cli_t2")
+            sel_familia_t2 = col_f2_2.multiselect("📂 Familia", options=opciones_filtro(cubo_ventas['filtros'], 'Familia'), key="f_fam_t2")
+            sel_arts_t2 = col_f2_3.multiselect("🏷️ Artículo", options=opciones_filtro(cubo_ventas['filtros'], 'Artículo'), key="f_art_t2")
             
-        df_proc_filtrado_t2 = df_proc_validos_t2.copy()
-        if sel_clientes_t2: df_proc_filtrado_t2 = df_proc_filtrado_t2[df_proc_filtrado_t2['Cliente'].isin(sel_clientes_t2)]
-        if sel_familia_t2: df_proc_filtrado_t2 = df_proc_filtrado_t2[df_proc_filtrado_t2['Familia'].isin(sel_familia_t2)]
-        if sel_arts_t2: df_proc_filtrado_t2 = df_proc_filtrado_t2[df_proc_filtrado_t2['Artículo'].isin(sel_arts_t2)]
+        df_master = cubo_ventas['celdas'][mascara_filtros(cubo_ventas['filtros'], {'Cliente': sel_clientes_t2, 'Familia': sel_familia_t2, 'Artículo': sel_arts_t2})]
         
-        if not df_proc_filtrado_t2.empty:
-            df_master = df_proc_filtrado_t2.groupby(['Cliente', 'Familia', 'Código', 'Artículo']).agg(
-                Kilos=('Kilos', 'sum'), Ingreso_EXW=('Precio_CP_Total', 'sum'), Precio_CP_Unitario=('Precio_CP_Unitario', 'first')
-            ).reset_index()
-            
-            df_arts_master = df_proc_filtrado_t2.copy()
-            df_arts_master['Ing_EXW'] = df_arts_master['Kilos'] * df_arts_master['Precio EXW']
-            df_exw_master = df_arts_master.groupby(['Cliente', 'Familia', 'Código', 'Artículo']).agg(
-                Ing_EXW=('Ing_EXW', 'sum'), Kilos=('Kilos', 'sum')
-            ).reset_index()
-            df_exw_master['Precio EXW'] = np.where(df_exw_master['Kilos']>0, df_exw_master['Ing_EXW']/df_exw_master['Kilos'], 0)
-            
-            df_master = pd.merge(df_master, df_exw_master[['Cliente', 'Código', 'Precio EXW']], on=['Cliente', 'Código'], how='left')
-            df_master.rename(columns={'Precio_CP_Unitario': 'Precio a CP'}, inplace=True)
-            df_master_disp = df_master[['Cliente', 'Familia', 'Código', 'Artículo', 'Kilos', 'Precio EXW', 'Precio a CP']].reset_index(drop=True)
+        if not df_master.empty:
+            df_master_disp = df_master[['Cliente', 'Familia', 'Código', 'Artículo', 'Kilos', 'Precio EXW', 'Precio_CP_Unitario']].rename(columns={'Precio_CP_Unitario': 'Precio a CP'}).reset_index(drop=True)
             df_master_disp.columns = [str(c).upper() for c in df_master_disp.columns]
 
-            styled_master = df_master_disp.style.apply(zebra_base, axis=1).format({
-                'KILOS': lambda x: formato_europeo(x, 0, " kg"),
-                'PRECIO EXW': lambda x: formato_europeo(x, 3, " €"),
-                'PRECIO A CP': lambda x: formato_europeo(x, 4, " €/kg")
-            })
-
-            event_master = st.dataframe(
-                styled_master, use_container_width=True, hide_index=True,
-                selection_mode="multi-row", on_select="rerun", key="table_master_t2_fixed"
+            filas_master = tabla_paginada(
+                df_master_disp, "table_master_t2", {'KILOS': (0, " kg"), 'PRECIO EXW': (3, " €"), 'PRECIO A CP': (4, " €/kg")},
+                orden_defecto=('CLIENTE', True), use_container_width=True, hide_index=True, selection_mode="multi-row", on_select="rerun"
             )
             
-            if len(event_master.selection.rows) > 0:
-                for row_idx in event_master.selection.rows:
+            if len(filas_master) > 0:
+                for row_idx in filas_master:
                     sel_cli = str(df_master_disp.iloc[row_idx]['CLIENTE'])
                     sel_cod = str(df_master_disp.iloc[row_idx]['CÓDIGO'])
                     sel_exw = float(df_master_disp.iloc[row_idx]['PRECIO EXW'])
@@ -733,61 +559,15 @@ with tab2:
                     
                     st.markdown(f"###### 🔎 Trazabilidad del Escandallo: {sel_cod} - {sel_art} (Cliente: {sel_cli})")
                     
-                    esc_id = None; cod_principal_teorico = None; es_equivalencia = False
-                    if sel_cod in mapa_escandallos:
-                        esc_id = mapa_escandallos[sel_cod]; cod_principal_teorico = sel_cod
-                    elif sel_cod in mapa_equivalencias:
-                        esc_id = mapa_equivalencias[sel_cod][0]; cod_principal_teorico = mapa_equivalencias[sel_cod][1]; es_equivalencia = True
-                    
-                    if esc_id is not None and cod_principal_teorico is not None:
-                        df_bloque_esc = st.session_state.df_global_base[st.session_state.df_global_base['Escandallo'] == esc_id]
-                        breakdown_data = []
-                        for _, item in df_bloque_esc.iterrows():
-                            cod_item = str(item.get('Código', '')).strip()
-                            pct_item = float(item.get('%_Calculado', 0.0))
-                            coste_cong = float(item.get('Coste_congelación', 0.0))
-                            coste_desp = float(item.get('Coste_despiece', 0.0))
-                            
-                            if cod_item == cod_principal_teorico:
-                                precio_aplicado = sel_exw; disp_cod = sel_cod
-                                origen = "📍 Venta principal (Equivalencia)" if es_equivalencia else "📍 Venta principal (Esta factura)"
-                                disp_name = f"{sel_art} (Equivalencia)" if es_equivalencia else item.get('Nombre', '')
-                            else:
-                                disp_cod = cod_item; disp_name = item.get('Nombre', '')
-                                if cod_item in client_avg_base.get(sel_cli, {}):
-                                    precio_aplicado = client_avg_base[sel_cli][cod_item]; origen = "🥇 Venta a este cliente (P1)"
-                                elif cod_item in global_avg_base:
-                                    precio_aplicado = global_avg_base[cod_item]; origen = "🥈 Media del mercado (P2)"
-                                else:
-                                    precio_aplicado = float(item.get('Precio EXW', 0.0)); origen = "🥉 Precio teórico (P3)"
-                            
-                            linea_cp = (precio_aplicado - coste_cong - coste_desp) * pct_item
-                            breakdown_data.append({
-                                'Código': disp_cod, 'Artículo': disp_name, '% Rendimiento': pct_item * 100, 
-                                'Origen del Precio': origen, 'Precio Aplicado': precio_aplicado,
-                                'Coste Despiece': coste_desp, 'Coste Cong.': coste_cong, 'Aportación a CP': linea_cp
-                            })
-                            
-                        df_breakdown = pd.DataFrame(breakdown_data).reset_index(drop=True)
-                        df_breakdown.columns = [str(c).upper() for c in df_breakdown.columns]
-
-                        def style_breakdown(row):
-                            if row['CÓDIGO'] == sel_cod: return ['background-color: #1E3A8A; font-weight: bold; color: #FFFFFF; font-size: 16px;'] * len(row)
-                            return zebra_base(row)
-                            
-                        st.dataframe(
-                            df_breakdown.style.apply(style_breakdown, axis=1).format({
-                                '% RENDIMIENTO': lambda x: formato_europeo(x, 2, " %"), 'PRECIO APLICADO': lambda x: formato_europeo(x, 3, " €"),
-                                'COSTE DESPIECE': lambda x: formato_europeo(x, 3, " €"), 'COSTE CONG.': lambda x: formato_europeo(x, 3, " €"),
-                                'APORTACIÓN A CP': lambda x: formato_europeo(x, 4, " €/kg")
-                            }), use_container_width=True, hide_index=True
-                        )
+                    df_breakdown = desglose_venta(indice_recetas, mapa_equivalencias, precios_base, sel_cli, sel_cod, sel_exw, sel_art, cache_trazabilidad())
+                    if df_breakdown is not None: mostrar_desglose(df_breakdown, sel_cod)
                     else: st.info("Este artículo no está registrado como 'Principal' ni como 'Equivalencia'.")
         else: st.info("ℹ️ Este cliente solo ha comprado artículos que no están mapeados.")
 
 # --- PESTAÑA 3: PANEL EJECUTIVO CON FRAGMENTO DE ALTO RENDIMIENTO ---
-with tab3:
+with tab3, medir_etapa("render_pestaña_3"):
     @st.fragment
+    @fragmento_medido("render_pestaña_3")
     def renderizar_panel_ejecutivo():
         cliente_sel_final = None 
         
@@ -796,23 +576,16 @@ with tab3:
             with st.expander("🎛️ Panel de Filtros de Análisis y KPIs (Cascada Activa)", expanded=True):
                 col_f1, col_f2, col_f3 = st.columns([1.5, 1, 1])
                 
-                all_clients = sorted(df_proc_global['Cliente'].unique()) if not df_proc_global.empty else []
+                all_clients = opciones_filtro(filtros_ventas, 'Cliente')
                 buscador = col_f1.text_input("🔍 Auto-seleccionar cadena (Ej: Escribe 'COVI' o 'DIA')")
                 clientes_preseleccionados = [c for c in all_clients if buscador.lower() in c.lower()] if buscador else []
                 sel_clients = col_f1.multiselect("🏢 Clientes (Selecciona uno o varios)", all_clients, default=clientes_preseleccionados)
                 agrupar_cadena = col_f1.checkbox("🔗 Agrupar clientes seleccionados como una 'Cadena'", value=bool(buscador))
                 
-                df_proc_temp_fams = df_proc_global[df_proc_global['Familia'] != 'Sin clasificar'].copy()
-                if sel_clients:
-                    df_proc_temp_fams = df_proc_temp_fams[df_proc_temp_fams['Cliente'].isin(sel_clients)]
-                fams_disp = sorted(df_proc_temp_fams['Familia'].unique()) if not df_proc_temp_fams.empty else []
-                sel_fams = col_f2.multiselect("📂 Familias", fams_disp)
+                mask_clientes = mascara_filtros(cubo_ventas['filtros'], {'Cliente': sel_clients})
+                sel_fams = col_f2.multiselect("📂 Familias", opciones_filtro(cubo_ventas['filtros'], 'Familia', mask_clientes))
                 
-                df_proc_temp_arts = df_proc_temp_fams.copy()
-                if sel_fams:
-                    df_proc_temp_arts = df_proc_temp_arts[df_proc_temp_arts['Familia'].isin(sel_fams)]
-                arts_disp = sorted(df_proc_temp_arts['Artículo'].unique()) if not df_proc_temp_arts.empty else []
-                sel_arts = col_f3.multiselect("🏷️ Artículos", arts_disp)
+                sel_arts = col_f3.multiselect("🏷️ Artículos", opciones_filtro(cubo_ventas['filtros'], 'Artículo', mascara_filtros(cubo_ventas['filtros'], {'Familia': sel_fams}, mask_clientes)))
                 
                 st.markdown("---")
                 col_n1, col_n2 = st.columns(2)
@@ -834,40 +607,24 @@ with tab3:
                         max_ben = c4.number_input("Máximo (€/kg)", value=2.0, step=0.1)
             
             if sel_clients and agrupar_cadena:
-                nombre_grupo = "GRUPO: " + " + ".join([c[:10] for c in sel_clients[:2]]) + ("..." if len(sel_clients)>2 else "")
-                df_ventas_grupo = df_ventas.copy()
-                df_ventas_grupo.loc[df_ventas_grupo['Cliente'].isin(sel_clients), 'Cliente'] = nombre_grupo
-                df_proc_full, global_avg_active, client_avg_active = procesar_ventas_cascada(df_ventas_grupo, st.session_state.df_global_base, mapa_escandallos, mapa_equivalencias, esc_to_princ)
-                df_proc = df_proc_full[df_proc_full['Cliente'] == nombre_grupo].copy()
+                clave_cadena = tuple(sorted(sel_clients))
+                nombre_grupo = "GRUPO: " + " + ".join([c[:10] for c in clave_cadena[:2]]) + ("..." if len(clave_cadena)>2 else "")
+                def calcular_cadena():
+                    df_cadena, _, precios_cadena = procesar_cadena_cascada(df_ventas, list(clave_cadena), nombre_grupo, precios_base, mapa_escandallos, mapa_equivalencias, indice_recetas)
+                    return df_cadena, construir_cubo(df_cadena), precios_cadena
+                df_proc, cubo_activo, precios_active = memo_lru(resultados['cadenas'], clave_cadena, calcular_cadena, MAX_CADENAS_COMPARTIDAS)
+                familias_kpi = familias_cubo(cubo_activo, {'Familia': sel_fams, 'Artículo': sel_arts})
             else:
-                df_proc = df_proc_global.copy()
-                global_avg_active = global_avg_base
-                client_avg_active = client_avg_base
-                if sel_clients: df_proc = df_proc[df_proc['Cliente'].isin(sel_clients)]
-            
-            df_proc_kpi = df_proc[df_proc['Familia'] != 'Sin clasificar']
-            if sel_fams: df_proc_kpi = df_proc_kpi[df_proc_kpi['Familia'].isin(sel_fams)]
-            if sel_arts: df_proc_kpi = df_proc_kpi[df_proc_kpi['Artículo'].isin(sel_arts)]
+                df_proc = df_proc_global
+                cubo_activo = cubo_ventas
+                precios_active = precios_base
+                if sel_clients: df_proc = df_proc[mascara_filtros(filtros_ventas, {'Cliente': sel_clients})]
+                familias_kpi = familias_cubo(cubo_activo, {'Cliente': sel_clients, 'Familia': sel_fams, 'Artículo': sel_arts})
                     
-            if df_proc_kpi.empty:
+            if familias_kpi.empty:
                 st.info("ℹ️ Los artículos de este cliente (o filtros) no coinciden con ningún escandallo. Por favor, revisa el desplegable inferior de 'Artículos Sin clasificar'.")
             else:
-                df_cli = df_proc_kpi.groupby('Cliente').agg(
-                    Kilos_Vendidos=('Kilos', 'sum'), Kilos_CP_Totales=('Kilos_CP', 'sum'), Precio_CP_Total=('Precio_CP_Total', 'sum')
-                ).reset_index()
-                
-                df_cli['Precio_Medio_CP'] = np.where(df_cli['Kilos_CP_Totales'] > 0, df_cli['Precio_CP_Total'] / df_cli['Kilos_CP_Totales'], 0.0)
-                
-                def calc_vs_market(cliente):
-                    df_c = df_proc_kpi[df_proc_kpi['Cliente'] == cliente]
-                    extra = 0.0
-                    for _, r in df_c.iterrows():
-                        if r['Kilos_CP'] > 0: 
-                            extra += (r['Precio_CP_Unitario'] - bench_familia.get(r['Familia'], 0.0)) * r['Kilos_CP']
-                    return extra
-                    
-                df_cli['Vs_Mercado_Euros'] = df_cli['Cliente'].apply(calc_vs_market)
-                df_cli['Beneficio_kg'] = np.where(df_cli['Kilos_CP_Totales']>0, df_cli['Vs_Mercado_Euros'] / df_cli['Kilos_CP_Totales'], 0.0)
+                df_cli = resumen_clientes_cubo(familias_kpi, bench_familia)
                 
                 if vol_op == "Mayor o igual a (>=)": df_cli = df_cli[df_cli['Kilos_Vendidos'] >= min_kilos]
                 elif vol_op == "Menor o igual a (<=)": df_cli = df_cli[df_cli['Kilos_Vendidos'] <= max_kilos]
@@ -883,16 +640,13 @@ with tab3:
                     st.divider()
                     st.markdown("### 📊 Indicadores de Rendimiento")
                     
-                    clientes_filtrados = df_cli['Cliente'].tolist()
-                    df_proc_kpi_filtered = df_proc_kpi[df_proc_kpi['Cliente'].isin(clientes_filtrados)]
-                    
                     kpi_kilos_cp_tot = df_cli['Kilos_CP_Totales'].sum()
                     kpi_kilos_fisicos_tot = df_cli['Kilos_Vendidos'].sum()
                     kpi_beneficio_abs = df_cli['Vs_Mercado_Euros'].sum()
                     kpi_beneficio_kg = kpi_beneficio_abs / kpi_kilos_cp_tot if kpi_kilos_cp_tot > 0 else 0.0
                     kpi_cp_medio = df_cli['Precio_CP_Total'].sum() / kpi_kilos_cp_tot if kpi_kilos_cp_tot > 0 else 0.0
                     
-                    ingreso_exw_tot = (df_proc_kpi_filtered['Kilos'] * df_proc_kpi_filtered['Precio EXW']).sum()
+                    ingreso_exw_tot = df_cli['Ingreso_EXW'].sum()
                     kpi_exw_medio = ingreso_exw_tot / kpi_kilos_fisicos_tot if kpi_kilos_fisicos_tot > 0 else 0.0
                     
                     if abs(kpi_beneficio_kg) < 0.0001: kpi_beneficio_kg = 0.0
@@ -947,21 +701,18 @@ with tab3:
                     df_rank_display.rename(columns={'Kilos_Vendidos': 'Kilos Físicos', 'Precio_Medio_CP': 'Precio Medio a CP', 'Beneficio_kg': 'Beneficio €/kg CP', 'Vs_Mercado_Euros': 'Beneficio Absoluto (€)'}, inplace=True)
                     df_rank_display.columns = [str(c).upper() for c in df_rank_display.columns]
 
-                    styled_rank = df_rank_display.style.apply(zebra_base, axis=1)
-                    try: styled_rank = styled_rank.map(color_vs_market, subset=['BENEFICIO ABSOLUTO (€)'])
-                    except AttributeError: styled_rank = styled_rank.applymap(color_vs_market, subset=['BENEFICIO ABSOLUTO (€)'])
-                    
-                    event_table = st.dataframe(
-                        styled_rank.format({
-                            'KILOS FÍSICOS': lambda x: formato_europeo(x, 0, " kg"), 'PRECIO MEDIO A CP': lambda x: formato_europeo(x, 4, " €/kg"),
-                            'BENEFICIO €/KG CP': lambda x: ("+" if x>0 else "") + formato_europeo(x, 4, " €/kg"), 'BENEFICIO ABSOLUTO (€)': lambda x: ("+" if x>0 else "") + formato_europeo(x, 2, " €")
-                        }), use_container_width=True, hide_index=True, selection_mode="single-row", on_select="rerun"
+                    filas_rank = tabla_paginada(
+                        df_rank_display, "table_rank_t3", {
+                            'KILOS FÍSICOS': (0, " kg"), 'PRECIO MEDIO A CP': (4, " €/kg"),
+                            'BENEFICIO €/KG CP': (4, " €/kg", True), 'BENEFICIO ABSOLUTO (€)': (2, " €", True)
+                        }, orden_defecto=('CLIENTE', True), estilos_celda={'BENEFICIO ABSOLUTO (€)': color_vs_market},
+                        use_container_width=True, hide_index=True, selection_mode="single-row", on_select="rerun"
                     )
                     
                     st.divider()
                     
-                    if len(event_table.selection.rows) > 0:
-                        cliente_sel_final = df_cli.iloc[event_table.selection.rows[0]]['Cliente']
+                    if len(filas_rank) > 0:
+                        cliente_sel_final = df_cli.iloc[filas_rank[0]]['Cliente']
                     elif hasattr(event_chart, 'selection') and 'sel_cliente' in event_chart.selection:
                         lista_sel = event_chart.selection['sel_cliente']
                         if len(lista_sel) > 0:
@@ -971,11 +722,7 @@ with tab3:
                         st.subheader(f"🔍 Análisis de Cesta: {cliente_sel_final}")
                         st.info("💡 Haz clic en una o **varias filas a la vez** para auditar y comparar sus recetas abajo.")
                         
-                        df_zoom = df_proc_kpi[df_proc_kpi['Cliente'] == cliente_sel_final].groupby('Familia').agg(Kilos_Vendidos=('Kilos', 'sum'), Kilos_CP=('Kilos_CP', 'sum'), Precio_CP_Total=('Precio_CP_Total', 'sum')).reset_index()
-                        df_zoom['Precio_CP_Cliente'] = np.where(df_zoom['Kilos_CP'] > 0, df_zoom['Precio_CP_Total'] / df_zoom['Kilos_CP'], 0.0)
-                        df_zoom['Precio_CP_Mercado'] = df_zoom['Familia'].map(bench_familia)
-                        df_zoom['Dif_Unitaria'] = df_zoom['Precio_CP_Cliente'] - df_zoom['Precio_CP_Mercado']
-                        df_zoom['Extra_Generado'] = df_zoom['Dif_Unitaria'] * df_zoom['Kilos_CP'] 
+                        df_zoom = precio_cp_familias(familias_kpi[familias_kpi['Cliente'] == cliente_sel_final].rename(columns={'Kilos': 'Kilos_Vendidos'}), bench_familia)
                         
                         df_chart = df_zoom[['Familia', 'Precio_CP_Cliente', 'Precio_CP_Mercado']].melt(id_vars='Familia', var_name='Métrica', value_name='Precio a CP')
                         df_chart['Métrica'] = df_chart['Métrica'].replace({'Precio_CP_Cliente': 'Cliente', 'Precio_CP_Mercado': 'Media Mercado'})
@@ -1006,22 +753,14 @@ with tab3:
                                 color_dif = "#4ADE80" if r['Dif_Unitaria'] > 0 else "#F87171"
                                 col_m3.markdown(render_kpi("Beneficio €/kg CP", f"{dif_sign}{formato_europeo(r['Dif_Unitaria'], 4, ' €/kg')}", color_dif), unsafe_allow_html=True)
                                 
-                                df_arts = df_proc_kpi[(df_proc_kpi['Cliente'] == cliente_sel_final) & (df_proc_kpi['Familia'] == r['Familia'])].copy()
-                                df_arts['Ingreso_EXW'] = df_arts['Kilos'] * df_arts['Precio EXW']
-                                df_arts_grouped = df_arts.groupby(['Código', 'Artículo']).agg(
-                                    Kilos=('Kilos', 'sum'), Kilos_CP=('Kilos_CP', 'sum'), Ingreso_EXW=('Ingreso_EXW', 'sum'), Precio_CP_Unitario=('Precio_CP_Unitario', 'first')
-                                ).reset_index()
-                                df_arts_grouped['Precio EXW Medio'] = np.where(df_arts_grouped['Kilos'] > 0, df_arts_grouped['Ingreso_EXW'] / df_arts_grouped['Kilos'], 0)
-                                df_arts_grouped.drop(columns=['Ingreso_EXW'], inplace=True)
-                                df_arts_grouped.rename(columns={'Precio_CP_Unitario': 'Precio a CP'}, inplace=True)
+                                df_arts_grouped = cubo_activo['celdas'][mascara_filtros(cubo_activo['filtros'], {'Cliente': [cliente_sel_final], 'Familia': [r['Familia']], 'Artículo': sel_arts})]
+                                df_arts_grouped = df_arts_grouped[['Código', 'Artículo', 'Kilos', 'Kilos_CP', 'Precio_CP_Unitario', 'Precio EXW']].rename(columns={'Precio_CP_Unitario': 'Precio a CP', 'Precio EXW': 'Precio EXW Medio'}).reset_index(drop=True)
                                 df_arts_grouped.columns = [str(c).upper() for c in df_arts_grouped.columns]
                                 
-                                styled_arts = df_arts_grouped.style.apply(zebra_base, axis=1).format({
-                                    'KILOS': lambda x: formato_europeo(x, 0, " kg"), 'KILOS_CP': lambda x: formato_europeo(x, 0, " kg"),
-                                    'PRECIO EXW MEDIO': lambda x: formato_europeo(x, 3, " €"), 'PRECIO A CP': lambda x: formato_europeo(x, 4, " €/kg")
-                                })
-
-                                event_arts = st.dataframe(styled_arts, use_container_width=True, hide_index=True, selection_mode="multi-row", on_select="rerun", key=f"arts_{cliente_sel_final}_{r['Familia']}")
+                                event_arts = mostrar_tabla(
+                                    df_arts_grouped, {'KILOS': (0, " kg"), 'KILOS_CP': (0, " kg"), 'PRECIO EXW MEDIO': (3, " €"), 'PRECIO A CP': (4, " €/kg")},
+                                    use_container_width=True, hide_index=True, selection_mode="multi-row", on_select="rerun", key=f"arts_{cliente_sel_final}_{r['Familia']}"
+                                )
                                 
                                 if len(event_arts.selection.rows) > 0:
                                     for row_idx in event_arts.selection.rows:
@@ -1031,55 +770,8 @@ with tab3:
                                         
                                         st.markdown(f"###### 🔎 Trazabilidad del Escandallo: {selected_code} - {selected_name}")
                                         
-                                        esc_id = None; cod_principal_teorico = None; es_equivalencia = False
-                                        if selected_code in mapa_escandallos:
-                                            esc_id = mapa_escandallos[selected_code]; cod_principal_teorico = selected_code
-                                        elif selected_code in mapa_equivalencias:
-                                            esc_id = mapa_equivalencias[selected_code][0]; cod_principal_teorico = mapa_equivalencias[selected_code][1]; es_equivalencia = True
-                                        
-                                        if esc_id is not None and cod_principal_teorico is not None:
-                                            df_bloque_esc = st.session_state.df_global_base[st.session_state.df_global_base['Escandallo'] == esc_id]
-                                            breakdown_data = []
-                                            for _, item in df_bloque_esc.iterrows():
-                                                cod_item = str(item.get('Código', '')).strip()
-                                                pct_item = float(item.get('%_Calculado', 0.0))
-                                                coste_cong = float(item.get('Coste_congelación', 0.0))
-                                                coste_desp = float(item.get('Coste_despiece', 0.0))
-                                                
-                                                if cod_item == cod_principal_teorico:
-                                                    precio_aplicado = selected_exw; disp_cod = selected_code
-                                                    origen = "📍 Venta principal (Equivalencia)" if es_equivalencia else "📍 Venta principal (Esta factura)"
-                                                    disp_name = f"{selected_name} (Equivalencia)" if es_equivalencia else item.get('Nombre', '')
-                                                else:
-                                                    disp_cod = cod_item; disp_name = item.get('Nombre', '')
-                                                    if cod_item in client_avg_active.get(cliente_sel_final, {}):
-                                                        precio_aplicado = client_avg_active[cliente_sel_final][cod_item]; origen = "🥇 Venta a este cliente (P1)"
-                                                    elif cod_item in global_avg_active:
-                                                        precio_aplicado = global_avg_active[cod_item]; origen = "🥈 Media del mercado (P2)"
-                                                    else:
-                                                        precio_aplicado = float(item.get('Precio EXW', 0.0)); origen = "🥉 Precio teórico (P3)"
-                                                
-                                                linea_cp = (precio_aplicado - coste_cong - coste_desp) * pct_item
-                                                breakdown_data.append({
-                                                    'Código': disp_cod, 'Artículo': disp_name, '% Rendimiento': pct_item * 100, 
-                                                    'Origen del Precio': origen, 'Precio Aplicado': precio_aplicado,
-                                                    'Coste Despiece': coste_desp, 'Coste Cong.': coste_cong, 'Aportación a CP': linea_cp
-                                                })
-                                                
-                                            df_breakdown = pd.DataFrame(breakdown_data).reset_index(drop=True)
-                                            df_breakdown.columns = [str(c).upper() for c in df_breakdown.columns]
-
-                                            def style_breakdown(row):
-                                                if row['CÓDIGO'] == selected_code: return ['background-color: #1E3A8A; font-weight: bold; color: #FFFFFF; font-size: 16px;'] * len(row)
-                                                return zebra_base(row)
-                                                
-                                            st.dataframe(
-                                                df_breakdown.style.apply(style_breakdown, axis=1).format({
-                                                    '% RENDIMIENTO': lambda x: formato_europeo(x, 2, " %"), 'PRECIO APLICADO': lambda x: formato_europeo(x, 3, " €"),
-                                                    'COSTE DESPIECE': lambda x: formato_europeo(x, 3, " €"), 'COSTE CONG.': lambda x: formato_europeo(x, 3, " €"),
-                                                    'APORTACIÓN A CP': lambda x: formato_europeo(x, 4, " €/kg")
-                                                }), use_container_width=True, hide_index=True
-                                            )
+                                        df_breakdown = desglose_venta(indice_recetas, mapa_equivalencias, precios_active, cliente_sel_final, selected_code, selected_exw, selected_name, cache_trazabilidad())
+                                        if df_breakdown is not None: mostrar_desglose(df_breakdown, selected_code)
                                         else: st.info("Este artículo no está registrado como 'Principal' ni como 'Equivalencia'.")
             
             st.divider()
@@ -1098,10 +790,9 @@ with tab3:
                     df_sob_disp = df_sobrantes[['Código', 'Artículo', 'Cliente', 'Kilos', 'Precio EXW']].reset_index(drop=True)
                     df_sob_disp.columns = [str(c).upper() for c in df_sob_disp.columns]
                     
-                    st.dataframe(
-                        df_sob_disp.style.apply(zebra_base, axis=1).format({
-                            'KILOS': lambda x: formato_europeo(x, 2, " kg"), 'PRECIO EXW': lambda x: formato_europeo(x, 3, " €")
-                        }), use_container_width=True, hide_index=True
-                    )
+                    mostrar_tabla(df_sob_disp, {'KILOS': (2, " kg"), 'PRECIO EXW': (3, " €")}, use_container_width=True, hide_index=True)
 
     renderizar_panel_ejecutivo()
+
+cerrar_medicion()
+if st.query_params.get("admin") == "1": panel_rendimiento()
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+import pandas as pd
+
+import motor
+from motor import (
+    preprocesar_fuentes, huella_fuentes, familias_cubo, resumen_clientes_cubo,
+    iniciar_medicion, cerrar_medicion, medir_etapa, tabla_mediciones,
+)
+from fuentes import (
+    FUENTES_SHEETS, cliente_gspread, load_sheets_batch, cargar_fuentes_locales, preparar_base, preparar_equivalencias, preparar_ventas,
+)
+
+# Cálculo completo sin Streamlit: carga las fuentes (Google Sheets o ficheros exportados), ejecuta la cascada, el
+# benchmark de mercado y el ranking de clientes, y escribe los resultados en Parquet o CSV. Uso:
+#   python batch.py --credenciales cuenta_servicio.json --salida resultados/
+#   python batch.py --base base.csv --equivalencias equivalencias.csv --ventas ventas.csv --salida resultados/ --formato csv
+
+# --- CARGA ---
+def cargar_fuentes(args):
+    """{nombre: (df_limpio, error)} desde ficheros locales si se indican, si no desde Google Sheets."""
+    if args.base:
+        rutas = {nombre: ruta for nombre, ruta in (('base', args.base), ('equivalencias', args.equivalencias), ('ventas', args.ventas)) if ruta}
+        cargadas = cargar_fuentes_locales(rutas)
+        for nombre in FUENTES_SHEETS: cargadas.setdefault(nombre, (pd.DataFrame(), None))
+        return cargadas
+    credenciales = args.credenciales or os.environ.get("GOOGLE_CREDENTIALS")
+    if not credenciales: raise SystemExit("Indica --base (y --ventas/--equivalencias) como ficheros o --credenciales (cuenta de servicio de Google).")
+    if os.path.exists(credenciales):
+        with open(credenciales, encoding='utf-8') as f: creds_dict = json.load(f)
+    else: creds_dict = json.loads(credenciales)
+    return load_sheets_batch(FUENTES_SHEETS, cliente_gspread(creds_dict))
+
+# --- CÁLCULO ---
+def calcular_resultados(cargadas):
+    """Tablas de resultados {nombre: DataFrame}, versión de datos y avisos de carga."""
+    df_base, indice_recetas, err = preparar_base(*cargadas['base'])
+    if err: raise SystemExit(err)
+    mapa_equiv, err_e = preparar_equivalencias(*cargadas['equivalencias'])
+    df_ventas, err_v = preparar_ventas(*cargadas['ventas'])
+    avisos = [e for e in (err_e, err_v) if e]
+
+    version = huella_fuentes(df_base, df_ventas, mapa_equiv)
+    R = preprocesar_fuentes(df_base, indice_recetas, df_ventas, err_v, mapa_equiv)
+    df_proc = R['df_proc_global']
+    tablas = {
+        'cascada': df_proc,
+        'benchmark_familia': pd.DataFrame(list(R['bench_familia'].items()), columns=['Familia', 'Precio_CP_Mercado']),
+        'precio_venta_real': pd.DataFrame(list(R['global_avg_base'].items()), columns=['Código', 'Precio_EXW_Medio']),
+    }
+    if not df_proc.empty:
+        tablas['ranking_clientes'] = resumen_clientes_cubo(familias_cubo(R['cubo'], {}), R['bench_familia']).sort_values('Vs_Mercado_Euros', ascending=False)
+    if R['ranking_simulador'] is not None:
+        tablas['ranking_escandallos'] = R['ranking_simulador'].reset_index()
+    return tablas, version, avisos
+
+# --- SALIDA ---
+def para_parquet(df):
+    """Las columnas de texto con valores de varios tipos (p. ej. escandallos numéricos y alfanuméricos) pasan a texto."""
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True) not in ('string', 'empty'):
+            df[col] = df[col].map(lambda v: v if pd.isna(v) else str(v))
+    return df
+
+def escribir_resultados(tablas, carpeta, formato, manifiesto):
+    os.makedirs(carpeta, exist_ok=True)
+    for nombre, df in tablas.items():
+        ruta = os.path.join(carpeta, f"{nombre}.{formato}")
+        if formato == 'parquet': para_parquet(df).to_parquet(ruta, index=False)
+        else: df.to_csv(ruta, index=False)
+    with open(os.path.join(carpeta, "resultados.json"), 'w', encoding='utf-8') as f:
+        json.dump(manifiesto, f, indent=2, ensure_ascii=False)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cascada de ventas y rentabilidad por cliente sin la interfaz.")
+    parser.add_argument('--base', help="Base de escandallos exportada (CSV, Excel o Parquet). Sin ella se lee de Google Sheets.")
+    parser.add_argument('--equivalencias', help="Tabla de equivalencias exportada.")
+    parser.add_argument('--ventas', help="Hoja de ventas exportada.")
+    parser.add_argument('--credenciales', help="JSON (o ruta al JSON) de la cuenta de servicio de Google; también GOOGLE_CREDENTIALS.")
+    parser.add_argument('--salida', required=True, help="Carpeta de resultados.")
+    parser.add_argument('--formato', choices=['parquet', 'csv'], default='parquet')
+    parser.add_argument('--procesos', type=int, default=motor.PROCESOS_CASCADA, help="Procesos para la cascada (1 = en serie).")
+    args = parser.parse_args(argv)
+    if not args.base and (args.ventas or args.equivalencias): parser.error("--ventas y --equivalencias solo se usan junto con --base (la base de escandallos exportada).")
+    motor.PROCESOS_CASCADA = args.procesos
+
+    medicion = iniciar_medicion("batch")
+    with medir_etapa('carga_fuentes'): cargadas = cargar_fuentes(args)
+    tablas, version, avisos = calcular_resultados(cargadas)
+    for aviso in avisos: print(f"Aviso: {aviso}", file=sys.stderr)
+    cerrar_medicion()
+
+    manifiesto = {
+        'fecha': datetime.now().isoformat(timespec='seconds'), 'version_datos': version, 'formato': args.formato, 'avisos': avisos,
+        'filas': {nombre: len(df) for nombre, df in tablas.items()}, 'segundos': medicion['segundos'],
+        'etapas': tabla_mediciones([medicion])[['etapa', 'nivel', 'segundos', 'filas_entrada', 'filas_salida']].astype(object).where(lambda d: d.notna(), None).to_dict('records'),
+    }
+    escribir_resultados(tablas, args.salida, args.formato, manifiesto)
+    print(f"{len(tablas)} tablas escritas en {args.salida} (versión de datos {version[:12]}, {medicion['segundos']:.2f} s)", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from motor import (
+    formato_europeo_columna, limpiar_base, limpiar_equivalencias, limpiar_ventas, construir_mapa_equivalencias,
+    construir_indice_recetas, recalcular_dataframe, vocabularios_cascada, procesar_ventas_cascada, preprocesar_fuentes,
+    construir_ranking_simulador, editar_simulador, benchmark_mercado, familias_cubo, resumen_clientes_cubo, procesar_cadena_cascada,
+    agregar_ventas_cascada, tabla_precios_cascada, resolver_cascada_paralelo, PROCESOS_CASCADA,
+    precio_cp_escandallos, precio_cp_por_cliente, vector_precios,
+)
+
+# Benchmarks del motor con datos sintéticos: no necesitan Streamlit ni Google. Uso:
+#   python benchmark.py --escalas pequena media --salida bench.json [--comparar bench_anterior.json]
+
+# --- ESCALAS ---
+# escandallos × líneas por receta, clientes × códigos vendidos por cliente
+ESCALAS = {
+    'pequena': {'escandallos': 200, 'lineas': 8, 'clientes': 50, 'codigos_cliente': 40},
+    'media': {'escandallos': 1000, 'lineas': 10, 'clientes': 200, 'codigos_cliente': 80},
+    'grande': {'escandallos': 3000, 'lineas': 12, 'clientes': 500, 'codigos_cliente': 150},
+}
+FAMILIAS = ['Vacuno', 'Cerdo', 'Ave', 'Cordero', 'Elaborados']
+
+# --- GENERADOR SINTÉTICO ---
+def texto_europeo(valores, decimales=3):
+    """Números como los devuelve la hoja: texto con separadores europeos."""
+    return formato_europeo_columna(pd.Series(valores), decimales).to_numpy()
+
+def generar_hojas(escandallos, lineas, clientes, codigos_cliente, semilla=0):
+    """Hojas crudas (todo texto, como llegan de gspread) de base, equivalencias y ventas."""
+    rng = np.random.default_rng(semilla)
+    n = escandallos * lineas
+    esc = np.repeat(np.arange(1, escandallos + 1), lineas)
+    linea = np.tile(np.arange(lineas), escandallos)
+    # La línea 0 es la principal (código propio); el resto son subproductos de un catálogo compartido entre recetas.
+    catalogo = np.array([f"{20000 + i}" for i in range(escandallos * 2)], dtype=object)
+    codigos = np.where(linea == 0, (10000 + esc).astype(str), rng.choice(catalogo, n))
+    base = pd.DataFrame({
+        'Escandallo': esc.astype(str), 'Código': codigos, 'Nombre': np.char.add('ART ', codigos.astype(str)),
+        'TIPO': np.where(linea == 0, 'Principal', 'Subproducto'), 'Familia': np.array(FAMILIAS, dtype=object)[esc % len(FAMILIAS)],
+        'Formato': np.where(esc % 2, 'Fresco', 'Congelado'), 'Fecha': '01/06/2024',
+        'Cantidad(kg)': texto_europeo(np.where(linea == 0, rng.uniform(20, 60, n), rng.uniform(0, 15, n))),
+        'Coste despiece': texto_europeo(rng.uniform(0, 0.6, n)), 'Coste congelación': texto_europeo(rng.uniform(0, 0.3, n)),
+        'Precio EXW': texto_europeo(rng.uniform(0.5, 12, n)),
+    })
+    # Una de cada diez recetas tiene además una revisión antigua que la limpieza debe descartar.
+    antiguas = base[base['Escandallo'].astype(int) % 10 == 0].assign(Fecha='01/01/2023')
+    base = pd.concat([base, antiguas], ignore_index=True)
+
+    n_equiv = max(escandallos // 5, 1)
+    esc_equiv = rng.integers(1, escandallos + 1, n_equiv)
+    equivalencias = pd.DataFrame({
+        'CODIGO': [f"{50000 + i}" for i in range(n_equiv)], 'ESCANDALLO': esc_equiv.astype(str),
+        'CODIGO PRINCIPAL': (10000 + esc_equiv).astype(str),
+    })
+
+    vendibles = np.concatenate([(10000 + np.arange(1, escandallos + 1)).astype(str), catalogo, equivalencias['CODIGO'].to_numpy(),
+                                [f"{90000 + i}" for i in range(max(escandallos // 10, 1))]]).astype(object)
+    cli = np.repeat(np.arange(clientes), codigos_cliente)
+    cod = np.concatenate([rng.choice(vendibles, codigos_cliente, replace=False) for _ in range(clientes)])
+    nombres_cli = np.array([f"CLIENTE {i:04d}" for i in range(clientes)], dtype=object)
+    nombres_cli[-1] = 'Entradas a Congelar'
+    m = len(cli)
+    ventas = pd.DataFrame({
+        'CLIENTE': nombres_cli[cli], 'CODIGO': cod, 'NOMBRE': np.char.add('ART ', cod.astype(str)),
+        'KILOS': texto_europeo(rng.uniform(-20, 2000, m), 2), 'PRECIO EXW': texto_europeo(rng.uniform(0.5, 14, m)),
+    })
+    return base, equivalencias, ventas
+
+# --- MEDICIÓN ---
+def medir(funcion, preparar=None, repeticiones=3):
+    """Tiempos de funcion(*preparar()) en segundos; preparar (copias de entrada, etc.) queda fuera de la medida."""
+    tiempos = []
+    for _ in range(repeticiones):
+        args = preparar() if preparar else ()
+        t0 = time.perf_counter()
+        funcion(*args)
+        tiempos.append(time.perf_counter() - t0)
+    return {'min_s': min(tiempos), 'mediana_s': statistics.median(tiempos), 'repeticiones': repeticiones}
+
+def medir_escala(params, semilla=0, repeticiones=3, procesos=PROCESOS_CASCADA):
+    """Tiempos por etapa del motor para una escala: carga, cascada, simulador y panel ejecutivo."""
+    hoja_base, hoja_equiv, hoja_ventas = generar_hojas(semilla=semilla, **params)
+    etapas = {}
+
+    # Limpieza de las hojas (lo que hacen los loaders tras descargar)
+    etapas['limpiar_base'] = medir(limpiar_base, lambda: (hoja_base.copy(),), repeticiones)
+    etapas['limpiar_equivalencias'] = medir(lambda df: construir_mapa_equivalencias(limpiar_equivalencias(df)), lambda: (hoja_equiv.copy(),), repeticiones)
+    etapas['limpiar_ventas'] = medir(limpiar_ventas, lambda: (hoja_ventas.copy(),), repeticiones)
+    df_base = limpiar_base(hoja_base.copy())
+    mapa_equiv = construir_mapa_equivalencias(limpiar_equivalencias(hoja_equiv.copy()))
+    df_ventas = limpiar_ventas(hoja_ventas.copy())
+    etapas['construir_indice_recetas'] = medir(construir_indice_recetas, lambda: (df_base,), repeticiones)
+    indice = construir_indice_recetas(df_base)
+    etapas['recalcular_dataframe'] = medir(recalcular_dataframe, lambda: (df_base.copy(),), repeticiones)
+
+    # Cascada de ventas y preprocesado completo
+    df_v = df_ventas[~df_ventas['Cliente'].str.contains('Entradas a Congelar', case=False, na=False)]
+    mapa_esc = {cod: esc for cod, (esc, _) in indice['principales'].items()}
+    esc_to_princ = dict(indice['principal_de'])
+    etapas['procesar_ventas_cascada'] = medir(
+        lambda: procesar_ventas_cascada(df_v, df_base, mapa_esc, mapa_equiv, esc_to_princ, indice, vocabularios_cascada(df_v, indice)), None, repeticiones)
+    if procesos > 1:
+        # Resolución repartida por clientes entre procesos (el primer reparto arranca el pool y queda fuera de la medida)
+        vocab = vocabularios_cascada(df_v, indice)
+        ventas_agr = agregar_ventas_cascada(df_v, vocab)
+        precios = tabla_precios_cascada(ventas_agr, vocab)
+        resolver_cascada_paralelo(ventas_agr, precios, mapa_esc, mapa_equiv, indice, procesos=procesos)
+        etapas[f'resolver_cascada_{procesos}_procesos'] = medir(
+            lambda: resolver_cascada_paralelo(ventas_agr, precios, mapa_esc, mapa_equiv, indice, procesos=procesos), None, repeticiones)
+        etapas['resolver_cascada_1_proceso'] = medir(
+            lambda: resolver_cascada_paralelo(ventas_agr, precios, mapa_esc, mapa_equiv, indice, procesos=1), None, repeticiones)
+    etapas['preprocesar_fuentes'] = medir(
+        lambda df: preprocesar_fuentes(df, indice, df_ventas, None, mapa_equiv), lambda: (df_base.copy(),), repeticiones)
+    R = preprocesar_fuentes(df_base.copy(), indice, df_ventas, None, mapa_equiv)
+    # Recarga tras añadir unas filas de venta de un cliente: solo se rehace la cascada de los clientes afectados
+    cliente = df_v['Cliente'].iloc[0]
+    df_ventas_mas = pd.concat([df_ventas, df_ventas[df_ventas['Cliente'] == cliente].head(5)], ignore_index=True)
+    etapas['preprocesar_incremental'] = medir(
+        lambda df: preprocesar_fuentes(df, indice, df_ventas_mas, None, mapa_equiv, R), lambda: (df_base.copy(),), repeticiones)
+
+    # Simulador: ranking inicial y edición de precios
+    df_sim = R['df_simulador']
+    etapas['simulador_ranking'] = medir(lambda df: construir_ranking_simulador(df, indice), lambda: (df_sim,), repeticiones)
+    # Precio a CP de todos los escandallos con la matriz de rendimientos: un vector de precios y uno por cliente
+    matriz = indice['matriz']
+    etapas['matriz_precio_cp'] = medir(lambda: precio_cp_escandallos(matriz, vector_precios(matriz, R['global_avg_base'])), None, repeticiones)
+    clientes = np.arange(len(R['precios_base']['vocabularios']['Cliente']))
+    etapas['matriz_precio_cp_por_cliente'] = medir(lambda: precio_cp_por_cliente(matriz, R['precios_base'], clientes), None, repeticiones)
+    ranking = construir_ranking_simulador(df_sim, indice)
+    rng = np.random.default_rng(semilla)
+    principales = list(indice['principales'].items())
+    for n_cambios in (1, 25):
+        elegidos = rng.choice(len(principales), min(n_cambios, len(principales)), replace=False)
+        cambios = [(principales[i][1][0], principales[i][0], float(rng.uniform(1, 10))) for i in elegidos]
+        etapas[f'simulador_edicion_{n_cambios}'] = medir(
+            lambda df, rk: editar_simulador(df, rk, indice, cambios), lambda: (df_sim.copy(), ranking.copy()), repeticiones)
+
+    # Panel ejecutivo: benchmark de mercado, resumen por cliente y cadena de clientes
+    df_proc = R['df_proc_global']
+    etapas['panel_benchmark_mercado'] = medir(lambda: benchmark_mercado(df_proc, 'Familia'), None, repeticiones)
+    etapas['panel_resumen_clientes'] = medir(lambda: resumen_clientes_cubo(familias_cubo(R['cubo'], {}), R['bench_familia']), None, repeticiones)
+    cadena = sorted(df_proc['Cliente'].unique())[:5]
+    etapas['panel_cadena'] = medir(
+        lambda: procesar_cadena_cascada(R['df_ventas_crudas'], cadena, "GRUPO", R['precios_base'], mapa_esc, mapa_equiv, indice), None, repeticiones)
+
+    tamano = {**params, 'lineas_base': len(df_base), 'lineas_ventas': len(df_ventas), 'equivalencias': len(mapa_equiv), 'lineas_cascada': len(df_proc)}
+    return {'tamano': tamano, 'etapas': etapas}
+
+# --- COMPARACIÓN ---
+def comparar(actual, anterior):
+    """Líneas 'escala / etapa: antes -> ahora (ratio)' con las medianas de dos ejecuciones."""
+    lineas = []
+    for escala, res in actual['escalas'].items():
+        previas = anterior.get('escalas', {}).get(escala, {}).get('etapas', {})
+        for etapa, t in res['etapas'].items():
+            if etapa not in previas: continue
+            antes, ahora = previas[etapa]['mediana_s'], t['mediana_s']
+            lineas.append(f"{escala} / {etapa}: {antes:.4f} s -> {ahora:.4f} s (x{ahora / antes if antes > 0 else float('nan'):.2f})")
+    return lineas
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks del motor de escandallos con datos sintéticos.")
+    parser.add_argument('--escalas', nargs='+', choices=list(ESCALAS), default=['pequena', 'media'])
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--procesos', type=int, default=PROCESOS_CASCADA, help="Procesos para la etapa de cascada en paralelo (1 la omite).")
+    parser.add_argument('--salida', help="Fichero JSON de resultados (por defecto, salida estándar).")
+    parser.add_argument('--comparar', help="JSON de una ejecución anterior con el que comparar las medianas.")
+    args = parser.parse_args(argv)
+
+    resultado = {
+        'meta': {'fecha': datetime.now().isoformat(timespec='seconds'), 'semilla': args.semilla, 'repeticiones': args.repeticiones,
+                 'python': platform.python_version(), 'procesos_cascada': args.procesos, 'pandas': pd.__version__, 'numpy': np.__version__, 'plataforma': platform.platform()},
+        'escalas': {},
+    }
+    for escala in args.escalas:
+        print(f"Midiendo escala '{escala}'...", file=sys.stderr)
+        resultado['escalas'][escala] = medir_escala(ESCALAS[escala], args.semilla, args.repeticiones, args.procesos)
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f: f.write(texto + "\n")
+    else: print(texto)
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f: anterior = json.load(f)
+        for linea in comparar(resultado, anterior): print(linea, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
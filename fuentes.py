@@ -0,0 +1,218 @@
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pyarrow as pa
+from motor import (
+    etapa, con_medicion, medicion_actual, limpiar_base, limpiar_equivalencias, limpiar_ventas,
+    construir_mapa_equivalencias, construir_indice_recetas,
+)
+
+# Carga de las fuentes (Google Sheets o ficheros locales) sin Streamlit: la usan app.py y el modo batch.
+
+# --- CONEXIÓN A GOOGLE SHEETS ---
+SCOPES_GOOGLE = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+    "https://www.googleapis.com/auth/drive.readonly"
+]
+
+def cliente_gspread(creds_dict):
+    """Cliente gspread autorizado con la cuenta de servicio creds_dict. gspread y google-auth solo hacen falta aquí."""
+    import gspread
+    from google.oauth2.service_account import Credentials
+    return gspread.authorize(Credentials.from_service_account_info(creds_dict, scopes=SCOPES_GOOGLE))
+
+def gid_de_url(url):
+    """Extrae el GID (Identificador de la pestaña) del enlace."""
+    return int(url.split("gid=")[-1].split("&")[0].split("#")[0]) if "gid=" in url else 0
+
+def id_spreadsheet(url):
+    return url.split("/d/")[1].split("/")[0]
+
+def valores_a_df(data):
+    """Convierte los datos brutos en un DataFrame de Pandas usando la primera fila como cabecera."""
+    if not data: return pd.DataFrame()
+    # values_batch_get recorta las celdas vacías al final de cada fila; se rellenan como hace get_all_values
+    ancho = max(len(fila) for fila in data)
+    data = [fila + [''] * (ancho - len(fila)) for fila in data]
+    return pd.DataFrame(data[1:], columns=data[0])
+
+def revision_spreadsheet(sheet):
+    """Fecha de última modificación del Spreadsheet (Drive modifiedTime), o None si no se puede consultar."""
+    try:
+        return str(sheet.get_lastUpdateTime() if hasattr(sheet, 'get_lastUpdateTime') else sheet.lastUpdateTime)
+    except Exception:
+        return None
+
+# --- ENLACES REALES DE DATOS PRIVADOS ---
+VENTAS_URL = 'https://docs.google.com/spreadsheets/d/1kyiTFjTl-XxkwhYQlm6FjMbnZWhNR4-AtW3iFj2qXzs/edit?gid=1543847315#gid=1543847315'
+BASE_URL = 'https://docs.google.com/spreadsheets/d/1nGSUQGspPnvkkSD0qmlYqhhfXAEAqbN1vm5DTPhaDkM/edit?gid=0#gid=0'
+EQUIV_URL = 'https://docs.google.com/spreadsheets/d/1nGSUQGspPnvkkSD0qmlYqhhfXAEAqbN1vm5DTPhaDkM/edit?gid=1911720872#gid=1911720872'
+
+# --- SNAPSHOTS LOCALES (ARROW IPC) ---
+# Cada fuente limpia se guarda en disco junto a la revisión de su Spreadsheet; mientras la hoja no cambie,
+# un reinicio o un worker nuevo la lee del snapshot (memory-mapped) en lugar de descargarla y limpiarla otra vez.
+SNAPSHOT_DIR = os.environ.get("ESCANDALLOS_SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".snapshots"))
+VERSION_SNAPSHOT = "1"  # Subir si cambia la limpieza de las fuentes para invalidar los snapshots existentes
+
+def ruta_snapshot(nombre):
+    return os.path.join(SNAPSHOT_DIR, f"{nombre}.arrow")
+
+def leer_snapshot(nombre, revision):
+    """Devuelve el DataFrame guardado si su revisión coincide con la actual; None en cualquier otro caso."""
+    ruta = ruta_snapshot(nombre)
+    if revision is None or not os.path.exists(ruta): return None
+    try:
+        with pa.memory_map(ruta, 'r') as fuente:
+            tabla = pa.ipc.open_file(fuente).read_all()
+        meta = tabla.schema.metadata or {}
+        if meta.get(b'revision', b'').decode() != revision or meta.get(b'version', b'').decode() != VERSION_SNAPSHOT: return None
+        df = tabla.to_pandas()
+        df.attrs = json.loads(meta.get(b'attrs', b'{}').decode())
+        return df
+    except Exception:
+        return None
+
+def guardar_snapshot(nombre, df, revision):
+    """Escribe el snapshot de forma atómica. Es una caché: si falla, se sigue sin ella."""
+    if revision is None: return
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        tabla = pa.Table.from_pandas(df)
+        tabla = tabla.replace_schema_metadata({
+            **(tabla.schema.metadata or {}), b'revision': revision.encode(), b'version': VERSION_SNAPSHOT.encode(),
+            b'attrs': json.dumps(df.attrs, default=str).encode()
+        })
+        ruta_tmp = ruta_snapshot(nombre) + f".{os.getpid()}.tmp"
+        with pa.OSFile(ruta_tmp, 'wb') as destino, pa.ipc.new_file(destino, tabla.schema) as escritor:
+            escritor.write_table(tabla)
+        os.replace(ruta_tmp, ruta_snapshot(nombre))
+    except Exception:
+        pass
+
+@etapa('load_spreadsheet_batch')
+def load_spreadsheet_batch(client, sid, fuentes, abierta=None):
+    """Abre un Spreadsheet una sola vez y trae todas sus pestañas pendientes en un único values_batch_get.
+    abierta = (revisión, Spreadsheet) ya consultados al comprobar revisiones: no se vuelven a abrir ni a consultar."""
+    resultados = {}
+    try:
+        revision, sheet = abierta if abierta is not None else (None, client.open_by_key(sid))
+        if abierta is None: revision = revision_spreadsheet(sheet)
+        pendientes = {}
+        for nombre, (url, limpiar) in fuentes.items():
+            df = leer_snapshot(nombre, revision)
+            if df is not None: resultados[nombre] = (df, None)
+            else: pendientes[nombre] = (url, limpiar)
+        if not pendientes: return resultados
+        titulos = {ws.id: ws.title for ws in sheet.worksheets()}
+        rangos = ["'" + titulos[gid_de_url(url)].replace("'", "''") + "'" for url, _ in pendientes.values()]
+        rangos_leidos = sheet.values_batch_get(rangos).get('valueRanges', [])
+    except Exception as e:
+        error = f"No se pudo acceder a la hoja. ¿Has compartido el Excel con el correo del Robot? Detalle técnico: {e}"
+        return {**resultados, **{nombre: (None, error) for nombre in fuentes if nombre not in resultados}}
+
+    for (nombre, (url, limpiar)), rango in zip(pendientes.items(), rangos_leidos):
+        try:
+            df = limpiar(valores_a_df(rango.get('values', [])))
+            guardar_snapshot(nombre, df, revision)
+            resultados[nombre] = (df, None)
+        except Exception as e:
+            resultados[nombre] = (None, str(e))
+    return resultados
+
+@etapa('load_sheets_batch')
+def load_sheets_batch(fuentes, client, abiertas=None):
+    """Carga varias fuentes {nombre: (url, limpiar)} agrupadas por Spreadsheet: una ida y vuelta por Spreadsheet, no por pestaña.
+    Los Spreadsheets se descargan y limpian en paralelo, así que la espera es la del más lento y no la suma.
+    abiertas: {sid: (revisión, Spreadsheet)} ya abiertos (ver load_spreadsheet_batch).
+    Devuelve {nombre: (df_limpio, None)} o {nombre: (None, mensaje_error)}."""
+    por_spreadsheet = {}
+    for nombre, (url, limpiar) in fuentes.items():
+        por_spreadsheet.setdefault(id_spreadsheet(url), {})[nombre] = (url, limpiar)
+    resultados = {}
+    with ThreadPoolExecutor(max_workers=max(len(por_spreadsheet), 1)) as pool:
+        cargar = con_medicion(medicion_actual(), load_spreadsheet_batch)
+        futuros = [pool.submit(cargar, client, sid, fuentes_sid, (abiertas or {}).get(sid)) for sid, fuentes_sid in por_spreadsheet.items()]
+        for futuro in futuros: resultados.update(futuro.result())
+    return resultados
+
+FUENTES_SHEETS = {'base': (BASE_URL, limpiar_base), 'equivalencias': (EQUIV_URL, limpiar_equivalencias), 'ventas': (VENTAS_URL, limpiar_ventas)}
+
+# --- RECARGA SELECTIVA ---
+# Al refrescar solo se consulta la revisión (Drive modifiedTime) de cada Spreadsheet; los que no han cambiado se toman
+# de la última carga en memoria. Sin modifiedTime la revisión es una marca única de la consulta y la hoja se descarga.
+# Los Spreadsheets abiertos en la consulta se guardan con su revisión para que la descarga no los abra otra vez.
+def revision_de_spreadsheet(client, sid, abiertas=None):
+    try:
+        sheet = client.open_by_key(sid)
+        revision = revision_spreadsheet(sheet)
+        if abiertas is not None and revision: abiertas[sid] = (revision, sheet)
+    except Exception: revision = None
+    return revision or f"consulta-{uuid.uuid4().hex}"
+
+def revisiones_spreadsheets(fuentes, client, abiertas=None):
+    """{id de Spreadsheet: revisión} de los Spreadsheets de las fuentes, consultados en paralelo. Con `abiertas`
+    ({sid: (revisión, Spreadsheet)}) deja ahí los Spreadsheets abiertos, para pasarlos a recargar_fuentes."""
+    sids = list(dict.fromkeys(id_spreadsheet(url) for url, _ in fuentes.values()))
+    with ThreadPoolExecutor(max_workers=max(len(sids), 1)) as pool:
+        consultar = con_medicion(medicion_actual(), revision_de_spreadsheet)
+        return dict(zip(sids, pool.map(lambda sid: consultar(client, sid, abiertas), sids)))
+
+def recargar_fuentes(fuentes, client, revisiones, memoria, abiertas=None):
+    """Como load_sheets_batch, pero los Spreadsheets cuya revisión coincide con la de `memoria` ({sid: (revisión,
+    {nombre: (df, error)})}) no se descargan. memoria se actualiza en sitio con las cargas sin errores. Los
+    Spreadsheets de `abiertas` con la misma revisión que `revisiones` se descargan sin volver a abrirlos."""
+    resultados, pendientes = {}, {}
+    for nombre, (url, limpiar) in fuentes.items():
+        sid = id_spreadsheet(url)
+        revision, previas = memoria.get(sid, (None, {}))
+        if revision == revisiones.get(sid) and nombre in previas: resultados[nombre] = previas[nombre]
+        else: pendientes[nombre] = (url, limpiar)
+    if not pendientes: return resultados
+    abiertas = {sid: abierta for sid, abierta in (abiertas or {}).items() if abierta[0] == revisiones.get(sid)}
+    resultados.update(load_sheets_batch(pendientes, client, abiertas))
+    for sid in {id_spreadsheet(url) for url, _ in pendientes.values()}:
+        del_spreadsheet = {nombre: resultados[nombre] for nombre, (url, _) in fuentes.items() if id_spreadsheet(url) == sid}
+        if all(err is None for _, err in del_spreadsheet.values()): memoria[sid] = (revisiones.get(sid), del_spreadsheet)
+    return resultados
+
+# --- FICHEROS LOCALES ---
+def leer_fichero(ruta):
+    """Hoja exportada a CSV, Excel o Parquet. CSV y Excel se leen como texto, igual que llegan de Google Sheets."""
+    ext = os.path.splitext(ruta)[1].lower()
+    if ext == '.parquet': return pd.read_parquet(ruta)
+    if ext in ('.xlsx', '.xls'): return pd.read_excel(ruta, dtype=str).fillna('')
+    return pd.read_csv(ruta, dtype=str, keep_default_na=False, sep=None, engine='python', encoding='utf-8-sig')
+
+def cargar_fuentes_locales(rutas, fuentes=FUENTES_SHEETS):
+    """Como load_sheets_batch pero desde ficheros {nombre: ruta}: {nombre: (df_limpio, None)} o {nombre: (None, error)}."""
+    resultados = {}
+    for nombre, ruta in rutas.items():
+        try: resultados[nombre] = (fuentes[nombre][1](leer_fichero(ruta)), None)
+        except Exception as e: resultados[nombre] = (None, f"{ruta}: {e}")
+    return resultados
+
+# --- PREPARACIÓN DE FUENTES ---
+# De (df_limpio, error) de cada fuente a lo que consume el motor, con los mensajes que ve el usuario.
+def preparar_equivalencias(df_e, err=None):
+    try:
+        if err: return {}, f"Error cargando equivalencias: {err}"
+        if df_e.empty: return {}, "El archivo de Equivalencias está vacío."
+        
+        if 'Código' in df_e.columns and 'Escandallo' in df_e.columns and 'Codigo_Principal' in df_e.columns:
+            return construir_mapa_equivalencias(df_e), None
+        return {}, "Faltan columnas clave (Código, Escandallo, Codigo Principal) en Equivalencias."
+    except Exception as e:
+        return {}, f"Error cargando equivalencias: {e}"
+
+def preparar_base(df_calc, err=None):
+    """(base, índice de recetas, error)."""
+    if err: return None, None, f"Error conectando a Base de Datos: {err}"
+    if df_calc.empty: return None, None, "La base de datos principal está vacía."
+    return df_calc, construir_indice_recetas(df_calc), None
+
+def preparar_ventas(df_v, err=None):
+    if err: return None, f"Error cargando ventas: {err}"
+    if df_v.empty: return pd.DataFrame(), None
+    return df_v, None
@@ -0,0 +1,1230 @@
+import pandas as pd
+import numpy as np
+import functools
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime
+
+# --- MEDICIÓN DE ETAPAS ---
+# Cada ejecución (un rerun de la app, un cálculo batch...) abre una medición en su hilo; las etapas que corren
+# dentro (funciones con @etapa o bloques con medir_etapa) dejan en ella su tiempo, filas de entrada/salida y si
+# salieron de caché. Fuera de una medición solo se actualizan los contadores acumulados del proceso.
+CONTADORES_ETAPAS = {}
+_lock_contadores = threading.Lock()
+_hilo = threading.local()
+
+def medicion_actual():
+    return getattr(_hilo, 'medicion', None)
+
+def iniciar_medicion(etiqueta):
+    """Abre una medición en este hilo (cerrando la anterior si quedó abierta) y la devuelve."""
+    _hilo.medicion = {'id': uuid.uuid4().hex[:8], 'etiqueta': etiqueta, 'inicio': datetime.now().isoformat(timespec='seconds'),
+                      't0': time.perf_counter(), 'segundos': None, 'etapas': []}
+    _hilo.abiertas = []
+    return _hilo.medicion
+
+def cerrar_medicion():
+    medicion = medicion_actual()
+    if medicion is not None: medicion['segundos'] = time.perf_counter() - medicion['t0']
+    _hilo.medicion = None
+    return medicion
+
+def con_medicion(medicion, funcion):
+    """funcion preparada para ejecutarse en otro hilo (p. ej. un ThreadPoolExecutor) registrando en `medicion`."""
+    @functools.wraps(funcion)
+    def envoltura(*args, **kwargs):
+        _hilo.medicion, _hilo.abiertas = medicion, []
+        try: return funcion(*args, **kwargs)
+        finally: _hilo.medicion = None
+    return envoltura
+
+def filas_de(valor):
+    """Filas de un DataFrame, o del primero que haya en una tupla/lista de resultados; None si no hay."""
+    if isinstance(valor, (pd.DataFrame, pd.Series)): return len(valor)
+    if isinstance(valor, (tuple, list)): return next((len(v) for v in valor if isinstance(v, (pd.DataFrame, pd.Series))), None)
+    return None
+
+def anotar_cache(acierto):
+    """Marca la etapa abierta más interna de este hilo como acierto o fallo de caché."""
+    abiertas = getattr(_hilo, 'abiertas', None)
+    if abiertas: abiertas[-1]['cache'] = 'acierto' if acierto else 'fallo'
+
+@contextmanager
+def medir_etapa(nombre, filas_entrada=None):
+    """Mide el bloque como etapa `nombre`; el registro cedido admite 'filas_salida' y 'cache'."""
+    medicion = medicion_actual()
+    abiertas = getattr(_hilo, 'abiertas', None)
+    if abiertas is None: abiertas = _hilo.abiertas = []
+    registro = {'etapa': nombre, 'nivel': len(abiertas), 'filas_entrada': filas_entrada, 'filas_salida': None, 'cache': None}
+    abiertas.append(registro)
+    t0 = time.perf_counter()
+    try:
+        yield registro
+    finally:
+        registro['segundos'] = time.perf_counter() - t0
+        abiertas.pop()
+        if medicion is not None:
+            registro['desde_inicio'] = t0 - medicion['t0']
+            medicion['etapas'].append(registro)
+        with _lock_contadores:
+            c = CONTADORES_ETAPAS.setdefault(nombre, {'llamadas': 0, 'segundos': 0.0, 'aciertos': 0, 'fallos': 0})
+            c['llamadas'] += 1
+            c['segundos'] += registro['segundos']
+            if registro['cache'] == 'acierto': c['aciertos'] += 1
+            elif registro['cache'] == 'fallo': c['fallos'] += 1
+
+def etapa(nombre, cache=None):
+    """Decorador que mide cada llamada como etapa `nombre` (filas del primer DataFrame de entrada y del resultado).
+    cache es un decorador de memoización (p. ej. st.cache_data(ttl=600)): se aplica a la función y cada llamada se
+    anota como acierto, salvo que el cuerpo llegue a ejecutarse."""
+    def decorador(funcion):
+        calcular = funcion
+        if cache is not None:
+            @functools.wraps(funcion)
+            def ejecutar(*args, **kwargs):
+                anotar_cache(False)
+                return funcion(*args, **kwargs)
+            calcular = cache(ejecutar)
+
+        @functools.wraps(funcion)
+        def medida(*args, **kwargs):
+            with medir_etapa(nombre, filas_de(list(args))) as registro:
+                if cache is not None: registro['cache'] = 'acierto'
+                resultado = calcular(*args, **kwargs)
+                registro['filas_salida'] = filas_de(resultado)
+            return resultado
+        if hasattr(calcular, 'clear'): medida.clear = calcular.clear
+        return medida
+    return decorador
+
+def tabla_mediciones(mediciones):
+    """Una fila por etapa medida de cada medición, para mostrar o exportar a CSV."""
+    filas = [{'ejecucion': m['id'], 'etiqueta': m['etiqueta'], 'inicio': m['inicio'], 'segundos_ejecucion': m['segundos'], **r}
+             for m in mediciones for r in m['etapas']]
+    columnas = ['ejecucion', 'etiqueta', 'inicio', 'segundos_ejecucion', 'etapa', 'nivel', 'desde_inicio', 'segundos', 'filas_entrada', 'filas_salida', 'cache']
+    return pd.DataFrame(filas, columns=columnas).astype({'filas_entrada': 'Int64', 'filas_salida': 'Int64'})
+
+# --- FUNCIONES DE LIMPIEZA Y FORMATO ---
+def clean_european_column(serie):
+    """Números con formato europeo ('1.234,5') a float; vacías e ilegibles a 0.0 y los números se conservan.
+    Devuelve (valores, nº de celdas no vacías que no se pudieron leer)."""
+    if pd.api.types.is_numeric_dtype(serie): return serie.astype(float).fillna(0.0), 0
+    es_num = None
+    if pd.api.types.infer_dtype(serie, skipna=True) not in ('string', 'empty'):
+        es_num = serie.map(lambda x: isinstance(x, (int, float)) and not pd.isna(x)).astype(bool)
+    texto = (serie if es_num is None else serie.where(~es_num)).astype(str).str.strip()
+    vacias = serie.isna() | (texto == '')
+    valores = pd.to_numeric(texto.str.replace('.', '', regex=False).str.replace(',', '.', regex=False), errors='coerce')
+    if es_num is not None and es_num.any():
+        valores = valores.where(~es_num, pd.to_numeric(serie.where(es_num), errors='coerce'))
+    fallos = int((valores.isna() & ~vacias).sum())
+    return valores.fillna(0.0).astype(float), fallos
+
+def formato_europeo(val, decimales=2, sufijo=""):
+    if pd.isna(val) or val == np.inf or val == -np.inf: return "0" + sufijo
+    formateado = f"{val:,.{decimales}f}".replace(',', 'X').replace('.', ',').replace('X', '.')
+    return formateado + sufijo
+
+SEPARADORES_EUROPEOS = str.maketrans({',': '.', '.': ','})
+
+def formateador_europeo(decimales=2, sufijo="", con_signo=False):
+    """formato_europeo como función de un valor, para Styler.format."""
+    return lambda x: ("+" if con_signo and pd.notna(x) and np.isfinite(x) and x > 0 else "") + formato_europeo(x, decimales, sufijo)
+
+def formato_europeo_columna(serie, decimales=2, sufijo="", con_signo=False):
+    """formato_europeo de una columna entera de una pasada (con_signo antepone '+' a los positivos)."""
+    serie = pd.Series(serie)
+    valores = pd.to_numeric(serie, errors='coerce').to_numpy(dtype=float)
+    validos = np.isfinite(valores)
+    if not len(valores): return pd.Series([], index=serie.index, dtype=object)
+    # Todo se formatea como un único bloque de texto y los separadores se cambian con una sola traducción;
+    # el sufijo entra ya traducido para que la traducción lo deje como estaba.
+    fin = sufijo.translate(SEPARADORES_EUROPEOS) + "\n"
+    bloque = (fin.join(map(f"{{:,.{decimales}f}}".format, np.where(validos, valores, 0.0).tolist())) + fin).translate(SEPARADORES_EUROPEOS)
+    texto = pd.Series(bloque.split("\n")[:-1], index=serie.index, dtype=object).where(validos, "0" + sufijo)
+    if con_signo:
+        positivos = validos & (valores > 0)
+        texto[positivos] = "+" + texto[positivos]
+    return texto
+
+@etapa('recalcular_dataframe')
+def recalcular_dataframe(df):
+    if 'Cantidad(kg)' in df.columns and 'Escandallo' in df.columns:
+        df['Total_Kg_Grupo'] = df.groupby('Escandallo')['Cantidad(kg)'].transform('sum')
+        df['%_Calculado'] = np.where(df['Total_Kg_Grupo'] > 0, df['Cantidad(kg)'] / df['Total_Kg_Grupo'], 0.0)
+
+    cols_calc = ['Precio EXW', 'Coste_congelación', 'Coste_despiece', '%_Calculado']
+    if all(c in df.columns for c in cols_calc):
+        df['Precio_escandallo_Calculado'] = (df['Precio EXW'] - df['Coste_congelación'] - df['Coste_despiece']) * df['%_Calculado']
+    return df
+
+# --- CODIFICACIÓN DE CLAVES ---
+# El motor trabaja con ids int32 de clientes y códigos sobre vocabularios ordenados y compartidos: los joins,
+# groupbys y búsquedas van sobre enteros y el texto solo se recupera al construir los resultados.
+def vocabulario(*columnas):
+    """Vocabulario ordenado (pd.Index) de los valores de texto de una o varias columnas; el id de un valor es su posición."""
+    valores = [np.asarray(pd.Series(c, dtype=object).dropna().astype(str), dtype=object) for c in columnas]
+    return pd.Index(np.unique(np.concatenate(valores)) if valores else [], dtype=object)
+
+def codificar(valores, vocab):
+    """Ids int32 de valores en vocab (-1 si no están)."""
+    return vocab.get_indexer(pd.Index(valores, dtype=object)).astype(np.int32)
+
+def tabla_por_codigo(mapa, vocab, defecto=np.nan, dtype=float):
+    """Array indexado por id de código con los valores de un dict {código: valor}; defecto donde no hay valor."""
+    tabla = np.full(len(vocab), defecto, dtype=dtype)
+    if mapa:
+        ids = codificar(list(mapa.keys()), vocab)
+        tabla[ids[ids >= 0]] = np.asarray(list(mapa.values()), dtype=dtype)[ids >= 0]
+    return tabla
+
+def vocabularios_cascada(df_v, indice_recetas=None):
+    """Vocabularios de clientes y códigos para la cascada: códigos de venta y de receta, tal cual y sin espacios."""
+    codigos = [df_v['Código'].astype(str), df_v['Código'].astype(str).str.strip()]
+    if indice_recetas is not None:
+        codigos += [indice_recetas['codigos'], indice_recetas['matriz']['codigos']]
+    return {'Cliente': vocabulario(df_v['Cliente']), 'Código': vocabulario(*codigos)}
+
+# --- ÍNDICE DE RECETAS ---
+CAMPOS_INDICE = ('filas', 'codigos', 'nombres', 'familias', 'pct', 'coste_cong', 'coste_desp', 'precio_exw')
+
+def construir_indice_recetas(df):
+    """Compila la base en bloques contiguos por Escandallo, de modo que cada receta es un acceso a dict más un slice."""
+    n = len(df)
+    grupo = df.groupby('Escandallo', sort=False).ngroup().to_numpy() if 'Escandallo' in df.columns and n else np.full(n, -1)
+    filas = np.argsort(grupo, kind='stable')
+    filas = filas[grupo[filas] >= 0]
+    n_bloques = int(grupo.max()) + 1 if n else 0
+    offsets = np.zeros(n_bloques + 1, dtype=np.int64)
+    np.cumsum(np.bincount(grupo[filas], minlength=n_bloques), out=offsets[1:])
+    col = lambda c, defecto: (df[c].to_numpy() if c in df.columns else np.full(n, defecto))[filas]
+
+    escandallos = df['Escandallo'].to_numpy()[filas[offsets[:-1]]] if n_bloques else np.array([], dtype=object)
+    indice = {
+        'escandallos': escandallos, 'bloques': {esc: g for g, esc in enumerate(escandallos)}, 'offsets': offsets,
+        'filas': filas, 'codigos': col('Código', '').astype(str), 'nombres': col('Nombre', '').astype(object),
+        'familias': col('Familia', '').astype(object), 'pct': col('%_Calculado', 0.0).astype(float),
+        'coste_cong': col('Coste_congelación', 0.0).astype(float), 'coste_desp': col('Coste_despiece', 0.0).astype(float),
+        'precio_exw': col('Precio EXW', 0.0).astype(float)
+    }
+
+    # Principales: primera línea 'Principal' de cada código (en el orden de la hoja) -> (escandallo, offset en el bloque)
+    principales, principal_de = {}, {}
+    if 'Tipo' in df.columns and n:
+        pos_ordenada = np.full(n, -1, dtype=np.int64)
+        pos_ordenada[filas] = np.arange(len(filas))
+        es_princ = df['Tipo'].str.contains('Principal', case=False, na=False).to_numpy() & (grupo >= 0)
+        df_pr = pd.DataFrame({'Código': df['Código'].astype(str).to_numpy()[es_princ], 'Grupo': grupo[es_princ]})
+        df_pr['Offset'] = pos_ordenada[es_princ] - offsets[df_pr['Grupo'].to_numpy()]
+        por_codigo = df_pr.drop_duplicates('Código')
+        principales = dict(zip(por_codigo['Código'], zip(escandallos[por_codigo['Grupo'].to_numpy()], por_codigo['Offset'].tolist())))
+        por_esc = df_pr.drop_duplicates('Grupo')
+        principal_de = dict(zip(escandallos[por_esc['Grupo'].to_numpy()], por_esc['Código']))
+    indice['principales'] = principales
+    indice['principal_de'] = principal_de
+    indice['matriz'] = matriz_rendimientos(indice)
+    return indice
+
+def bloque_receta(indice, esc_id):
+    """Líneas de un escandallo como slices de los arrays del índice, o None si no existe."""
+    g = indice['bloques'].get(esc_id) if indice else None
+    if g is None: return None
+    ini, fin = indice['offsets'][g], indice['offsets'][g + 1]
+    return {campo: indice[campo][ini:fin] for campo in CAMPOS_INDICE}
+
+# --- MATRIZ DE RENDIMIENTOS ---
+# Las recetas del índice como matriz dispersa escandallo x código en CSR: la fila g es el bloque g del índice (indptr
+# = offsets), la columna de cada línea su código sin espacios y el dato su %_Calculado, con el coste (congelación +
+# despiece) y el Precio EXW teórico por línea al lado. El Precio a CP de todos los escandallos con un vector de precios
+# por código es un producto matriz-vector; con varios vectores (p. ej. uno por cliente) se evalúan por lotes. El
+# ranking del simulador suma igual las aportaciones con el precio de cada línea, y la cascada usa la misma aportación
+# por línea con el precio resuelto P1/P2/P3 de cada venta.
+TAM_LOTE_MATRIZ = 64
+
+def matriz_rendimientos(indice):
+    """CSR {'indptr', 'columnas', 'rendimientos', 'coste', 'precio_teorico', 'codigos'} de las recetas del índice;
+    'codigos' es el vocabulario ordenado de las columnas."""
+    columnas, codigos = pd.factorize(pd.Series(indice['codigos'], dtype=object).str.strip(), sort=True)
+    return {'indptr': indice['offsets'], 'columnas': columnas.astype(np.int64), 'rendimientos': indice['pct'],
+            'coste': indice['coste_cong'] + indice['coste_desp'], 'precio_teorico': indice['precio_exw'],
+            'codigos': pd.Index(codigos, dtype=object)}
+
+def columnas_en(matriz, vocab_cod):
+    """Id en vocab_cod del código de cada línea de la matriz (-1 si no está)."""
+    return codificar(matriz['codigos'], vocab_cod)[matriz['columnas']]
+
+def aportaciones(matriz, lineas, precio_linea):
+    """Aportación a CP de las líneas indicadas con su precio: (precio - coste) x rendimiento."""
+    return (precio_linea - matriz['coste'][lineas]) * matriz['rendimientos'][lineas]
+
+def lineas_de(matriz, grupos):
+    """Posiciones de las líneas de las filas (escandallos) indicadas, seguidas, y dónde empieza cada fila entre ellas."""
+    grupos = np.asarray(grupos, dtype=np.int64)
+    ini, n = matriz['indptr'][grupos], np.diff(matriz['indptr'])[grupos]
+    inicios = np.cumsum(n) - n
+    return np.repeat(ini - inicios, n) + np.arange(n.sum()), inicios
+
+def sumar_filas(valores, inicios):
+    """Suma por escandallo de valores por línea (en el último eje). Los bloques del índice nunca están vacíos."""
+    if not len(inicios): return np.zeros(valores.shape[:-1] + (0,))
+    return np.add.reduceat(valores, inicios, axis=-1)
+
+def precio_cp_escandallos(matriz, precios):
+    """Precio a CP de todos los escandallos (en el orden del índice) con precios por columna de la matriz:
+    (n_codigos,) -> (n_escandallos,) o (k, n_codigos) -> (k, n_escandallos). Las líneas sin precio (NaN) usan su
+    Precio EXW teórico."""
+    precios = np.asarray(precios, dtype=float)
+    lotes = np.atleast_2d(precios)
+    lineas = np.arange(len(matriz['columnas']))
+    resultado = np.empty((len(lotes), len(matriz['indptr']) - 1))
+    for ini in range(0, len(lotes), TAM_LOTE_MATRIZ):
+        precio_linea = lotes[ini:ini + TAM_LOTE_MATRIZ][:, matriz['columnas']]
+        precio_linea = np.where(np.isnan(precio_linea), matriz['precio_teorico'], precio_linea)
+        resultado[ini:ini + TAM_LOTE_MATRIZ] = sumar_filas(aportaciones(matriz, lineas, precio_linea), matriz['indptr'][:-1])
+    return resultado[0] if precios.ndim == 1 else resultado
+
+def vector_precios(matriz, precios_por_codigo):
+    """Vector por columna de la matriz a partir de {código: precio} (o Series); NaN donde no hay precio."""
+    return tabla_por_codigo(dict(precios_por_codigo), matriz['codigos'])
+
+@etapa('precio_cp_por_cliente')
+def precio_cp_por_cliente(matriz, precios, clientes):
+    """Precio a CP de todos los escandallos para cada cliente (ids de precios['vocabularios']['Cliente']) con la
+    prioridad de la cascada P1 -> P2 -> P3 en cada línea: array (n_clientes, n_escandallos), por lotes de clientes."""
+    cod = codificar(matriz['codigos'], precios['vocabularios']['Código']).astype(np.int64)
+    mercado = np.full(len(cod), np.nan)
+    mercado[cod >= 0] = precios['mercado'][cod[cod >= 0]]
+    columna_de = np.full(len(precios['vocabularios']['Código']), -1, dtype=np.int64)
+    columna_de[cod[cod >= 0]] = np.flatnonzero(cod >= 0)
+    banco, n_cod = precios['banco'], precios['banco']['n_cod']
+    clientes = np.asarray(clientes, dtype=np.int64)
+    resultado = np.empty((len(clientes), len(matriz['indptr']) - 1))
+    for ini in range(0, len(clientes), TAM_LOTE_MATRIZ):
+        lote = clientes[ini:ini + TAM_LOTE_MATRIZ]
+        tabla = np.tile(mercado, (len(lote), 1))
+        # P1: las entradas del banco de cada cliente del lote (claves ordenadas por cliente) pisan la media de mercado
+        desde, hasta = np.searchsorted(banco['claves'], lote * n_cod), np.searchsorted(banco['claves'], (lote + 1) * n_cod)
+        n = hasta - desde
+        fila = np.repeat(np.arange(len(lote)), n)
+        pos = np.repeat(desde - (np.cumsum(n) - n), n) + np.arange(n.sum())
+        col, precio = columna_de[banco['claves'][pos] % n_cod], banco['precio'][pos]
+        hay = (col >= 0) & ~np.isnan(precio)
+        tabla[fila[hay], col[hay]] = precio[hay]
+        resultado[ini:ini + len(lote)] = precio_cp_escandallos(matriz, tabla)
+    return resultado
+
+def precio_cp_simulador(df, indice, escandallos=None):
+    """Precio a CP de los escandallos indicados (todos si no se indican) con el Precio EXW de cada línea de df, un
+    simulador alineado con la base del índice. Series por Escandallo."""
+    matriz = indice['matriz']
+    if escandallos is None: grupos = np.arange(len(indice['escandallos']))
+    else: grupos = np.array([indice['bloques'][e] for e in dict.fromkeys(escandallos) if e in indice['bloques']], dtype=np.int64)
+    lineas, inicios = lineas_de(matriz, grupos)
+    precio_linea = df['Precio EXW'].to_numpy(dtype=float)[indice['filas'][lineas]]
+    return pd.Series(sumar_filas(aportaciones(matriz, lineas, precio_linea), inicios),
+                     index=pd.Index(indice['escandallos'][grupos], name='Escandallo'), name='Precio_escandallo_Calculado')
+
+# --- CAPAS DE PRECIO DEL SIMULADOR ---
+# El simulador parte del Precio EXW teórico de la hoja y aplica encima capas de precio en orden; cada capa pisa
+# a las anteriores allí donde tiene precio y deja su nombre en ORIGEN_PRECIO.
+ORIGEN_TEORICO, ORIGEN_VENTA_REAL, ORIGEN_MANUAL = 'Teórico', 'Venta Real', 'Simulado Manual'
+
+def aplicar_capas_precio(df, capas):
+    """capas: lista de (origen, precios). precios es {código: precio} o {(escandallo, código): precio} (o Series equivalente)."""
+    df['ORIGEN_PRECIO'] = ORIGEN_TEORICO
+    codigos = df['Código'].astype(str)
+    for origen, precios in capas:
+        precios = precios if isinstance(precios, pd.Series) else pd.Series(precios, dtype=float)
+        if precios.empty: continue
+        if precios.index.nlevels == 2:
+            nuevos = precios.reindex(pd.MultiIndex.from_arrays([df['Escandallo'], codigos])).to_numpy()
+        else:
+            nuevos = codigos.map(precios).to_numpy(dtype=float)
+        hay_precio = ~np.isnan(nuevos)
+        df['Precio EXW'] = np.where(hay_precio, nuevos, df['Precio EXW'].to_numpy())
+        df.loc[hay_precio, 'ORIGEN_PRECIO'] = origen
+    return df
+
+# --- SIMULADOR INCREMENTAL ---
+COLS_INFO_RANKING = ['Escandallo', 'Código', 'Nombre', '%_Calculado', 'Precio EXW', 'ORIGEN_PRECIO']
+
+def filas_escandallos(indice, escandallos):
+    """Posiciones (iloc) de todas las líneas de los escandallos indicados, una vez aunque se repitan."""
+    bloques = [bloque_receta(indice, esc) for esc in dict.fromkeys(escandallos)]
+    bloques = [b['filas'] for b in bloques if b is not None]
+    return np.concatenate(bloques) if bloques else np.array([], dtype=np.int64)
+
+def recalcular_escandallos(df, indice, escandallos):
+    """recalcular_dataframe limitado a las líneas de los escandallos indicados: O(líneas de esas recetas), no O(base)."""
+    filas = filas_escandallos(indice, escandallos)
+    if not len(filas): return df
+    df_sub = recalcular_dataframe(df.iloc[filas].copy())
+    cols = [c for c in ('Total_Kg_Grupo', '%_Calculado', 'Precio_escandallo_Calculado') if c in df_sub.columns]
+    df.iloc[filas, [df.columns.get_loc(c) for c in cols]] = df_sub[cols].to_numpy()
+    return df
+
+def construir_ranking_simulador(df, indice=None):
+    """Una fila por Escandallo: Precio a CP simulado (suma de sus líneas) y datos de su línea principal. Con el índice
+    de recetas (df alineado con su base) el Precio a CP sale de la matriz de rendimientos."""
+    cols_info = [c for c in COLS_INFO_RANKING if c in df.columns]
+    df_rank = precio_cp_simulador(df, indice) if indice is not None else df.groupby('Escandallo')['Precio_escandallo_Calculado'].sum()
+    es_princ = df['Tipo'].str.contains('Principal', case=False, na=False) if 'Tipo' in df.columns else pd.Series(False, index=df.index)
+    df_pr = df.loc[es_princ, cols_info] if es_princ.any() else df.groupby('Escandallo', as_index=False)[cols_info[1:]].first()
+    df_suma = df_pr.groupby('Escandallo')['%_Calculado'].sum()
+    cols_desc = [c for c in cols_info if c != '%_Calculado' and c != 'Escandallo']
+    df_desc = df_pr.groupby('Escandallo')[cols_desc].first()
+    return pd.concat([df_rank.reindex(df_suma.index), df_suma, df_desc], axis=1, join='inner')
+
+def actualizar_ranking_simulador(ranking, df, indice, escandallos):
+    """Reescribe en sitio solo las filas del ranking de los escandallos indicados."""
+    df_parcial = construir_ranking_simulador(df.iloc[filas_escandallos(indice, escandallos)])
+    df_parcial['Precio_escandallo_Calculado'] = precio_cp_simulador(df, indice, escandallos)
+    comunes = df_parcial.index.intersection(ranking.index)
+    ranking.loc[comunes, df_parcial.columns] = df_parcial.loc[comunes]
+    return ranking
+
+def editar_simulador(df, ranking, indice, cambios):
+    """Aplica en sitio precios manuales [(escandallo, código, precio)] al simulador y a su ranking, recalculando solo los
+    escandallos tocados. Devuelve los precios aplicados como {(escandallo, código): precio}."""
+    aplicados, escandallos = {}, []
+    for esc, cod, precio in cambios:
+        bloque = bloque_receta(indice, esc)
+        if bloque is None: continue
+        filas = bloque['filas'][bloque['codigos'] == str(cod)]
+        df.iloc[filas, df.columns.get_loc('Precio EXW')] = float(precio)
+        if 'ORIGEN_PRECIO' in df.columns: df.iloc[filas, df.columns.get_loc('ORIGEN_PRECIO')] = ORIGEN_MANUAL
+        aplicados[(esc, str(cod))] = float(precio)
+        escandallos.append(esc)
+    recalcular_escandallos(df, indice, escandallos)
+    actualizar_ranking_simulador(ranking, df, indice, escandallos)
+    return aplicados
+
+# --- TABLAS DE PRECIOS Y BANCO DE KILOS ---
+# Precios y stock de la cascada en arrays contiguos en vez de dicts anidados: el banco es CSR por cliente (claves
+# cli_id * n_códigos + cod_id ordenadas) y la media de mercado (P2) un array por id de código. Consultas y
+# descuentos van por lotes de (cliente, código). Cada tabla lleva una 'version' única para las cachés que dependen de ella.
+def construir_banco(cli, cod, kilos, precio, nombre, n_cod):
+    """Banco de kilos y precio P1 por (cliente, código); si una clave se repite gana la última fila."""
+    claves = np.asarray(cli, dtype=np.int64) * n_cod + np.asarray(cod, dtype=np.int64)
+    orden = np.argsort(claves, kind='stable')
+    orden = orden[np.r_[claves[orden][1:] != claves[orden][:-1], True]] if len(orden) else orden
+    return {'claves': claves[orden], 'kilos': np.asarray(kilos, dtype=float)[orden].copy(),
+            'precio': np.asarray(precio, dtype=float)[orden], 'nombre': np.asarray(nombre, dtype=object)[orden], 'n_cod': n_cod}
+
+def posiciones_banco(banco, cli, cod):
+    """Posición en el banco de cada (cliente, código) del lote; -1 si no tiene entrada."""
+    cli, cod = np.asarray(cli, dtype=np.int64), np.asarray(cod, dtype=np.int64)
+    claves = cli * banco['n_cod'] + cod
+    if not len(banco['claves']): return np.full(len(claves), -1)
+    pos = np.minimum(np.searchsorted(banco['claves'], claves), len(banco['claves']) - 1)
+    return np.where((cli >= 0) & (cod >= 0) & (banco['claves'][pos] == claves), pos, -1)
+
+def consultar_banco(banco, cli, cod, campo='precio'):
+    """Gather por lotes de un campo numérico del banco; NaN donde no hay entrada."""
+    pos = posiciones_banco(banco, cli, cod)
+    valores = np.full(len(pos), np.nan)
+    valores[pos >= 0] = banco[campo][pos[pos >= 0]]
+    return valores
+
+def descontar_banco(banco, cli, cod, cantidades):
+    """Resta en sitio los kilos consumidos por lotes de (cliente, código); los que no están en el banco se ignoran."""
+    pos = posiciones_banco(banco, cli, cod)
+    np.subtract.at(banco['kilos'], pos[pos >= 0], np.asarray(cantidades, dtype=float)[pos >= 0])
+    return banco
+
+ORIGENES_CASCADA = {1: "🥇 Venta a este cliente (P1)", 2: "🥈 Media del mercado (P2)", 3: "🥉 Precio teórico (P3)"}
+
+def resolver_precios(precios, cli, cod, precio_teorico):
+    """Precio de cada (cliente, código) del lote por prioridad: P1 venta al cliente, P2 media de mercado, P3 teórico.
+    Devuelve (precio, nivel) con nivel 1, 2 o 3."""
+    cod = np.asarray(cod, dtype=np.int64)
+    p1 = consultar_banco(precios['banco'], cli, cod)
+    p2 = np.full(len(cod), np.nan)
+    p2[cod >= 0] = precios['mercado'][cod[cod >= 0]]
+    nivel = np.where(~np.isnan(p1), 1, np.where(~np.isnan(p2), 2, 3))
+    return np.select([nivel == 1, nivel == 2], [p1, p2], np.asarray(precio_teorico, dtype=float)), nivel
+
+def media_mercado_dict(precios):
+    """P2 como {código: precio}, para las capas del simulador."""
+    hay = ~np.isnan(precios['mercado'])
+    return dict(zip(precios['vocabularios']['Código'][hay], precios['mercado'][hay]))
+
+def tabla_precios_de_dicts(global_avg, client_avg):
+    """Tabla de precios a partir de los dicts del motor iterativo (sin kilos ni nombres)."""
+    pares = [(cli, cod, p) for cli, precios_cli in client_avg.items() for cod, p in precios_cli.items()]
+    vocabularios = {'Cliente': vocabulario(list(client_avg)), 'Código': vocabulario(list(global_avg), [cod for _, cod, _ in pares])}
+    cli = codificar([cli for cli, _, _ in pares], vocabularios['Cliente'])
+    cod = codificar([cod for _, cod, _ in pares], vocabularios['Código'])
+    banco = construir_banco(cli, cod, np.zeros(len(pares)), [p for _, _, p in pares], np.full(len(pares), '', dtype=object), len(vocabularios['Código']))
+    return {'vocabularios': vocabularios, 'mercado': tabla_por_codigo(global_avg, vocabularios['Código']), 'banco': banco, 'version': uuid.uuid4().hex}
+
+# --- MOTOR MRP ---
+# "vectorizado" resuelve la cascada con joins y groupbys; "iterativo" conserva el bucle original como referencia.
+MOTOR_CASCADA = "vectorizado"
+COLS_CASCADA = ['Cliente', 'Código', 'Artículo', 'Familia', 'Kilos', 'Kilos_CP', 'Precio EXW', 'Precio_CP_Unitario', 'Precio_CP_Total']
+
+@etapa('procesar_ventas_cascada')
+def procesar_ventas_cascada(df_v, df_esc_completo, mapa_esc_principal, mapa_equiv, esc_to_princ, indice_recetas=None, vocabularios=None):
+    """Devuelve (df_final, global_avg, precios): precios es la tabla de precios y banco de kilos (ver resolver_precios)."""
+    if MOTOR_CASCADA == "iterativo":
+        df_final, global_avg, client_avg = procesar_ventas_cascada_iterativo(df_v, df_esc_completo, mapa_esc_principal, mapa_equiv, esc_to_princ)
+        return df_final, global_avg, tabla_precios_de_dicts(global_avg, client_avg)
+    return procesar_ventas_cascada_vectorizado(df_v, df_esc_completo, mapa_esc_principal, mapa_equiv, esc_to_princ, indice_recetas, vocabularios)
+
+def procesar_ventas_cascada_iterativo(df_v, df_esc_completo, mapa_esc_principal, mapa_equiv, esc_to_princ):
+    df_v_agrupado = df_v.groupby(['Cliente', 'Código', 'Nombre']).agg({'Kilos': 'sum', 'Precio EXW': 'mean'}).reset_index()
+    
+    global_avg = {}
+    for cod, grp in df_v_agrupado.groupby('Código'):
+        tot_k = grp['Kilos'].sum()
+        if tot_k > 0: global_avg[str(cod)] = (grp['Kilos'] * grp['Precio EXW']).sum() / tot_k
+
+    client_avg = {}
+    banco_kilos = {} 
+    
+    for cli, grp_cli in df_v_agrupado.groupby('Cliente'):
+        cli_str = str(cli)
+        client_avg[cli_str] = {}
+        banco_kilos[cli_str] = {}
+        for _, row in grp_cli.iterrows():
+            cod = str(row['Código'])
+            client_avg[cli_str][cod] = row['Precio EXW']
+            banco_kilos[cli_str][cod] = {'kilos': float(row['Kilos']), 'precio': float(row['Precio EXW']), 'nombre': str(row['Nombre'])}
+
+    ventas_procesadas = []
+
+    for _, row in df_v_agrupado.iterrows():
+        cli = str(row['Cliente'])
+        cod_vendido = str(row['Código']).strip()
+        kilos_cliente = float(row['Kilos'])
+        precio_cliente = float(row['Precio EXW'])
+        nombre_articulo = str(row['Nombre'])
+
+        esc_id = None
+        cod_principal_teorico = None
+        
+        if cod_vendido in mapa_esc_principal:
+            esc_id = mapa_esc_principal[cod_vendido]
+            cod_principal_teorico = cod_vendido
+        elif cod_vendido in mapa_equiv:
+            esc_id = mapa_equiv[cod_vendido][0]
+            cod_principal_teorico = mapa_equiv[cod_vendido][1]
+
+        if esc_id is not None and cod_principal_teorico is not None:
+            df_bloque_esc = df_esc_completo[df_esc_completo['Escandallo'] == esc_id]
+            if not df_bloque_esc.empty:
+                fam_temp = df_bloque_esc['Familia'].iloc[0] if 'Familia' in df_bloque_esc.columns else "Sin clasificar"
+                if pd.isna(fam_temp) or str(fam_temp).strip() == "": fam_temp = "Sin clasificar"
+                
+                fila_principal = df_bloque_esc[df_bloque_esc['Código'].astype(str) == cod_principal_teorico]
+                pct_principal = fila_principal['%_Calculado'].iloc[0] if not fila_principal.empty else 0.0
+                kilos_cp = (kilos_cliente / pct_principal) if pct_principal > 0 else 0.0
+                
+                precio_cp_unitario = 0.0
+                
+                for _, item in df_bloque_esc.iterrows():
+                    cod_item = str(item['Código']).strip()
+                    pct_item = float(item['%_Calculado'])
+                    coste_cong = float(item.get('Coste_congelación', 0.0))
+                    coste_desp = float(item.get('Coste_despiece', 0.0))
+                    
+                    if cod_item == cod_principal_teorico: 
+                        precio_exw_dinamico = precio_cliente
+                        codigo_a_consumir = cod_vendido 
+                    else:
+                        codigo_a_consumir = cod_item
+                        if cod_item in client_avg.get(cli, {}): precio_exw_dinamico = client_avg[cli][cod_item]
+                        elif cod_item in global_avg: precio_exw_dinamico = global_avg[cod_item]
+                        else: precio_exw_dinamico = float(item.get('Precio EXW', 0.0))
+                    
+                    precio_cp_unitario += (precio_exw_dinamico - coste_cong - coste_desp) * pct_item
+                    
+                    if cli in banco_kilos and codigo_a_consumir in banco_kilos[cli]:
+                        banco_kilos[cli][codigo_a_consumir]['kilos'] -= (kilos_cp * pct_item)
+
+                ventas_procesadas.append({
+                    'Cliente': cli, 'Código': cod_vendido, 'Artículo': nombre_articulo,
+                    'Familia': fam_temp, 'Kilos': kilos_cliente, 'Kilos_CP': kilos_cp,
+                    'Precio EXW': precio_cliente, 'Precio_CP_Unitario': precio_cp_unitario,
+                    'Precio_CP_Total': precio_cp_unitario * kilos_cp
+                })
+
+    sobrantes = []
+    for cli, codigos in banco_kilos.items():
+        for cod, data in codigos.items():
+            if data['kilos'] > 0.01: 
+                sobrantes.append({
+                    'Cliente': cli, 'Código': cod, 'Artículo': data['nombre'],
+                    'Familia': 'Sin clasificar', 'Kilos': data['kilos'], 'Kilos_CP': 0.0,
+                    'Precio EXW': data['precio'], 'Precio_CP_Unitario': 0.0, 'Precio_CP_Total': 0.0
+                })
+
+    df_final = pd.DataFrame(ventas_procesadas)
+    if sobrantes:
+        df_final = pd.concat([df_final, pd.DataFrame(sobrantes)], ignore_index=True)
+
+    return df_final, global_avg, client_avg
+
+def agregar_ventas_cascada(df_v, vocabularios=None):
+    """Ventas agregadas por (Cliente, Código, Nombre) en el formato que consume el motor vectorizado.
+    Cli_Id / Cod_Banco_Id (código tal cual) / Cod_Id (sin espacios) son ids de vocabularios; Nombre queda como texto."""
+    vocabularios = vocabularios or vocabularios_cascada(df_v)
+    vocab_cod = vocabularios['Código']
+    nom_id, nombres = pd.factorize(df_v['Nombre'], sort=True)
+    claves = pd.DataFrame({
+        'Cli_Id': codificar(df_v['Cliente'], vocabularios['Cliente']), 'Cod_Banco_Id': codificar(df_v['Código'], vocab_cod),
+        'Nom_Id': nom_id, 'Kilos': df_v['Kilos'].to_numpy(), 'Precio EXW': df_v['Precio EXW'].to_numpy()
+    })
+    claves = claves[(claves[['Cli_Id', 'Cod_Banco_Id', 'Nom_Id']] >= 0).all(axis=1)]
+    agrupado = claves.groupby(['Cli_Id', 'Cod_Banco_Id', 'Nom_Id']).agg({'Kilos': 'sum', 'Precio EXW': 'mean'}).reset_index()
+    cod_banco = agrupado['Cod_Banco_Id'].to_numpy()
+    return pd.DataFrame({
+        'Cli_Id': agrupado['Cli_Id'].to_numpy(np.int32), 'Cod_Banco_Id': cod_banco.astype(np.int32),
+        'Cod_Id': codificar(vocab_cod[cod_banco].str.strip(), vocab_cod),
+        'Nombre': np.asarray(nombres, dtype=object)[agrupado['Nom_Id'].to_numpy()].astype(str),
+        'Kilos': agrupado['Kilos'].astype(float).to_numpy(), 'Precio EXW': agrupado['Precio EXW'].astype(float).to_numpy()
+    })
+
+def tabla_precios_cascada(ventas, vocabularios):
+    """P2 (media de mercado ponderada por kilos) y P1 / banco de kilos a partir de las ventas agregadas."""
+    n_cod = len(vocabularios['Código'])
+    cod, kilos, precio = ventas['Cod_Banco_Id'].to_numpy(), ventas['Kilos'].to_numpy(), ventas['Precio EXW'].to_numpy()
+    kilos_cod = np.bincount(cod, weights=kilos, minlength=n_cod)
+    ingreso_cod = np.bincount(cod, weights=kilos * precio, minlength=n_cod)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mercado = np.where(kilos_cod > 0, ingreso_cod / kilos_cod, np.nan)
+    banco = construir_banco(ventas['Cli_Id'].to_numpy(), cod, kilos, precio, ventas['Nombre'].to_numpy(), n_cod)
+    return {'vocabularios': vocabularios, 'mercado': mercado, 'banco': banco, 'version': uuid.uuid4().hex}
+
+def procesar_ventas_cascada_vectorizado(df_v, df_esc_completo, mapa_esc_principal, mapa_equiv, esc_to_princ, indice_recetas=None, vocabularios=None):
+    """Misma cascada que el bucle iterativo, resuelta con un join ventas x líneas de receta."""
+    if indice_recetas is None: indice_recetas = construir_indice_recetas(df_esc_completo)
+    vocabularios = vocabularios or vocabularios_cascada(df_v, indice_recetas)
+    ventas = agregar_ventas_cascada(df_v, vocabularios)
+    precios = tabla_precios_cascada(ventas, vocabularios)
+    df_final = resolver_cascada_paralelo(ventas, precios, mapa_esc_principal, mapa_equiv, indice_recetas)
+    return df_final, media_mercado_dict(precios), precios
+
+@etapa('procesar_cadena_cascada')
+def procesar_cadena_cascada(df_v, clientes, nombre_grupo, precios_base, mapa_esc_principal, mapa_equiv, indice_recetas):
+    """Re-cascada solo de los clientes agrupados como cadena, reutilizando la media de mercado y los bancos de kilos ya calculados."""
+    vocabularios = precios_base['vocabularios']
+    vocab_cadena = {**vocabularios, 'Cliente': pd.Index([nombre_grupo], dtype=object)}
+    ventas = agregar_ventas_cascada(df_v[df_v['Cliente'].astype(str).isin(clientes)].assign(Cliente=nombre_grupo), vocab_cadena)
+
+    # Banco de la cadena = suma de los bancos de sus clientes; el precio P1 se pondera por kilos
+    banco_base, n_cod = precios_base['banco'], len(vocabularios['Código'])
+    de_miembros = np.isin(banco_base['claves'] // n_cod, codificar(clientes, vocabularios['Cliente']))
+    miembros = pd.DataFrame({
+        'Cod': banco_base['claves'][de_miembros] % n_cod, 'Kilos': banco_base['kilos'][de_miembros],
+        'Precio': banco_base['precio'][de_miembros], 'Nombre': banco_base['nombre'][de_miembros]
+    })
+    miembros['Ingreso'] = miembros['Kilos'] * miembros['Precio']
+    banco = miembros.groupby('Cod', sort=False).agg(
+        Kilos=('Kilos', 'sum'), Ingreso=('Ingreso', 'sum'), Precio_Medio=('Precio', 'mean'), Nombre=('Nombre', 'first')
+    )
+    precio = np.where(banco['Kilos'] > 0, banco['Ingreso'] / banco['Kilos'], banco['Precio_Medio'])
+    precios = {**precios_base, 'vocabularios': vocab_cadena, 'version': uuid.uuid4().hex,
+               'banco': construir_banco(np.zeros(len(banco)), banco.index.to_numpy(), banco['Kilos'].to_numpy(), precio, banco['Nombre'].to_numpy(), n_cod)}
+
+    df_final = resolver_cascada(ventas, precios, mapa_esc_principal, mapa_equiv, indice_recetas)
+    return df_final, media_mercado_dict(precios_base), precios
+
+def resolver_cascada(ventas, precios, mapa_esc_principal, mapa_equiv, indice_recetas, partes=False):
+    """Consume el banco de kilos de cada cliente con sus ventas agregadas y devuelve df_final (procesadas + sobrantes).
+    El banco de `precios` no se modifica: el consumo se descuenta sobre una copia. Con partes=True devuelve
+    (procesadas, sobrantes, uso_mercado), donde uso_mercado son los pares (Cliente, Código) de líneas que no se
+    resolvieron con P1 y por tanto dependen de la media de mercado."""
+    vocabularios = precios['vocabularios']
+    vocab_cod = vocabularios['Código']
+    n_cod = len(vocab_cod)
+    bloques, offsets = indice_recetas['bloques'], indice_recetas['offsets']
+
+    # Grupo (bloque del índice) y código principal de cada código vendido: principal directo o equivalencia
+    es_directo = tabla_por_codigo(dict.fromkeys(mapa_esc_principal, True), vocab_cod, False, bool)
+    grupo_de = np.where(es_directo, tabla_por_codigo({c: bloques.get(e, -1) for c, e in mapa_esc_principal.items()}, vocab_cod, -1, np.int64),
+                        tabla_por_codigo({c: bloques.get(v[0], -1) for c, v in mapa_equiv.items()}, vocab_cod, -1, np.int64))
+    princ_equiv = dict(zip(mapa_equiv.keys(), codificar([v[1] for v in mapa_equiv.values()], vocab_cod)))
+    princ_de = np.where(es_directo, np.arange(n_cod), tabla_por_codigo(princ_equiv, vocab_cod, -1, np.int64))
+    con_principal = es_directo | tabla_por_codigo(dict.fromkeys(mapa_equiv, True), vocab_cod, False, bool)
+
+    cod_v = ventas['Cod_Id'].to_numpy()
+    validas = ventas[(grupo_de[cod_v] >= 0) & con_principal[cod_v]]
+    cli, cod = validas['Cli_Id'].to_numpy(), validas['Cod_Id'].to_numpy()
+    grupo, princ = grupo_de[cod], princ_de[cod]
+
+    # Líneas de receta del índice: id del código tal cual y sin espacios (columna de la matriz de rendimientos)
+    matriz = indice_recetas['matriz']
+    cod_linea = codificar(indice_recetas['codigos'], vocab_cod).astype(np.int64)
+    cod_item = columnas_en(matriz, vocab_cod)
+
+    # Familia = primera línea del bloque; % principal = primera línea cuyo código coincide con el principal
+    familia = pd.Series(indice_recetas['familias'][offsets[:-1]][grupo], dtype=object)
+    familia = familia.where(~(familia.isna() | (familia.astype(str).str.strip() == "")), "Sin clasificar").to_numpy()
+    clave_linea = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)) * n_cod + cod_linea
+    primera = ~pd.Index(clave_linea).duplicated()
+    pct_por_clave = pd.Series(indice_recetas['pct'][primera], index=clave_linea[primera])
+    pct_principal = np.where(princ >= 0, pct_por_clave.reindex(grupo * n_cod + princ).fillna(0.0).to_numpy(), 0.0)
+    kilos = validas['Kilos'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kilos_cp = np.where(pct_principal > 0, kilos / pct_principal, 0.0)
+
+    # Expansión ventas x líneas de su bloque y resolución de precio P1 -> P2 -> P3
+    n_lineas = np.diff(offsets)[grupo]
+    venta = np.repeat(np.arange(len(validas)), n_lineas)
+    linea = offsets[grupo][venta] + (np.arange(len(venta)) - np.repeat(np.cumsum(n_lineas) - n_lineas, n_lineas))
+    item = cod_item[linea]
+    es_princ = (item == princ[venta]) & (princ[venta] >= 0)
+    precio_venta = validas['Precio EXW'].to_numpy()
+    precio_resuelto, nivel = resolver_precios(precios, cli[venta], item, matriz['precio_teorico'][linea])
+    precio_linea = np.where(es_princ, precio_venta[venta], precio_resuelto)
+    precio_cp_unitario = np.bincount(venta, weights=aportaciones(matriz, linea, precio_linea), minlength=len(validas))
+
+    # Consumo del banco de kilos: la línea principal descuenta el código vendido, el resto su propio código
+    banco = {**precios['banco'], 'kilos': precios['banco']['kilos'].copy()}
+    descontar_banco(banco, cli[venta], np.where(es_princ, cod[venta], item), kilos_cp[venta] * matriz['rendimientos'][linea])
+
+    df_procesadas = pd.DataFrame({
+        'Cliente': vocabularios['Cliente'][cli], 'Código': vocab_cod[cod], 'Artículo': validas['Nombre'].to_numpy(),
+        'Familia': familia, 'Kilos': kilos, 'Kilos_CP': kilos_cp,
+        'Precio EXW': precio_venta, 'Precio_CP_Unitario': precio_cp_unitario,
+        'Precio_CP_Total': precio_cp_unitario * kilos_cp
+    })
+    sobra = banco['kilos'] > 0.01
+    df_sobrantes = pd.DataFrame({
+        'Cliente': vocabularios['Cliente'][banco['claves'][sobra] // n_cod], 'Código': vocab_cod[banco['claves'][sobra] % n_cod],
+        'Artículo': banco['nombre'][sobra], 'Familia': 'Sin clasificar',
+        'Kilos': banco['kilos'][sobra], 'Kilos_CP': 0.0,
+        'Precio EXW': banco['precio'][sobra], 'Precio_CP_Unitario': 0.0, 'Precio_CP_Total': 0.0
+    })
+
+    if partes:
+        uso = np.unique(cli[venta][~es_princ & (nivel > 1)].astype(np.int64) * n_cod + item[~es_princ & (nivel > 1)])
+        uso_mercado = pd.DataFrame({'Cliente': vocabularios['Cliente'][uso // n_cod], 'Código': vocab_cod[uso % n_cod]})
+        return df_procesadas[COLS_CASCADA], df_sobrantes[COLS_CASCADA], uso_mercado
+    return pd.concat([df_procesadas, df_sobrantes], ignore_index=True)[COLS_CASCADA]
+
+# --- CASCADA EN PARALELO ---
+# Cada cliente consume solo su banco de kilos y sus precios P1; lo único compartido es la media de mercado (P2), que ya
+# está calculada antes de resolver. Con muchas ventas la resolución se reparte en tramos contiguos de clientes entre
+# los procesos de un pool que se reutiliza entre cargas (arrancarlo cuesta más que una cascada mediana). Cada tarea
+# lleva las recetas y la tabla de precios, de solo lectura, más las ventas y el banco de su tramo. Como los tramos
+# siguen el orden de cliente, unir las partes da el mismo df_final que resolver_cascada.
+PROCESOS_CASCADA = min(os.cpu_count() or 1, 8)
+MIN_VENTAS_PARALELO = 50_000
+POOL_CASCADA = {'ejecutor': None, 'procesos': 0, 'lock': threading.Lock()}
+
+def tramos_clientes(cli_ids, n_tramos):
+    """Cortes [desde, hasta) de ids de cliente contiguos y con un número parecido de ventas; cli_ids ordenados."""
+    clientes, inicio = np.unique(cli_ids, return_index=True)
+    cortes = np.unique(np.searchsorted(inicio, np.linspace(0, len(cli_ids), n_tramos + 1)[1:-1], side='right'))
+    limites = np.r_[clientes[0], clientes[cortes[(cortes > 0) & (cortes < len(clientes))]], clientes[-1] + 1]
+    return list(zip(limites[:-1], limites[1:]))
+
+def banco_de_clientes(banco, desde, hasta):
+    """Parte del banco de los clientes con id en [desde, hasta): las claves están ordenadas por cliente."""
+    a, b = np.searchsorted(banco['claves'], [desde * banco['n_cod'], hasta * banco['n_cod']])
+    return {**banco, **{c: banco[c][a:b] for c in ('claves', 'kilos', 'precio', 'nombre')}}
+
+def resolver_tramo(comun, ventas, banco):
+    return resolver_cascada(ventas, {**comun['precios'], 'banco': banco}, comun['mapa_esc_principal'], comun['mapa_equiv'], comun['indice_recetas'], partes=True)
+
+def contexto_procesos():
+    """forkserver con el motor precargado donde existe (arranque rápido y seguro con hilos); si no, spawn."""
+    if 'forkserver' not in multiprocessing.get_all_start_methods(): return multiprocessing.get_context('spawn')
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload([__name__])
+    return ctx
+
+def pool_cascada(procesos):
+    """Pool de procesos compartido; se rehace si cambia el número de procesos o si se rompió."""
+    with POOL_CASCADA['lock']:
+        if POOL_CASCADA['ejecutor'] is None or POOL_CASCADA['procesos'] != procesos:
+            if POOL_CASCADA['ejecutor'] is not None: POOL_CASCADA['ejecutor'].shutdown(wait=False, cancel_futures=True)
+            POOL_CASCADA.update(ejecutor=ProcessPoolExecutor(procesos, mp_context=contexto_procesos()), procesos=procesos)
+        return POOL_CASCADA['ejecutor']
+
+def descartar_pool():
+    with POOL_CASCADA['lock']:
+        if POOL_CASCADA['ejecutor'] is not None: POOL_CASCADA['ejecutor'].shutdown(wait=False, cancel_futures=True)
+        POOL_CASCADA.update(ejecutor=None, procesos=0)
+
+def unir(partes):
+    return concatenar(partes).reset_index(drop=True)
+
+@etapa('resolver_cascada_paralelo')
+def resolver_cascada_paralelo(ventas, precios, mapa_esc_principal, mapa_equiv, indice_recetas, partes=False, procesos=None):
+    """resolver_cascada repartida por tramos de clientes entre procesos, con el mismo resultado si las ventas vienen
+    ordenadas por cliente (como las da agregar_ventas_cascada). Sin `procesos` usa PROCESOS_CASCADA y solo reparte a
+    partir de MIN_VENTAS_PARALELO ventas. Se queda en serie con un solo proceso o si el pool no puede arrancar."""
+    if procesos is None: procesos = PROCESOS_CASCADA if len(ventas) >= MIN_VENTAS_PARALELO else 1
+    if procesos <= 1 or ventas.empty:
+        return resolver_cascada(ventas, precios, mapa_esc_principal, mapa_equiv, indice_recetas, partes)
+    cli = ventas['Cli_Id'].to_numpy()
+    orden = np.argsort(cli, kind='stable')
+    ventas, cli = ventas.iloc[orden], cli[orden]
+    tramos = tramos_clientes(cli, procesos)
+    comun = {'precios': {k: v for k, v in precios.items() if k != 'banco'}, 'mapa_esc_principal': mapa_esc_principal,
+             'mapa_equiv': mapa_equiv, 'indice_recetas': indice_recetas}
+    try:
+        pool = pool_cascada(procesos)
+        futuros = [pool.submit(resolver_tramo, comun, ventas[(cli >= a) & (cli < b)], banco_de_clientes(precios['banco'], a, b)) for a, b in tramos]
+        resultados = [f.result() for f in futuros]
+    except (OSError, BrokenProcessPool):
+        descartar_pool()
+        return resolver_cascada(ventas, precios, mapa_esc_principal, mapa_equiv, indice_recetas, partes)
+    procesadas, sobrantes, uso_mercado = (unir([r[i] for r in resultados]) for i in range(3))
+    if partes: return procesadas, sobrantes, uso_mercado
+    return pd.concat([procesadas, sobrantes], ignore_index=True)[COLS_CASCADA]
+
+# --- INGESTA INCREMENTAL DE VENTAS ---
+# Los bancos de kilos y los precios P1 son de cada cliente, así que la cascada se particiona por cliente. Entre dos
+# cargas con las mismas recetas y equivalencias solo se vuelven a resolver los clientes cuyas filas de venta cambiaron
+# (firma por hash de filas) y los que usaban la media de mercado de un código cuyo precio cambió. Las sumas de kilos y
+# kilos x precio por código se guardan y solo se recalculan las de los códigos tocados.
+COLS_FIRMA = ['Cliente', 'Código', 'Nombre', 'Kilos', 'Precio EXW']
+
+def firmas_clientes(df_v):
+    """{cliente: firma} a partir del hash de cada una de sus filas de venta, en el orden de la hoja."""
+    h = pd.util.hash_pandas_object(df_v[[c for c in COLS_FIRMA if c in df_v.columns]], index=False).to_numpy()
+    cli, clientes = pd.factorize(df_v['Cliente'])
+    orden = np.argsort(cli, kind='stable')
+    cortes = np.searchsorted(cli[orden], np.arange(len(clientes) + 1))
+    return {str(c): hashlib.sha1(h[orden[a:b]].tobytes()).hexdigest() for c, a, b in zip(clientes, cortes[:-1], cortes[1:])}
+
+def estado_cascada_vacio():
+    vacio = pd.DataFrame(columns=COLS_CASCADA)
+    return {'firmas': {}, 'agregadas': pd.DataFrame(columns=['Cliente', 'Código', 'Nombre', 'Kilos', 'Precio EXW']),
+            'sumas': pd.DataFrame(columns=['Kilos', 'Ingreso'], dtype=float), 'procesadas': vacio, 'sobrantes': vacio,
+            'uso_mercado': pd.DataFrame(columns=['Cliente', 'Código'])}
+
+def media_de_sumas(sumas):
+    return pd.Series(np.where(sumas['Kilos'] > 0, sumas['Ingreso'] / sumas['Kilos'].where(sumas['Kilos'] > 0, 1.0), np.nan), index=sumas.index)
+
+def concatenar(partes):
+    """pd.concat que ignora las partes vacías (para no heredar sus dtypes); si todas lo están devuelve la última."""
+    llenas = [p for p in partes if len(p)]
+    return pd.concat(llenas) if llenas else partes[-1]
+
+def juntar_por_cliente(previas, nuevas, afectados, vocab_cli):
+    """Filas de `previas` de los clientes no afectados más `nuevas`, en orden de cliente y conservando el orden dentro de cada uno."""
+    df = concatenar([previas[~previas['Cliente'].isin(afectados)], nuevas])
+    return df.iloc[np.argsort(codificar(df['Cliente'], vocab_cli), kind='stable')].reset_index(drop=True)
+
+@etapa('cascada_incremental')
+def cascada_incremental(df_v, mapa_esc_principal, mapa_equiv, indice_recetas, vocabularios, estado=None):
+    """Cascada de df_v reutilizando `estado` (el de una carga anterior con las mismas recetas y equivalencias; None
+    lo calcula todo). Devuelve (df_final, precios, estado_nuevo); df_final es el mismo que daría procesar_ventas_cascada."""
+    estado = estado or estado_cascada_vacio()
+    vocab_cli, vocab_cod = vocabularios['Cliente'], vocabularios['Código']
+    n_cod = len(vocab_cod)
+
+    # Clientes con filas nuevas, modificadas o eliminadas y sus ventas agregadas
+    firmas = firmas_clientes(df_v)
+    cambiados = {c for c in firmas.keys() | estado['firmas'].keys() if firmas.get(c) != estado['firmas'].get(c)}
+    v = agregar_ventas_cascada(df_v[df_v['Cliente'].astype(str).isin(cambiados)], vocabularios)
+    nuevas = pd.DataFrame({'Cliente': vocab_cli[v['Cli_Id'].to_numpy()], 'Código': vocab_cod[v['Cod_Banco_Id'].to_numpy()], 'Nombre': v['Nombre'].to_numpy(),
+                           'Kilos': v['Kilos'].to_numpy(), 'Precio EXW': v['Precio EXW'].to_numpy()})
+    previas = estado['agregadas']
+    agregadas = concatenar([previas[~previas['Cliente'].isin(cambiados)], nuevas])
+    cli_ids, cod_banco = codificar(agregadas['Cliente'], vocab_cli), codificar(agregadas['Código'], vocab_cod).astype(np.int64)
+    orden = np.lexsort((pd.factorize(agregadas['Nombre'], sort=True)[0], cod_banco, cli_ids))
+    agregadas, cli_ids, cod_banco = agregadas.iloc[orden].reset_index(drop=True), cli_ids[orden], cod_banco[orden]
+    ventas = pd.DataFrame({
+        'Cli_Id': cli_ids, 'Cod_Banco_Id': cod_banco.astype(np.int32),
+        'Cod_Id': codificar(agregadas['Código'].astype(str).str.strip(), vocab_cod), 'Nombre': agregadas['Nombre'].to_numpy(),
+        'Kilos': agregadas['Kilos'].to_numpy(dtype=float), 'Precio EXW': agregadas['Precio EXW'].to_numpy(dtype=float)
+    })
+
+    # Sumas por código: solo se recalculan (en el mismo orden que la cascada completa) las de los códigos tocados
+    tocados = pd.Index(previas.loc[previas['Cliente'].isin(cambiados), 'Código']).union(pd.Index(nuevas['Código'])).unique()
+    ids_tocados = codificar(tocados, vocab_cod)
+    ids_tocados = ids_tocados[ids_tocados >= 0]
+    en_tocados = np.isin(cod_banco, ids_tocados)
+    kilos, precio = ventas['Kilos'].to_numpy(), ventas['Precio EXW'].to_numpy()
+    filas = np.bincount(cod_banco[en_tocados], minlength=n_cod)[ids_tocados]
+    sumas_tocadas = pd.DataFrame({
+        'Kilos': np.bincount(cod_banco[en_tocados], weights=kilos[en_tocados], minlength=n_cod)[ids_tocados],
+        'Ingreso': np.bincount(cod_banco[en_tocados], weights=(kilos * precio)[en_tocados], minlength=n_cod)[ids_tocados]
+    }, index=pd.Index(vocab_cod[ids_tocados], dtype=object))[filas > 0]
+    sumas = concatenar([estado['sumas'].drop(tocados, errors='ignore'), sumas_tocadas])
+    media_previa, media = media_de_sumas(estado['sumas']).reindex(tocados), media_de_sumas(sumas).reindex(tocados)
+    cambio_mercado = tocados[~((media_previa == media) | (media_previa.isna() & media.isna())).to_numpy()]
+    mercado, ids_sumas = np.full(n_cod, np.nan), codificar(sumas.index, vocab_cod)
+    mercado[ids_sumas[ids_sumas >= 0]] = media_de_sumas(sumas).to_numpy()[ids_sumas >= 0]
+    banco = construir_banco(ventas['Cli_Id'].to_numpy(), cod_banco, kilos, precio, ventas['Nombre'].to_numpy(), n_cod)
+    precios = {'vocabularios': vocabularios, 'mercado': mercado, 'banco': banco, 'version': uuid.uuid4().hex}
+
+    # Re-cascada de los clientes afectados, con el banco limitado a ellos para que los sobrantes sean solo suyos
+    uso_previo = estado['uso_mercado']
+    afectados = cambiados | set(uso_previo.loc[uso_previo['Código'].isin(cambio_mercado), 'Cliente'])
+    ids_afectados = codificar(sorted(afectados), vocab_cli)
+    de_afectados = np.isin(banco['claves'] // n_cod, ids_afectados)
+    banco_afectados = {**banco, **{c: banco[c][de_afectados] for c in ('claves', 'kilos', 'precio', 'nombre')}}
+    procesadas, sobrantes, uso = resolver_cascada_paralelo(ventas[np.isin(ventas['Cli_Id'], ids_afectados)], {**precios, 'banco': banco_afectados},
+                                                  mapa_esc_principal, mapa_equiv, indice_recetas, partes=True)
+
+    estado_nuevo = {'firmas': firmas, 'agregadas': agregadas, 'sumas': sumas,
+                    'procesadas': juntar_por_cliente(estado['procesadas'], procesadas, afectados, vocab_cli),
+                    'sobrantes': juntar_por_cliente(estado['sobrantes'], sobrantes, afectados, vocab_cli),
+                    'uso_mercado': juntar_por_cliente(uso_previo, uso, afectados, vocab_cli)}
+    df_final = pd.concat([estado_nuevo['procesadas'], estado_nuevo['sobrantes']], ignore_index=True)[COLS_CASCADA]
+    return df_final, precios, estado_nuevo
+
+# --- TRAZABILIDAD DE ESCANDALLOS ---
+# Desglose línea a línea de un escandallo, común al simulador, la Lista Maestra y el panel ejecutivo. Los desgloses
+# se memoizan en una caché LRU ({'lru', 'lock'}) por (escandallo, cliente, código vendido, precio vendido, versión de precios).
+TAM_CACHE_TRAZABILIDAD = 512
+COLS_DESGLOSE = ['CÓDIGO', 'ARTÍCULO', '% RENDIMIENTO', 'ORIGEN DEL PRECIO', 'PRECIO APLICADO', 'COSTE DESPIECE', 'COSTE CONG.', 'APORTACIÓN A CP']
+
+def nueva_cache_lru():
+    return {'lru': OrderedDict(), 'lock': threading.Lock()}
+
+def memo_lru(cache, clave, calcular, tam=TAM_CACHE_TRAZABILIDAD):
+    """calcular() memoizado en cache con política LRU; sin cache simplemente calcula."""
+    if cache is None: return calcular()
+    with cache['lock']:
+        if clave in cache['lru']:
+            cache['lru'].move_to_end(clave)
+            anotar_cache(True)
+            return cache['lru'][clave]
+    anotar_cache(False)
+    valor = calcular()
+    with cache['lock']:
+        cache['lru'][clave] = valor
+        while len(cache['lru']) > tam: cache['lru'].popitem(last=False)
+    return valor
+
+def desglose_lineas(codigos, nombres, pct, origen, precio, coste_desp, coste_cong):
+    """Tabla de desglose (columnas COLS_DESGLOSE) a partir de los arrays de las líneas."""
+    pct, precio = np.asarray(pct, dtype=float), np.asarray(precio, dtype=float)
+    return pd.DataFrame(dict(zip(COLS_DESGLOSE, [
+        codigos, nombres, pct * 100, origen, precio, coste_desp, coste_cong, (precio - coste_cong - coste_desp) * pct
+    ])))
+
+@etapa('desglose_venta')
+def desglose_venta(indice_recetas, mapa_equiv, precios, cliente, cod_vendido, precio_venta, nombre_venta, cache=None):
+    """Escandallo de una venta con el precio aplicado a cada línea: el de la propia venta en la línea principal y
+    P1 / P2 / P3 en el resto. None si el código no es principal ni equivalencia."""
+    if cod_vendido in indice_recetas['principales']:
+        esc_id, cod_principal, es_equivalencia = indice_recetas['principales'][cod_vendido][0], cod_vendido, False
+    elif cod_vendido in mapa_equiv:
+        (esc_id, cod_principal), es_equivalencia = mapa_equiv[cod_vendido], True
+    else: return None
+
+    def calcular():
+        bloque = bloque_receta(indice_recetas, esc_id)
+        if bloque is None: return None
+        codigos = pd.Series(bloque['codigos'], dtype=object).str.strip().to_numpy()
+        vocab = precios['vocabularios']
+        precio, nivel = resolver_precios(precios, np.repeat(codificar([cliente], vocab['Cliente']), len(codigos)), codificar(codigos, vocab['Código']), bloque['precio_exw'])
+        origen = pd.Series(nivel).map(ORIGENES_CASCADA).to_numpy(dtype=object)
+        es_venta = codigos == cod_principal
+        origen[es_venta] = "📍 Venta principal (Equivalencia)" if es_equivalencia else "📍 Venta principal (Esta factura)"
+        nombres = np.where(es_venta & es_equivalencia, f"{nombre_venta} (Equivalencia)", bloque['nombres'])
+        return desglose_lineas(np.where(es_venta, cod_vendido, codigos), nombres, bloque['pct'], origen,
+                               np.where(es_venta, precio_venta, precio), bloque['coste_desp'], bloque['coste_cong'])
+    # El nombre del artículo vendido solo aparece en el desglose de las equivalencias.
+    return memo_lru(cache, (esc_id, cliente, cod_vendido, precio_venta, nombre_venta if es_equivalencia else None, precios['version']), calcular)
+
+@etapa('desglose_simulador')
+def desglose_simulador(indice_recetas, df_sim, esc_id, version, cache=None):
+    """Escandallo tal como está en el simulador (precios y orígenes simulados). None si no existe."""
+    def calcular():
+        bloque = bloque_receta(indice_recetas, esc_id)
+        if bloque is None: return None
+        filas = bloque['filas']
+        origen = df_sim['ORIGEN_PRECIO'].to_numpy()[filas].astype(str) if 'ORIGEN_PRECIO' in df_sim.columns else np.full(len(filas), ORIGEN_TEORICO)
+        return desglose_lineas(pd.Series(bloque['codigos'], dtype=object).str.strip().to_numpy(), bloque['nombres'], df_sim['%_Calculado'].to_numpy()[filas],
+                               origen, df_sim['Precio EXW'].to_numpy()[filas], bloque['coste_desp'], bloque['coste_cong'])
+    return memo_lru(cache, (esc_id, None, None, None, None, version), calcular)
+
+# --- BENCHMARKS DE MERCADO Y SCORING ---
+def claves_grupo(df, clave):
+    """Claves de agrupación para df: una columna, una lista de columnas o una Series alineada por índice."""
+    if isinstance(clave, pd.Series): return clave.loc[df.index]
+    if isinstance(clave, str): return df[clave]
+    return [df[c] for c in clave]
+
+def benchmark_por_fila(df, benchmark, clave='Familia'):
+    """Benchmark de benchmark_mercado(..., clave) para cada fila de df, resolviendo la clave como claves_grupo;
+    0 donde el grupo no tiene benchmark."""
+    claves = claves_grupo(df, clave)
+    claves = pd.MultiIndex.from_arrays(claves) if isinstance(claves, list) else pd.Index(claves)
+    return pd.Series(benchmark, dtype=float).reindex(claves).fillna(0.0).to_numpy(dtype=float)
+
+def benchmark_mercado(df_proc, clave='Familia'):
+    """Precio a CP de mercado por grupo en un solo groupby: Σ Precio_CP_Total / Σ Kilos_CP.
+    clave puede ser una columna ('Familia', 'Cliente'...), una lista de columnas o una Series alineada con df_proc
+    (p. ej. df_proc['Cliente'].map(cadena_de_cliente) para comparar por cadena)."""
+    df_c = df_proc[df_proc['Familia'] != 'Sin clasificar']
+    tot = df_c[['Kilos_CP', 'Precio_CP_Total']].groupby(claves_grupo(df_c, clave)).sum()
+    return dict(zip(tot.index, np.where(tot['Kilos_CP'] > 0, tot['Precio_CP_Total'] / tot['Kilos_CP'], 0.0)))
+
+# --- ÍNDICES DE FILTROS ---
+# Para cada columna de filtro, un vocabulario ordenado y un índice invertido CSR (valor -> posiciones de sus filas),
+# construidos una vez por versión de datos. Las máscaras y las opciones de los desplegables dependientes salen de
+# esos arrays sin recorrer ni copiar el DataFrame. Las máscaras son arrays booleanos por posición de fila.
+COLS_FILTRO_BASE = ['Familia', 'Formato', 'Filtro_Display']
+COLS_FILTRO_VENTAS = ['Cliente', 'Familia', 'Artículo']
+
+def construir_indice_filtros(df, columnas):
+    """{'n': filas, 'columnas': {columna: {'valores', 'codigos', 'filas', 'inicio'}}} de las columnas presentes en df."""
+    indice = {'n': len(df), 'columnas': {}}
+    for col in columnas:
+        if col not in df.columns: continue
+        codigos, valores = pd.factorize(df[col], sort=True)
+        orden = np.argsort(codigos, kind='stable')
+        indice['columnas'][col] = {'valores': pd.Index(valores, dtype=object), 'codigos': codigos, 'filas': orden,
+                                   'inicio': np.searchsorted(codigos[orden], np.arange(len(valores) + 1))}
+    return indice
+
+def filas_con_valores(indice, columna, valores):
+    """Posiciones de las filas cuyo valor de `columna` está en `valores`."""
+    c = indice['columnas'][columna]
+    ids = c['valores'].get_indexer(pd.Index(list(valores), dtype=object).unique())
+    return np.concatenate([c['filas'][c['inicio'][k]:c['inicio'][k + 1]] for k in ids[ids >= 0]] or [np.array([], dtype=np.intp)])
+
+def mascara_filtros(indice, selecciones, mascara=None):
+    """Máscara de las filas que cumplen todas las selecciones {columna: valores} (intersección con `mascara` si se da).
+    Las selecciones vacías y las columnas que no están en el índice no filtran."""
+    mascara = np.ones(indice['n'], dtype=bool) if mascara is None else np.array(mascara, dtype=bool)
+    for col, valores in selecciones.items():
+        if not len(valores) or col not in indice['columnas']: continue
+        en_seleccion = np.zeros(indice['n'], dtype=bool)
+        en_seleccion[filas_con_valores(indice, col, valores)] = True
+        mascara &= en_seleccion
+    return mascara
+
+def opciones_filtro(indice, columna, mascara=None):
+    """Valores de `columna` presentes en las filas de `mascara` (todas si es None), ordenados."""
+    if columna not in indice['columnas']: return []
+    c = indice['columnas'][columna]
+    if mascara is None: return c['valores'].tolist()
+    codigos = c['codigos'][mascara]
+    return c['valores'][np.bincount(codigos[codigos >= 0], minlength=len(c['valores'])) > 0].tolist()
+
+# --- CUBO DE VENTAS ---
+# Sumas de la cascada (sin 'Sin clasificar') por Cliente x Familia x Código x Artículo, construidas una vez tras la
+# cascada, más su roll-up por (Cliente, Familia). Las vistas ejecutiva y maestra leen del cubo en vez de reagrupar
+# líneas: Ingreso_EXW es Σ Kilos x Precio EXW y las medidas *_Pos solo suman las líneas con Kilos_CP > 0 (las que
+# cuentan para el beneficio frente a mercado).
+COLS_CUBO = ['Cliente', 'Familia', 'Código', 'Artículo']
+MEDIDAS_CUBO = ['Kilos', 'Kilos_CP', 'Precio_CP_Total', 'Ingreso_EXW', 'Kilos_CP_Pos', 'Precio_CP_Total_Pos']
+
+def enrollar_cubo(celdas, niveles):
+    """Sumas de las medidas del cubo por `niveles` (cualquier subconjunto de COLS_CUBO)."""
+    return celdas.groupby(niveles, sort=True)[MEDIDAS_CUBO].sum().reset_index()
+
+@etapa('construir_cubo')
+def construir_cubo(df_proc):
+    """{'celdas', 'familias', 'filtros'}: celdas con las medidas, Precio_CP_Unitario (el de su primera línea) y
+    Precio EXW medio ponderado; familias es el roll-up por (Cliente, Familia) y filtros el índice de las celdas."""
+    df = df_proc[df_proc['Familia'] != 'Sin clasificar']
+    positiva = df['Kilos_CP'] > 0
+    df = df.assign(Ingreso_EXW=df['Kilos'] * df['Precio EXW'], Kilos_CP_Pos=df['Kilos_CP'].where(positiva, 0.0),
+                   Precio_CP_Total_Pos=df['Precio_CP_Total'].where(positiva, 0.0))
+    celdas = df.groupby(COLS_CUBO, sort=True).agg(**{m: (m, 'sum') for m in MEDIDAS_CUBO}, Precio_CP_Unitario=('Precio_CP_Unitario', 'first')).reset_index()
+    celdas['Precio EXW'] = np.where(celdas['Kilos'] > 0, celdas['Ingreso_EXW'] / celdas['Kilos'].where(celdas['Kilos'] > 0, 1.0), 0.0)
+    return {'celdas': celdas, 'familias': enrollar_cubo(celdas, ['Cliente', 'Familia']), 'filtros': construir_indice_filtros(celdas, COLS_FILTRO_VENTAS)}
+
+def familias_cubo(cubo, selecciones):
+    """Nivel (Cliente, Familia) con las selecciones {columna: valores} aplicadas. Sale del roll-up precalculado salvo
+    que se filtre por Código o Artículo; entonces se enrolla desde las celdas filtradas."""
+    if any(len(selecciones.get(c, [])) for c in ('Código', 'Artículo')):
+        return enrollar_cubo(cubo['celdas'][mascara_filtros(cubo['filtros'], selecciones)], ['Cliente', 'Familia'])
+    familias = cubo['familias']
+    mascara = np.ones(len(familias), dtype=bool)
+    for col in ('Cliente', 'Familia'):
+        if len(selecciones.get(col, [])): mascara &= familias[col].isin(selecciones[col]).to_numpy()
+    return familias[mascara]
+
+def precio_cp_familias(familias, benchmark):
+    """Precio a CP del cliente y de mercado por fila del nivel familias, con la diferencia unitaria y el extra generado."""
+    familias = familias.copy()
+    familias['Precio_CP_Cliente'] = np.where(familias['Kilos_CP'] > 0, familias['Precio_CP_Total'] / familias['Kilos_CP'].where(familias['Kilos_CP'] > 0, 1.0), 0.0)
+    familias['Precio_CP_Mercado'] = familias['Familia'].map(benchmark)
+    familias['Dif_Unitaria'] = familias['Precio_CP_Cliente'] - familias['Precio_CP_Mercado']
+    familias['Extra_Generado'] = familias['Dif_Unitaria'] * familias['Kilos_CP']
+    return familias
+
+def resumen_clientes_cubo(familias, benchmark, clave='Familia'):
+    """Una fila por cliente a partir del nivel (Cliente, Familia) del cubo (o de sus celdas): kilos vendidos, kilos y
+    precio a CP, beneficio frente a mercado (total y por kg CP, sobre las líneas con Kilos_CP > 0) e ingreso EXW.
+    benchmark y clave son los de benchmark_mercado; la clave se resuelve por fila como en claves_grupo (columnas del
+    nivel o una Series alineada con él, p. ej. familias['Cliente'].map(cadena_de_cliente))."""
+    bench = benchmark_por_fila(familias, benchmark, clave)
+    extra = familias['Precio_CP_Total_Pos'].to_numpy() - bench * familias['Kilos_CP_Pos'].to_numpy()
+    df_cli = familias.assign(Vs_Mercado_Euros=extra).groupby('Cliente').agg(
+        Kilos_Vendidos=('Kilos', 'sum'), Kilos_CP_Totales=('Kilos_CP', 'sum'), Precio_CP_Total=('Precio_CP_Total', 'sum'),
+        Vs_Mercado_Euros=('Vs_Mercado_Euros', 'sum'), Ingreso_EXW=('Ingreso_EXW', 'sum')
+    ).reset_index()
+    con_cp = df_cli['Kilos_CP_Totales'] > 0
+    df_cli['Precio_Medio_CP'] = np.where(con_cp, df_cli['Precio_CP_Total'] / df_cli['Kilos_CP_Totales'].where(con_cp, 1.0), 0.0)
+    df_cli['Beneficio_kg'] = np.where(con_cp, df_cli['Vs_Mercado_Euros'] / df_cli['Kilos_CP_Totales'].where(con_cp, 1.0), 0.0)
+    return df_cli[['Cliente', 'Kilos_Vendidos', 'Kilos_CP_Totales', 'Precio_CP_Total', 'Precio_Medio_CP', 'Vs_Mercado_Euros', 'Beneficio_kg', 'Ingreso_EXW']]
+
+# --- LIMPIEZA DE FUENTES ---
+@etapa('limpiar_equivalencias')
+def limpiar_equivalencias(df_e):
+    if df_e.empty: return df_e
+    df_e.columns = df_e.columns.str.strip()
+    for c in df_e.columns:
+        c_up = c.upper()
+        if c_up in ['CODIGO', 'CÓDIGO']: df_e.rename(columns={c: 'Código'}, inplace=True)
+        elif c_up == 'ESCANDALLO': df_e.rename(columns={c: 'Escandallo'}, inplace=True)
+        elif c_up in ['CODIGO PRINCIPAL', 'CÓDIGO PRINCIPAL']: df_e.rename(columns={c: 'Codigo_Principal'}, inplace=True)
+    if 'Código' in df_e.columns: df_e['Código'] = df_e['Código'].astype(str).str.replace('.0', '', regex=False).str.strip()
+    if 'Codigo_Principal' in df_e.columns: df_e['Codigo_Principal'] = df_e['Codigo_Principal'].astype(str).str.replace('.0', '', regex=False).str.strip()
+    return df_e
+
+def construir_mapa_equivalencias(df_e):
+    """{Código: (Escandallo, Codigo_Principal)} de la hoja de equivalencias ya limpia; los escandallos numéricos pasan a int."""
+    mapa_equiv = {}
+    for cod, esc, princ in zip(df_e['Código'], df_e['Escandallo'], df_e['Codigo_Principal']):
+        try:
+            val_esc = float(esc)
+            val_esc = int(val_esc) if val_esc.is_integer() else val_esc
+        except: val_esc = esc
+        mapa_equiv[cod] = (val_esc, princ)
+    return mapa_equiv
+
+@etapa('limpiar_base')
+def limpiar_base(df_raw):
+    if df_raw.empty: return df_raw
+    df_raw.columns = df_raw.columns.str.strip()
+    rename_map = {'Coste congelación': 'Coste_congelación', 'Coste congelacion': 'Coste_congelación', 'Coste despiece': 'Coste_despiece', 'Precio escandallo': 'Precio_escandallo', 'TIPO': 'Tipo', 'tipo': 'Tipo', 'Fecha': 'Fecha', 'fecha': 'Fecha', 'Cliente': 'Cliente'}
+    df_raw.rename(columns={k:v for k,v in rename_map.items() if k in df_raw.columns}, inplace=True)
+    if 'Tipo' not in df_raw.columns: df_raw['Tipo'] = ""
+    for col in ['Cliente', 'Fecha', 'Familia', 'Formato']:
+        if col not in df_raw.columns: df_raw[col] = ""
+        else: df_raw[col] = df_raw[col].fillna("")
+    if 'Código' in df_raw.columns: df_raw['Código'] = df_raw['Código'].astype(str).str.replace('.0', '', regex=False)
+    cols_num = ['Cantidad(kg)', 'Coste_despiece', 'Coste_congelación', 'Precio EXW']
+    fallos_numericos = {}
+    for col in cols_num:
+        if col in df_raw.columns: df_raw[col], fallos_numericos[col] = clean_european_column(df_raw[col])
+        else: df_raw[col] = 0.0
+    if 'Fecha' in df_raw.columns:
+        df_raw['Fecha_dt'] = pd.to_datetime(df_raw['Fecha'], dayfirst=True, errors='coerce')
+        if df_raw['Fecha_dt'].notna().any():
+            max_fechas = df_raw.groupby('Escandallo')['Fecha_dt'].transform('max')
+            mask = (df_raw['Fecha_dt'] == max_fechas) | (df_raw['Fecha_dt'].isna())
+            df_raw = df_raw[mask].copy()
+            df_raw.drop(columns=['Fecha_dt'], inplace=True)
+    df_calc = recalcular_dataframe(df_raw)
+    df_calc.attrs['fallos_numericos'] = {c: n for c, n in fallos_numericos.items() if n}
+    return df_calc
+
+@etapa('limpiar_ventas')
+def limpiar_ventas(df_v):
+    if df_v.empty: return df_v
+    df_v.columns = df_v.columns.str.strip()
+    for c in df_v.columns:
+        c_up = c.upper()
+        if c_up in ['CODIGO', 'CÓDIGO']: df_v.rename(columns={c: 'Código'}, inplace=True)
+        elif c_up == 'CLIENTE': df_v.rename(columns={c: 'Cliente'}, inplace=True)
+        elif c_up == 'NOMBRE': df_v.rename(columns={c: 'Nombre'}, inplace=True)
+        elif c_up == 'KILOS': df_v.rename(columns={c: 'Kilos'}, inplace=True)
+        elif c_up == 'PRECIO EXW': df_v.rename(columns={c: 'Precio EXW'}, inplace=True)
+    fallos_numericos = {}
+    for col in ['Kilos', 'Precio EXW']:
+        if col in df_v.columns: df_v[col], fallos_numericos[col] = clean_european_column(df_v[col])
+    if 'Código' in df_v.columns: df_v['Código'] = df_v['Código'].astype(str).str.replace('.0', '', regex=False)
+    df_v.attrs['fallos_numericos'] = {c: n for c, n in fallos_numericos.items() if n}
+    return df_v
+
+# --- PREPROCESADO DE FUENTES ---
+def huella_df(df):
+    """Huella del contenido de un DataFrame (columnas y valores)."""
+    if df is None: return "sin-datos"
+    h = hashlib.sha1("|".join(map(str, df.columns)).encode())
+    if not df.empty: h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+def huella_equivalencias(mapa_equiv):
+    return hashlib.sha1(repr(sorted(mapa_equiv.items(), key=repr)).encode()).hexdigest()
+
+def combinar_huellas(*huellas):
+    h = hashlib.sha1()
+    for parte in huellas: h.update(parte.encode())
+    return h.hexdigest()
+
+def huella_recetas(df_base, mapa_equiv):
+    """Huella de lo que define las recetas: base y equivalencias. Si no cambia, la cascada puede ser incremental."""
+    return combinar_huellas(huella_df(df_base), huella_equivalencias(mapa_equiv))
+
+def huella_fuentes(df_base, df_ventas, mapa_equiv):
+    """Versión de datos: huella conjunta de las tres hojas ya limpias."""
+    return combinar_huellas(huella_recetas(df_base, mapa_equiv), huella_df(df_ventas))
+
+def etiquetas_escandallo(df_base):
+    """Texto 'Escandallo | Código | Nombre' del artículo principal de cada escandallo."""
+    if 'Tipo' in df_base.columns and df_base['Tipo'].str.contains('Principal', case=False, na=False).any():
+        df_principales = df_base[df_base['Tipo'].str.contains('Principal', case=False, na=False)][['Escandallo', 'Código', 'Nombre']]
+    else:
+        df_principales = df_base.groupby('Escandallo')[['Escandallo', 'Código', 'Nombre']].first().reset_index()
+    
+    df_principales = df_principales.drop_duplicates(subset=['Escandallo'])
+    df_principales['Texto_Escandallo'] = df_principales['Escandallo'].astype(str) + " | " + df_principales['Código'].astype(str) + " | " + df_principales['Nombre']
+    return dict(zip(df_principales['Escandallo'], df_principales['Texto_Escandallo']))
+
+def construir_simulador(df_base, global_avg, precios_manuales=None):
+    """Simulador sembrado por capas: teórico, venta real y, si los hay, los precios manuales de una sesión."""
+    capas = [(ORIGEN_VENTA_REAL, global_avg), (ORIGEN_MANUAL, precios_manuales or {})]
+    return recalcular_dataframe(aplicar_capas_precio(df_base.copy(), capas))
+
+def ranking_inicial(df_sim, indice_recetas):
+    """Ranking del simulador recién construido, o None si la base no permite calcular el Precio a CP."""
+    return construir_ranking_simulador(df_sim, indice_recetas) if 'Precio_escandallo_Calculado' in df_sim.columns else None
+
+@etapa('preprocesar_fuentes')
+def preprocesar_fuentes(df_base, indice_recetas, df_ventas, err_v, mapa_equiv, previo=None):
+    """Todo lo que depende solo de los datos: cascada, medias, benchmark y simulador base con su ranking.
+    previo son los resultados de una carga anterior y se reutiliza lo que no depende de las fuentes que cambiaron
+    (según la huella de cada una): con las mismas recetas y equivalencias la cascada solo se rehace para los clientes
+    afectados por el cambio de ventas (ver cascada_incremental), y con la misma base y la misma media de mercado se
+    conserva el simulador. No modifica df_base ni df_ventas."""
+    huellas = {'base': huella_df(df_base), 'equivalencias': huella_equivalencias(mapa_equiv), 'ventas': huella_df(df_ventas)}
+    huella = combinar_huellas(huellas['base'], huellas['equivalencias'])
+    misma_base = previo is not None and previo.get('huellas', {}).get('base') == huellas['base']
+    if misma_base: df_base, filtros_base = previo['df_global_base'], previo['filtros_base']
+    else:
+        if 'Escandallo' in df_base.columns: df_base = df_base.assign(Filtro_Display=df_base['Escandallo'].map(etiquetas_escandallo(df_base)))
+        filtros_base = construir_indice_filtros(df_base, COLS_FILTRO_BASE)
+    R = {'df_global_base': df_base, 'indice_recetas': indice_recetas, 'mapa_equivalencias': mapa_equiv, 'err_v': err_v,
+         'df_proc_global': pd.DataFrame(), 'global_avg_base': {}, 'precios_base': None, 'bench_familia': {},
+         'mapa_escandallos': {}, 'esc_to_princ': {}, 'df_ventas_crudas': pd.DataFrame(), 'vocabularios': None, 'df_simulador': df_base,
+         'ranking_simulador': None, 'version_simulador': uuid.uuid4().hex, 'cadenas': nueva_cache_lru(), 'filtros_base': filtros_base,
+         'filtros_ventas': construir_indice_filtros(pd.DataFrame(), COLS_FILTRO_VENTAS), 'cubo': None, 'huellas': huellas, 'huella_recetas': huella, 'estado_cascada': None}
+    if err_v or df_ventas is None or df_ventas.empty or 'Código' not in df_ventas.columns or not indice_recetas['principales']:
+        R['ranking_simulador'] = ranking_inicial(df_base, indice_recetas)
+        return R
+    
+    df_ventas = df_ventas[~df_ventas['Cliente'].str.contains('Entradas a Congelar', case=False, na=False)]
+    mapa_escandallos = {cod: esc for cod, (esc, _) in indice_recetas['principales'].items()}
+    esc_to_princ = dict(indice_recetas['principal_de'])
+    vocabularios = vocabularios_cascada(df_ventas, indice_recetas)
+    if MOTOR_CASCADA == "vectorizado":
+        estado = previo['estado_cascada'] if previo and previo.get('huella_recetas') == huella else None
+        df_proc_global, precios_base, R['estado_cascada'] = cascada_incremental(df_ventas, mapa_escandallos, mapa_equiv, indice_recetas, vocabularios, estado)
+        global_avg_base = media_mercado_dict(precios_base)
+    else:
+        df_proc_global, global_avg_base, precios_base = procesar_ventas_cascada(df_ventas, df_base, mapa_escandallos, mapa_equiv, esc_to_princ, indice_recetas, vocabularios)
+    R.update(df_proc_global=df_proc_global, global_avg_base=global_avg_base, precios_base=precios_base,
+             bench_familia=benchmark_mercado(df_proc_global, 'Familia') if not df_proc_global.empty else {},
+             filtros_ventas=construir_indice_filtros(df_proc_global, COLS_FILTRO_VENTAS), cubo=construir_cubo(df_proc_global),
+             mapa_escandallos=mapa_escandallos, esc_to_princ=esc_to_princ, df_ventas_crudas=df_ventas, vocabularios=vocabularios)
+    if misma_base and previo['global_avg_base'] == global_avg_base and 'ORIGEN_PRECIO' in previo['df_simulador'].columns:
+        R.update(df_simulador=previo['df_simulador'], ranking_simulador=previo['ranking_simulador'], version_simulador=previo['version_simulador'])
+    else: R['df_simulador'] = construir_simulador(df_base, global_avg_base)
+    if R['ranking_simulador'] is None: R['ranking_simulador'] = ranking_inicial(R['df_simulador'], indice_recetas)
+    return R
@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+
+from benchmark import generar_hojas
+from motor import (
+    limpiar_base, limpiar_equivalencias, limpiar_ventas, construir_mapa_equivalencias, construir_indice_recetas,
+    procesar_ventas_cascada_iterativo, procesar_ventas_cascada_vectorizado,
+)
+
+# Paridad del motor vectorizado con el bucle iterativo original sobre datos sintéticos.
+
+def hojas_con_casos_limite(semilla):
+    """Hojas de benchmark.generar_hojas con códigos con espacios (base y ventas) y una equivalencia cuyo principal
+    no está en su escandallo."""
+    hoja_base, hoja_equiv, hoja_ventas = generar_hojas(escandallos=150, lineas=6, clientes=40, codigos_cliente=30, semilla=semilla)
+    subproductos = hoja_base.index[hoja_base['TIPO'] == 'Subproducto'][::7]
+    hoja_base.loc[subproductos, 'Código'] = ' ' + hoja_base.loc[subproductos, 'Código'] + ' '
+    hoja_ventas.loc[hoja_ventas.index[::11], 'CODIGO'] = hoja_ventas.loc[hoja_ventas.index[::11], 'CODIGO'] + ' '
+    hoja_equiv = pd.concat([hoja_equiv, pd.DataFrame({'CODIGO': ['59999'], 'ESCANDALLO': ['3'], 'CODIGO PRINCIPAL': ['10004']})], ignore_index=True)
+    hoja_ventas = pd.concat([hoja_ventas, pd.DataFrame({
+        'CLIENTE': ['CLIENTE 0001', 'CLIENTE 0002'], 'CODIGO': ['59999', '59999'], 'NOMBRE': ['EQUIV SIN PRINCIPAL'] * 2,
+        'KILOS': ['10,00', '4,50'], 'PRECIO EXW': ['3,000', '2,500'],
+    })], ignore_index=True)
+    return hoja_base, hoja_equiv, hoja_ventas
+
+@pytest.mark.parametrize('semilla', [0, 1, 2])
+def test_vectorizado_igual_que_iterativo(semilla):
+    hoja_base, hoja_equiv, hoja_ventas = hojas_con_casos_limite(semilla)
+    df_base = limpiar_base(hoja_base)
+    indice = construir_indice_recetas(df_base)
+    mapa_equiv = construir_mapa_equivalencias(limpiar_equivalencias(hoja_equiv))
+    df_v = limpiar_ventas(hoja_ventas)
+    df_v = df_v[~df_v['Cliente'].str.contains('Entradas a Congelar', case=False, na=False)]
+    mapa_esc = {cod: esc for cod, (esc, _) in indice['principales'].items()}
+    esc_to_princ = dict(indice['principal_de'])
+    esc_equiv, princ_equiv = mapa_equiv['59999']
+    assert princ_equiv not in set(df_base.loc[df_base['Escandallo'].astype(str) == str(esc_equiv), 'Código'].astype(str).str.strip())
+
+    df_iter, avg_iter, _ = procesar_ventas_cascada_iterativo(df_v, df_base, mapa_esc, mapa_equiv, esc_to_princ)
+    df_vect, avg_vect, _ = procesar_ventas_cascada_vectorizado(df_v, df_base, mapa_esc, mapa_equiv, esc_to_princ, indice)
+
+    pd.testing.assert_frame_equal(df_iter.reset_index(drop=True), df_vect.reset_index(drop=True), check_dtype=False, rtol=1e-9)
+    assert avg_iter.keys() == avg_vect.keys()
+    assert avg_vect == pytest.approx(avg_iter, rel=1e-12)
+    assert (df_vect['Código'] == '59999').any()
@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+import fuentes
+from fuentes import load_spreadsheet_batch, recargar_fuentes, revisiones_spreadsheets, leer_snapshot, ruta_snapshot, id_spreadsheet, gid_de_url, limpiar_ventas, limpiar_equivalencias
+
+# Carga por lotes y snapshots locales contra un cliente gspread falso que registra cada llamada.
+
+class HojaFalsa:
+    def __init__(self, cliente, sid): self.cliente, self.id = cliente, sid
+    def get_lastUpdateTime(self):
+        self.cliente.llamadas.append(('get_lastUpdateTime', self.id))
+        return self.cliente.revisiones[self.id]
+    def worksheets(self):
+        self.cliente.llamadas.append(('worksheets', self.id))
+        return [type('Pestaña', (), {'id': gid, 'title': titulo})() for (sid, gid), (titulo, _) in self.cliente.pestañas.items() if sid == self.id]
+    def values_batch_get(self, rangos):
+        self.cliente.llamadas.append(('values_batch_get', self.id))
+        valores = {titulo: filas for (sid, _), (titulo, filas) in self.cliente.pestañas.items() if sid == self.id}
+        return {'valueRanges': [{'range': r, 'values': valores[r[1:-1].replace("''", "'")]} for r in rangos]}
+
+class ClienteFalso:
+    def __init__(self, pestañas, revisiones):
+        self.pestañas, self.revisiones, self.llamadas = pestañas, revisiones, []
+    def open_by_key(self, sid):
+        self.llamadas.append(('open_by_key', sid))
+        return HojaFalsa(self, sid)
+    def descargas(self):
+        return [ll for ll in self.llamadas if ll[0] in ('worksheets', 'values_batch_get')]
+
+SID = id_spreadsheet(fuentes.VENTAS_URL)
+URL_EQUIV = f"https://docs.google.com/spreadsheets/d/{SID}/edit?gid=7#gid=7"
+FUENTES = {'ventas': (fuentes.VENTAS_URL, limpiar_ventas), 'equivalencias': (URL_EQUIV, limpiar_equivalencias)}
+VENTAS = [['CLIENTE', 'CODIGO', 'NOMBRE', 'KILOS', 'PRECIO EXW'], ['A', '100', 'P', '1.000', '3,5'], ['B', '300', 'S', '50', 'abc']]
+EQUIV = [['CODIGO', 'ESCANDALLO', 'CODIGO PRINCIPAL'], ['300', '1', '100']]
+
+@pytest.fixture
+def cliente(tmp_path, monkeypatch):
+    monkeypatch.setattr(fuentes, 'SNAPSHOT_DIR', str(tmp_path))
+    return ClienteFalso({(SID, gid_de_url(fuentes.VENTAS_URL)): ('Ventas', VENTAS), (SID, 7): ("Equiv's", EQUIV)}, {SID: 'r1'})
+
+def test_primera_carga_descarga_y_guarda_snapshots(cliente):
+    r = load_spreadsheet_batch(cliente, SID, FUENTES)
+    assert r['ventas'][1] is None and r['equivalencias'][1] is None
+    assert list(r['ventas'][0]['Cliente']) == ['A', 'B']
+    assert [ll[0] for ll in cliente.descargas()] == ['worksheets', 'values_batch_get']
+    assert os.path.exists(ruta_snapshot('ventas')) and os.path.exists(ruta_snapshot('equivalencias'))
+
+def test_snapshot_vigente_no_descarga(cliente):
+    primera = load_spreadsheet_batch(cliente, SID, FUENTES)
+    cliente.llamadas.clear()
+    segunda = load_spreadsheet_batch(cliente, SID, FUENTES)
+    assert cliente.descargas() == []
+    for nombre in FUENTES: assert segunda[nombre][0].equals(primera[nombre][0])
+
+def test_cambio_de_revision_vuelve_a_descargar(cliente):
+    load_spreadsheet_batch(cliente, SID, FUENTES)
+    cliente.revisiones[SID] = 'r2'
+    cliente.pestañas[(SID, gid_de_url(fuentes.VENTAS_URL))] = ('Ventas', VENTAS + [['C', '100', 'P', '5', '4']])
+    cliente.llamadas.clear()
+    r = load_spreadsheet_batch(cliente, SID, FUENTES)
+    assert [ll[0] for ll in cliente.descargas()] == ['worksheets', 'values_batch_get']
+    assert list(r['ventas'][0]['Cliente']) == ['A', 'B', 'C']
+    assert leer_snapshot('ventas', 'r1') is None and len(leer_snapshot('ventas', 'r2')) == 3
+
+def test_subir_version_snapshot_invalida(cliente, monkeypatch):
+    load_spreadsheet_batch(cliente, SID, FUENTES)
+    monkeypatch.setattr(fuentes, 'VERSION_SNAPSHOT', fuentes.VERSION_SNAPSHOT + '-nueva')
+    assert leer_snapshot('ventas', 'r1') is None
+    cliente.llamadas.clear()
+    load_spreadsheet_batch(cliente, SID, FUENTES)
+    assert [ll[0] for ll in cliente.descargas()] == ['worksheets', 'values_batch_get']
+    assert leer_snapshot('ventas', 'r1') is not None
+
+@pytest.mark.parametrize('estropear', [lambda b: b[:len(b) // 2], lambda b: b'basura'])
+def test_snapshot_corrupto_vuelve_a_la_red(cliente, estropear):
+    primera = load_spreadsheet_batch(cliente, SID, FUENTES)
+    with open(ruta_snapshot('ventas'), 'rb') as f: contenido = f.read()
+    with open(ruta_snapshot('ventas'), 'wb') as f: f.write(estropear(contenido))
+    assert leer_snapshot('ventas', 'r1') is None
+    cliente.llamadas.clear()
+    r = load_spreadsheet_batch(cliente, SID, FUENTES)
+    assert ('values_batch_get', SID) in cliente.descargas()
+    assert r['ventas'][1] is None and r['ventas'][0].equals(primera['ventas'][0])
+    assert r['equivalencias'][0].equals(primera['equivalencias'][0])
+
+def test_attrs_sobreviven_al_snapshot(cliente):
+    primera = load_spreadsheet_batch(cliente, SID, FUENTES)
+    assert primera['ventas'][0].attrs['fallos_numericos'] == {'Precio EXW': 1}
+    assert leer_snapshot('ventas', 'r1').attrs == primera['ventas'][0].attrs
+
+def test_recarga_reutiliza_la_consulta_de_revisiones(cliente):
+    memoria, abiertas = {}, {}
+    revisiones = revisiones_spreadsheets(FUENTES, cliente, abiertas)
+    r = recargar_fuentes(FUENTES, cliente, revisiones, memoria, abiertas)
+    assert r['ventas'][1] is None and memoria[SID][0] == 'r1'
+    assert [ll[0] for ll in cliente.llamadas] == ['open_by_key', 'get_lastUpdateTime', 'worksheets', 'values_batch_get']
+    cliente.llamadas.clear()
+    recargar_fuentes(FUENTES, cliente, revisiones_spreadsheets(FUENTES, cliente, abiertas), memoria, abiertas)
+    assert [ll[0] for ll in cliente.llamadas] == ['open_by_key', 'get_lastUpdateTime']
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import generar_hojas
+from motor import (
+    limpiar_base, limpiar_equivalencias, limpiar_ventas, construir_mapa_equivalencias, construir_indice_recetas,
+    preprocesar_fuentes, nueva_cache_lru, desglose_venta, construir_simulador, construir_ranking_simulador, editar_simulador,
+    precio_cp_escandallos, precio_cp_por_cliente, vector_precios, resolver_precios, codificar,
+    benchmark_mercado, claves_grupo, familias_cubo, resumen_clientes_cubo,
+)
+
+# Servicios del motor sobre los resultados de preprocesar_fuentes con datos sintéticos.
+
+@pytest.fixture(scope='module')
+def resultados():
+    hoja_base, hoja_equiv, hoja_ventas = generar_hojas(escandallos=120, lineas=6, clientes=30, codigos_cliente=25, semilla=4)
+    # Escandallos numéricos, como los de la base real, para que casen con los de las equivalencias.
+    hoja_base['Escandallo'] = hoja_base['Escandallo'].astype(int)
+    df_base = limpiar_base(hoja_base)
+    return preprocesar_fuentes(df_base, construir_indice_recetas(df_base), limpiar_ventas(hoja_ventas), None,
+                               construir_mapa_equivalencias(limpiar_equivalencias(hoja_equiv)))
+
+def test_desglose_de_equivalencia_con_el_nombre_de_cada_venta(resultados):
+    R, cache = resultados, nueva_cache_lru()
+    cod = next(iter(R['mapa_equivalencias']))
+    cliente = R['df_proc_global']['Cliente'].iloc[0]
+    args = (R['indice_recetas'], R['mapa_equivalencias'], R['precios_base'], cliente, cod, 2.5)
+    primero = desglose_venta(*args, 'ARTICULO A', cache)
+    segundo = desglose_venta(*args, 'ARTICULO B', cache)
+    assert primero is not None and segundo is not None
+    assert primero.iloc[:, 1].str.contains('ARTICULO A').any() and not primero.iloc[:, 1].str.contains('ARTICULO B').any()
+    assert segundo.iloc[:, 1].str.contains('ARTICULO B').any()
+    assert desglose_venta(*args, 'ARTICULO A', cache) is primero
+
+def precio_cp_por_formula(df):
+    """Precio a CP por escandallo como suma por líneas de (Precio EXW - Coste_congelación - Coste_despiece) * %_Calculado."""
+    return ((df['Precio EXW'] - df['Coste_congelación'] - df['Coste_despiece']) * df['%_Calculado']).groupby(df['Escandallo']).sum()
+
+def test_ranking_del_simulador_igual_que_la_formula(resultados):
+    R = resultados
+    df_sim, indice = R['df_simulador'].copy(), R['indice_recetas']
+    ranking = construir_ranking_simulador(df_sim, indice)
+    esperado = precio_cp_por_formula(df_sim)
+    assert ranking.index.equals(esperado.index)
+    np.testing.assert_allclose(ranking['Precio_escandallo_Calculado'], esperado, rtol=1e-12)
+    pd.testing.assert_frame_equal(R['ranking_simulador'], ranking)
+
+    cambios = [(esc, cod, 7.25) for cod, (esc, _) in list(indice['principales'].items())[:5]]
+    editar_simulador(df_sim, ranking, indice, cambios + cambios[:1])
+    np.testing.assert_allclose(ranking['Precio_escandallo_Calculado'], precio_cp_por_formula(df_sim), rtol=1e-12)
+
+def test_precio_cp_matriz_con_vector_de_precios_por_codigo(resultados):
+    R = resultados
+    matriz = R['indice_recetas']['matriz']
+    esperado = precio_cp_por_formula(construir_simulador(R['df_global_base'], R['global_avg_base']))
+    precio_cp = precio_cp_escandallos(matriz, vector_precios(matriz, R['global_avg_base']))
+    np.testing.assert_allclose(precio_cp, esperado.loc[R['indice_recetas']['escandallos']], rtol=1e-12)
+
+def test_precio_cp_por_cliente_igual_que_un_vector_por_cliente(resultados):
+    R = resultados
+    matriz, precios = R['indice_recetas']['matriz'], R['precios_base']
+    clientes = np.arange(len(precios['vocabularios']['Cliente']))
+    por_cliente = precio_cp_por_cliente(matriz, precios, clientes)
+    cod = codificar(matriz['codigos'], precios['vocabularios']['Código'])
+    for c in clientes[::7]:
+        vector, _ = resolver_precios(precios, np.full(len(cod), c, dtype=np.int32), cod, np.full(len(cod), np.nan))
+        np.testing.assert_allclose(por_cliente[c], precio_cp_escandallos(matriz, vector), rtol=1e-12)
+    assert not np.allclose(por_cliente[0], precio_cp_escandallos(matriz, vector_precios(matriz, R['global_avg_base'])))
+
+def cadena_de(cliente):
+    return f"CADENA {int(cliente[-1]) % 3}"
+
+@pytest.mark.parametrize('nivel, clave', [
+    ('familias', 'Familia'), ('celdas', 'Código'), ('celdas', ['Familia', 'Código']), ('familias', 'cadena'),
+])
+def test_resumen_clientes_por_cualquier_clave(resultados, nivel, clave):
+    df_proc, cubo = resultados['df_proc_global'], resultados['cubo']
+    filas = familias_cubo(cubo, {}) if nivel == 'familias' else cubo['celdas']
+    clave_proc, clave_filas = (df_proc['Cliente'].map(cadena_de), filas['Cliente'].map(cadena_de)) if clave == 'cadena' else (clave, clave)
+    benchmark = benchmark_mercado(df_proc, clave_proc)
+    df_cli = resumen_clientes_cubo(filas, benchmark, clave_filas).set_index('Cliente')
+
+    # Referencia línea a línea: Σ (Precio_CP_Total - benchmark de la línea x Kilos_CP) sobre las líneas con Kilos_CP > 0
+    lineas = df_proc[(df_proc['Familia'] != 'Sin clasificar') & (df_proc['Kilos_CP'] > 0)]
+    claves = claves_grupo(lineas, clave_proc)
+    claves = list(zip(*claves)) if isinstance(claves, list) else claves
+    extra = lineas['Precio_CP_Total'] - pd.Series(claves, index=lineas.index).map(benchmark) * lineas['Kilos_CP']
+    esperado = extra.groupby(lineas['Cliente']).sum()
+    np.testing.assert_allclose(df_cli['Vs_Mercado_Euros'].reindex(esperado.index), esperado, rtol=1e-9, atol=1e-9)